@@ -1,46 +1,72 @@
 # ChatManager.py
-import json
-import os
 from pathlib import Path
 from datetime import datetime
 from typing import List, Dict
+from StorageBackend import create_storage_backend
+from MessageStore import MessageStore
 
 class ChatManager:
     """
     聊天管理器重构版 - 支持广播室、个人消息、群聊
     """
     
-    def __init__(self, data_dir="data"):
+    def __init__(self, data_dir="data", storage_mode="json", storage=None, history_tail=None):
         """
         初始化聊天管理器
+        
+        参数:
+        - data_dir: 数据存储目录
+        - storage_mode: 存储模式，"json"、"jsonl"（追加式消息日志）、"segmented" 或 "sqlite"
+        - storage: 共享的存储后端，提供时忽略 storage_mode
+        - history_tail: 启动时每个会话只加载最新的这么多条消息，更早的历史翻页时再加载；
+          为空时加载全部历史（json/jsonl 模式始终加载全部）
         """
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(exist_ok=True)
-        self.messages_file = self.data_dir / "messages.json"
+        if storage is None:
+            storage = create_storage_backend(self.data_dir, storage_mode)
+        self.storage = storage
         
         # 导入好友管理器
         try:
             from FriendManager import FriendManager
-            self.friend_manager = FriendManager(data_dir)
+            self.friend_manager = FriendManager(data_dir, storage=self.storage)
             print("✅ 好友管理器加载成功")
         except ImportError as e:
             print(f"❌ 好友管理器加载失败: {e}")
             self.friend_manager = None
         
-        # 加载现有消息数据
-        self.messages = self._load_messages()
-        print(f"💬 聊天系统初始化完成，已加载 {len(self.messages)} 条历史消息")
+        # 加载现有消息数据（按会话索引，读取历史时无需扫描全部消息）
+        # 搜索索引保存在 data/search_index，重启后无需重新分词
+        # 同一份数据共用一个消息仓库，chat.Chat 发送的消息这里立即可见
+        self.message_store = MessageStore.shared(self.storage, tail_size=history_tail)
+        self._load_messages()
+        print(f"💬 聊天系统初始化完成，已加载 {len(self.message_store)} 条历史消息")
+    
+    @property
+    def conversation_index(self) -> Dict[str, List[Dict]]:
+        """
+        会话索引：recipient_id -> 该会话的消息列表
+        """
+        return self.message_store.conversations
+    
+    @property
+    def messages(self) -> List[Dict]:
+        """
+        全部消息（按时间顺序合并各会话索引）
+        """
+        return self.message_store.messages
     
-    def _load_messages(self) -> List[Dict]:
+    def _load_messages(self):
         """
-        从JSON文件加载历史聊天记录
+        从存储后端加载历史聊天记录
         """
+        if self.message_store.loaded:
+            # 共享仓库已由其他模块加载
+            return
         try:
-            if self.messages_file.exists():
-                with open(self.messages_file, 'r', encoding='utf-8') as f:
-                    messages = json.load(f)
-                    print(f"✅ 成功加载聊天记录，共 {len(messages)} 条消息")
-                    return messages
+            if self.message_store.load():
+                print(f"✅ 成功加载聊天记录，共 {len(self.message_store)} 条消息")
             else:
                 print("📝 聊天记录文件不存在，将创建新文件")
                 # 创建欢迎消息
@@ -60,24 +86,26 @@ class ChatManager:
                 ]
                 # 保存初始消息
                 self._save_messages(welcome_messages)
-                return welcome_messages
         except Exception as e:
             print(f"❌ 加载聊天记录时出错: {e}")
-            return []
+    
+    def subscribe(self, callback):
+        """
+        订阅消息变化，callback(event, conversation_id, messages)，见 MessageStore.subscribe
+        """
+        self.message_store.subscribe(callback)
+    
+    def unsubscribe(self, callback):
+        """
+        取消订阅消息变化
+        """
+        self.message_store.unsubscribe(callback)
     
     def _save_messages(self, messages=None) -> bool:
         """
-        将聊天记录保存到JSON文件
+        将全部聊天记录整体保存到存储后端
         """
-        try:
-            if messages is None:
-                messages = self.messages
-            with open(self.messages_file, 'w', encoding='utf-8') as f:
-                json.dump(messages, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            print(f"❌ 保存聊天记录时出错: {e}")
-            return False
+        return self.message_store.save_all(messages)
     
     def send_message(self, sender: str, content: str, recipient_id: str = None) -> (bool, str):
         """
@@ -110,15 +138,10 @@ class ChatManager:
             "timestamp": self._get_current_time()
         }
         
-        # 添加到消息列表
-        self.messages.append(message)
-        
-        # 保存消息
-        if self._save_messages():
+        # 添加到会话索引并保存（jsonl/sqlite 模式只追加一条记录），失败时自动回滚
+        if self.message_store.append(message):
             return True, "✅ 消息发送成功"
         else:
-            # 如果保存失败，从列表中移除
-            self.messages.remove(message)
             return False, "❌ 消息发送失败，请稍后重试"
     
     def get_messages(self, user_id: str, conversation_id: str = None) -> List[Dict]:
@@ -127,24 +150,32 @@ class ChatManager:
         如果未指定conversation_id，则返回广播室消息
         """
         # 默认获取广播室消息
-        if conversation_id is None:
-            if self.friend_manager:
-                conversation_id = self.friend_manager.get_broadcast_room_id()
-            else:
-                conversation_id = "BROADCAST_ROOM"
+        conversation_id = self._resolve_conversation_id(conversation_id)
         
         # 验证会话权限
-        if self.friend_manager:
-            if not self.friend_manager.can_access_conversation(user_id, conversation_id):
-                return []
-        
-        # 过滤消息
-        filtered_messages = []
-        for message in self.messages:
-            if message["recipient_id"] == conversation_id:
-                filtered_messages.append(message)
+        if not self._can_read(user_id, conversation_id):
+            return []
         
-        return filtered_messages
+        # 从会话索引中直接取出该会话的消息
+        return list(self.message_store.get_conversation(conversation_id))
+    
+    def _resolve_conversation_id(self, conversation_id: str = None) -> str:
+        """
+        未指定会话时使用广播室
+        """
+        if conversation_id is None:
+            if self.friend_manager:
+                return self.friend_manager.get_broadcast_room_id()
+            return "BROADCAST_ROOM"
+        return conversation_id
+    
+    def _can_read(self, user_id: str, conversation_id: str) -> bool:
+        """
+        检查用户是否可以读取会话
+        """
+        if self.friend_manager:
+            return self.friend_manager.can_access_conversation(user_id, conversation_id)
+        return True
     
     def _get_current_time(self) -> str:
         """
@@ -157,12 +188,137 @@ class ChatManager:
         清空指定会话的消息
         """
         try:
-            self.messages = [msg for msg in self.messages if msg["recipient_id"] != conversation_id]
-            return self._save_messages()
+            # 只需丢弃该会话的索引桶，无需重建整个消息列表
+            return self.message_store.clear_conversation(conversation_id)
         except Exception as e:
             print(f"❌ 清空消息失败: {e}")
             return False
     
+    def search_messages(self, keyword: str, conversation_id: str = None, user_id: str = None) -> List[Dict]:
+        """
+        搜索会话中内容包含关键词的消息
+        
+        参数:
+        - keyword: 搜索关键词（不区分大小写）
+        - conversation_id: 会话ID，默认为广播室
+        - user_id: 提供时先检查该用户的会话权限
+        
+        返回:
+        - 按时间顺序的匹配消息列表
+        """
+        if not keyword or not keyword.strip():
+            return []
+        conversation_id = self._resolve_conversation_id(conversation_id)
+        if user_id is not None and not self._can_read(user_id, conversation_id):
+            return []
+        return self.message_store.search(keyword.strip(), conversation_id)
+    
+    def search_messages_ranked(self, keyword: str, conversation_id: str = None, user_id: str = None,
+                               limit: int = 20, cursor: str = None) -> Dict:
+        """
+        按相关度分页搜索会话中的消息（词频 + 时间衰减）
+        
+        参数:
+        - keyword: 搜索关键词，多个词用空格分隔，每个词都必须出现
+        - conversation_id: 会话ID，默认为广播室
+        - user_id: 提供时先检查该用户的会话权限
+        - limit: 每页条数
+        - cursor: 上一页返回的 next_cursor，为空时返回第一页
+        
+        返回:
+        - {"results": [{"message", "score", "highlights"}], "next_cursor": 下一页游标或 None}
+          highlights 为关键词在消息内容中的 [起始, 结束) 字符区间
+        """
+        empty = {"results": [], "next_cursor": None}
+        if not keyword or not keyword.strip():
+            return empty
+        conversation_id = self._resolve_conversation_id(conversation_id)
+        if user_id is not None and not self._can_read(user_id, conversation_id):
+            return empty
+        try:
+            return self.message_store.search_ranked(keyword, conversation_id, limit, cursor)
+        except ValueError as e:
+            print(f"❌ 搜索消息失败: {e}")
+            return empty
+    
+    def search_all_chats(self, user_id: str, keyword: str, limit: int = 20, cursor: str = None) -> Dict:
+        """
+        在用户有权访问的全部会话中按相关度搜索
+        
+        参数:
+        - user_id: 搜索的用户
+        - keyword: 搜索关键词，多个词用空格分隔
+        - limit: 每页条数
+        - cursor: 上一页返回的 next_cursor
+        
+        返回:
+        - 同 search_messages_ranked
+        """
+        empty = {"results": [], "next_cursor": None}
+        if not keyword or not keyword.strip():
+            return empty
+        # 预先算出可访问的会话集合，交给索引在内部过滤
+        if self.friend_manager:
+            accessible = self.friend_manager.get_accessible_conversations(user_id)
+        else:
+            accessible = None
+        try:
+            return self.message_store.search_ranked(keyword, None, limit, cursor, conversation_ids=accessible)
+        except ValueError as e:
+            print(f"❌ 搜索消息失败: {e}")
+            return empty
+    
+    def query_messages(self, user_id: str, sender: str = None, conversation_id: str = None,
+                       start=None, end=None, keywords: List[str] = None, match_all: bool = True,
+                       limit: int = None) -> List[Dict]:
+        """
+        组合条件查询消息，例如 "小明上周在数学群里发了什么"
+        
+        参数:
+        - user_id: 查询的用户，只会查到他有权访问的会话
+        - sender: 发送者
+        - conversation_id: 会话ID，为空时查询用户可访问的全部会话
+        - start / end: 时间范围（含两端），如 "2025-06-01 00:00:00"，也可以是 datetime
+        - keywords: 关键词列表
+        - match_all: True 表示所有关键词都要出现，False 表示出现任意一个即可
+        - limit: 只返回最新的 limit 条
+        
+        返回:
+        - 按时间顺序的匹配消息列表
+        """
+        if conversation_id is not None:
+            if not self._can_read(user_id, conversation_id):
+                return []
+            conversation_ids = {conversation_id}
+        elif self.friend_manager:
+            conversation_ids = self.friend_manager.get_accessible_conversations(user_id)
+        else:
+            conversation_ids = None
+        try:
+            return self.message_store.query(sender, conversation_ids, start, end, keywords, match_all, limit)
+        except ValueError as e:
+            print(f"❌ 查询消息失败: {e}")
+            return []
+    
+    def mark_as_read(self, user_id: str, conversation_id: str = None, seq: int = None) -> bool:
+        """
+        标记用户已读到会话中的 seq（默认为最新消息），用于计算未读数
+        """
+        conversation_id = self._resolve_conversation_id(conversation_id)
+        return self.message_store.mark_read(user_id, conversation_id, seq)
+    
+    def get_conversation_message_count(self, conversation_id: str) -> int:
+        """
+        获取会话的消息总条数（不受分页影响，由消息仓库的序号直接给出）
+        """
+        return self.message_store.count_conversation(conversation_id)
+    
+    def get_user_message_count(self, username: str) -> int:
+        """
+        获取用户发送的消息条数（由消息仓库的发送者索引直接给出）
+        """
+        return self.message_store.count_by_sender(username)
+    
     def get_recent_chats_for_user(self, username: str) -> List[Dict]:
         """
         获取用户参与的最近会话列表
@@ -189,7 +345,8 @@ class ChatManager:
                 "id": broadcast_room_id,
                 "name": broadcast_name,
                 "type": "broadcast",
-                "unread_count": 0
+                "last_message": self.message_store.get_last_message(broadcast_room_id),
+                "unread_count": self.message_store.get_unread_count(username, broadcast_room_id)
             })
             
             # 如果有好友管理器，可以获取更多会话
@@ -203,7 +360,8 @@ class ChatManager:
                         "id": friend_id,
                         "name": friend_name,
                         "type": "personal",
-                        "unread_count": 0
+                        "last_message": self.message_store.get_last_message(friend_id),
+                        "unread_count": self.message_store.get_unread_count(username, friend_id)
                     })
                 
                 # 获取用户加入的群组
@@ -215,10 +373,14 @@ class ChatManager:
                             "id": group_id,
                             "name": all_groups[group_id].get("name", f"群组{group_id}"),
                             "type": "group",
-                            "unread_count": 0
+                            "last_message": self.message_store.get_last_message(group_id),
+                            "unread_count": self.message_store.get_unread_count(username, group_id)
                         })
             
-            return recent_chats
+            # 广播室固定在最前，其余会话按最后活动时间从新到旧排列（只查最后活动表）
+            others = {chat["id"]: chat for chat in recent_chats[1:]}
+            return recent_chats[:1] + [others[chat_id] for chat_id in
+                                       self.message_store.sort_by_last_activity(others)]
         except Exception as e:
             print(f"❌ 获取最近会话失败: {e}")
             # 至少返回广播室作为默认会话
@@ -247,4 +409,44 @@ class ChatManager:
             return messages
         except Exception as e:
             print(f"❌ 获取聊天历史失败: {e}")
-            return []
\ No newline at end of file
+            return []
+    
+    def get_chat_history_page(self, user_id: str, conversation_id: str = None,
+                              before: str = None, limit: int = 50) -> Dict:
+        """
+        分页获取聊天历史，向上翻页时只取出当前这一页
+        
+        参数:
+        - user_id: 用户ID
+        - conversation_id: 会话ID，默认为广播室
+        - before: 上一页返回的 next_cursor，为空时返回最新一页
+        - limit: 每页消息数
+        
+        返回:
+        - {"messages": 按时间顺序的消息列表, "next_cursor": 更早一页的游标，没有更多时为 None}
+        """
+        conversation_id = self._resolve_conversation_id(conversation_id)
+        if not self._can_read(user_id, conversation_id):
+            return {"messages": [], "next_cursor": None}
+        try:
+            return self.message_store.get_page(conversation_id, before, limit)
+        except ValueError as e:
+            print(f"❌ 获取聊天历史失败: {e}")
+            return {"messages": [], "next_cursor": None}
+    
+    def get_messages_since(self, conversation_id: str, seq: int, user_id: str = None) -> List[Dict]:
+        """
+        增量拉取：获取会话中序号大于 seq 的新消息
+        
+        参数:
+        - conversation_id: 会话ID
+        - seq: 客户端已看到的最后一条消息的序号，从头拉取时传 0
+        - user_id: 提供时先检查该用户的会话权限
+        
+        返回:
+        - 按序号递增的新消息列表
+        """
+        conversation_id = self._resolve_conversation_id(conversation_id)
+        if user_id is not None and not self._can_read(user_id, conversation_id):
+            return []
+        return self.message_store.get_messages_since(conversation_id, seq)
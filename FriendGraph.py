@@ -0,0 +1,163 @@
+# FriendGraph.py
+from typing import Dict, List, Set
+from StorageBackend import StorageBackend
+from SharedDocument import SharedDocument
+from GroupStore import GroupStore
+from FriendSuggester import FriendSuggester
+
+class FriendGraph(SharedDocument):
+    """
+    好友关系图
+    好友数据在进程内只有一份（见 shared），FriendManager 和 Friend 都通过它读写，
+    所有修改都在同一把锁下完成并立即保存，不会出现某个过期副本写快照时覆盖其他副本修改的情况
+
+    好友关系在内存中是邻接集合（用户 -> 好友集合），保存时集合写成列表，friends 文档的格式不变；
+    增删好友只保存一条变更（存储后端支持时追加到变更日志），不重写整个好友文档
+
+    与 GroupStore 一样，通过存储后端的文档版本发现其他进程的修改并重新加载（见 SharedDocument）：
+    每次修改前都会检查，读取时最多每 CHECK_INTERVAL 秒检查一次
+
+    "可能认识的人" 推荐器也由这里持有，无论哪个模块修改好友关系或群成员，
+    受影响用户的推荐缓存都会失效
+    """
+
+    DOCUMENT_NAME = "friends"
+    DOCUMENT_LABEL = "好友数据"
+
+    def __init__(self, storage: StorageBackend):
+        """
+        初始化好友图并从存储后端加载
+
+        参数:
+        - storage: 负责持久化的存储后端
+        """
+        super().__init__(storage)
+        # 好友邻接集合：用户 -> 好友集合，重新加载时原地替换，调用方持有的引用仍然有效
+        self.friends: Dict[str, Set[str]] = {}
+        # 好友推荐，群成员变化时让相关用户的推荐缓存失效
+        self.group_store = GroupStore.shared(storage)
+        self.suggester = FriendSuggester(self.friends, self.group_store)
+        self.group_store.subscribe(self._on_group_changed)
+        self._load()
+
+    def _load(self):
+        """
+        从存储后端加载好友关系
+        """
+        try:
+            data = self.storage.load_document("friends")
+        except Exception as e:
+            print(f"❌ 加载好友数据失败: {e}")
+            data = {}
+        graph: Dict[str, Set[str]] = {}
+        if data is None:
+            print("📝 好友数据文件不存在，创建新文件")
+        else:
+            graph = {user: set(friends) for user, friends in data.items()}
+            # 好友关系是双向的，旧数据中单向的关系补齐反向边，与原来的权限判定一致
+            for user, friends in data.items():
+                for friend in friends:
+                    graph.setdefault(friend, set()).add(user)
+            print(f"✅ 加载好友数据，共 {len(graph)} 个用户的好友关系")
+        self.friends.clear()
+        self.friends.update(graph)
+        self.suggester.clear()
+        self._remember_version()
+
+    def _save_friend_edge(self, op: str, user_id: str, friend_id: str) -> bool:
+        """
+        保存一条好友关系的增删（双向两条边）并记录保存后的文档版本
+        """
+        try:
+            saved = self.storage.save_edges("friends", self.friends, [
+                {"op": op, "key": user_id, "value": friend_id},
+                {"op": op, "key": friend_id, "value": user_id}
+            ])
+        except Exception as e:
+            print(f"❌ 保存好友数据失败: {e}")
+            return False
+        if saved:
+            self._remember_version()
+        return saved
+
+    def _on_group_changed(self, event, group_id, user_id):
+        """
+        群组仓库的变化通知
+        在群组仓库的锁内调用，不再获取好友图的锁（推荐时先持有好友图的锁再访问群组仓库，反过来会死锁）
+        """
+        self.suggester.invalidate_group(group_id, user_id)
+
+    def get_friends(self, user_id: str) -> Set[str]:
+        """
+        用户的好友集合（内部集合，调用方不要修改）
+        """
+        self.refresh()
+        return self.friends.get(user_id, set())
+
+    def add_friend(self, user_id: str, friend_id: str) -> (bool, str):
+        """
+        添加好友关系（双向）
+        返回: (成功与否, 提示信息)
+        """
+        if user_id == friend_id:
+            return False, "❌ 不能添加自己为好友"
+
+        with self._lock:
+            self.refresh(force=True)
+            user_friends = self.friends.setdefault(user_id, set())
+            other_friends = self.friends.setdefault(friend_id, set())
+
+            # 检查是否已经是好友
+            if friend_id in user_friends:
+                return False, "❌ 你们已经是好友了"
+
+            # 建立好友关系
+            user_friends.add(friend_id)
+            other_friends.add(user_id)
+
+            # 保存数据
+            if self._save_friend_edge("add", user_id, friend_id):
+                self.suggester.invalidate_friendship(user_id, friend_id)
+                return True, f"✅ 成功添加好友 {friend_id}"
+            else:
+                # 回滚操作
+                user_friends.discard(friend_id)
+                other_friends.discard(user_id)
+                return False, "❌ 添加好友失败，请稍后重试"
+
+    def remove_friend(self, user_id: str, friend_id: str) -> (bool, str):
+        """
+        移除好友关系（双向）
+        返回: (成功与否, 提示信息)
+        """
+        with self._lock:
+            self.refresh(force=True)
+            # 检查用户数据结构
+            if user_id not in self.friends or friend_id not in self.friends:
+                return False, "❌ 好友关系不存在"
+
+            # 检查是否是好友
+            if friend_id not in self.friends[user_id]:
+                return False, "❌ 你们不是好友"
+
+            # 解除好友关系
+            self.friends[user_id].discard(friend_id)
+            self.friends[friend_id].discard(user_id)
+
+            # 保存数据
+            if self._save_friend_edge("remove", user_id, friend_id):
+                self.suggester.invalidate_friendship(user_id, friend_id)
+                return True, f"✅ 已解除与 {friend_id} 的好友关系"
+            else:
+                # 回滚操作
+                self.friends[user_id].add(friend_id)
+                self.friends[friend_id].add(user_id)
+                return False, "❌ 移除好友失败，请稍后重试"
+
+    def suggest(self, user_id: str, limit: int = 10) -> List[Dict]:
+        """
+        推荐可能认识的人，见 FriendSuggester.suggest
+        """
+        with self._lock:
+            self.refresh()
+            return self.suggester.suggest(user_id, limit)
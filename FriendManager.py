@@ -1,105 +1,61 @@
 # FriendManager.py
-import json
-import os
-import uuid
 from pathlib import Path
 from typing import List, Dict, Set
-from datetime import datetime
+from StorageBackend import create_storage_backend
+from GroupStore import GroupStore
+from FriendGraph import FriendGraph
 
 class FriendManager:
     """
     好友和群组管理系统
     管理用户的好友关系、群组创建和成员管理
+
+    好友关系在内存中是邻接集合（用户 -> 好友集合），群成员也是集合，
+    权限检查只需一次集合查找，与用户数量无关；保存时集合写成列表，文件格式不变
+
+    好友关系由共享的 FriendGraph 管理（与 Friend 模块共用同一份），
+    多个好友管理器不会各自保存一份过期的好友图
+
+    群组数据由共享的 GroupStore 管理（与 Group 模块共用同一份），
+    其中维护了用户 -> 所在群组ID 的反向索引，查询一个用户的群组与群组总数无关
+
+    "可能认识的人" 推荐由 FriendSuggester 计算并缓存，好友关系或群成员变化时
+    只让受影响用户的缓存失效
     """
     
-    def __init__(self, data_dir="data"):
+    def __init__(self, data_dir="data", storage=None):
         """
         初始化好友管理器
+        
+        参数:
+        - data_dir: 数据存储目录
+        - storage: 共享的存储后端，默认使用 data_dir 下的JSON文件
         """
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(exist_ok=True)
         
-        # 好友数据文件
-        self.friends_file = self.data_dir / "friends.json"
+        # 存储后端（好友数据存于 friends 文档，群组数据存于 groups 文档）
+        self.storage = storage if storage is not None else create_storage_backend(self.data_dir)
         
-        # 群组数据文件
-        self.groups_file = self.data_dir / "groups.json"
+        # 固定会话ID
+        self.BROADCAST_ROOM_ID = GroupStore.BROADCAST_ROOM_ID
         
-        # 先定义固定会话ID，确保_load_groups_data能访问到
-        self.BROADCAST_ROOM_ID = "BROADCAST_ROOM"
+        # 加载数据；同一份数据的好友关系和群组只加载一份，与 Friend、Group 模块共用
+        self.friend_graph = FriendGraph.shared(self.storage)
+        self.friends_data = self.friend_graph.friends
+        self.group_store = GroupStore.shared(self.storage)
         
-        # 加载数据
-        self.friends_data = self._load_friends_data()
-        self.groups_data = self._load_groups_data()
+        # 好友推荐（由好友图持有，任何模块修改好友关系或群成员都会让相关缓存失效）
+        self.suggester = self.friend_graph.suggester
         
         print("✅ 好友管理系统初始化完成")
     
-    def _load_friends_data(self) -> Dict:
+    @property
+    def groups_data(self) -> Dict[str, Dict]:
         """
-        加载好友关系数据
+        全部群组数据（共享群组仓库中的唯一副本）
         """
-        try:
-            if self.friends_file.exists():
-                with open(self.friends_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    print(f"✅ 加载好友数据，共 {len(data)} 个用户的好友关系")
-                    return data
-            else:
-                print("📝 好友数据文件不存在，创建新文件")
-                return {}
-        except Exception as e:
-            print(f"❌ 加载好友数据失败: {e}")
-            return {}
-    
-    def _load_groups_data(self) -> Dict:
-        """
-        加载群组数据
-        """
-        try:
-            if self.groups_file.exists():
-                with open(self.groups_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    print(f"✅ 加载群组数据，共 {len(data)} 个群组")
-                    return data
-            else:
-                print("📝 群组数据文件不存在，创建新文件")
-                # 创建默认的广播室
-                default_groups = {
-                    self.BROADCAST_ROOM_ID: {
-                        "name": "中考加油广播室",
-                        "creator": "系统",
-                        "members": [],
-                        "created_at": "2024-01-01 00:00:00",
-                        "type": "broadcast"
-                    }
-                }
-                self._save_groups_data(default_groups)
-                return default_groups
-        except Exception as e:
-            print(f"❌ 加载群组数据失败: {e}")
-            return {}
-    
-    def _save_friends_data(self):
-        """保存好友数据"""
-        try:
-            with open(self.friends_file, 'w', encoding='utf-8') as f:
-                json.dump(self.friends_data, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            print(f"❌ 保存好友数据失败: {e}")
-            return False
-    
-    def _save_groups_data(self, data=None):
-        """保存群组数据"""
-        try:
-            if data is None:
-                data = self.groups_data
-            with open(self.groups_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            print(f"❌ 保存群组数据失败: {e}")
-            return False
+        return self.group_store.groups
     
     def get_broadcast_room_id(self) -> str:
         """
@@ -111,144 +67,32 @@ class FriendManager:
         """
         添加好友
         """
-        # 确保用户数据结构存在
-        if user_id not in self.friends_data:
-            self.friends_data[user_id] = []
-        
-        if friend_id not in self.friends_data:
-            self.friends_data[friend_id] = []
-        
-        # 检查是否已经是好友
-        if friend_id in self.friends_data[user_id]:
-            return False, "❌ 你们已经是好友了"
-        
-        # 检查是否是添加自己
-        if user_id == friend_id:
-            return False, "❌ 不能添加自己为好友"
-        
-        # 建立好友关系
-        self.friends_data[user_id].append(friend_id)
-        self.friends_data[friend_id].append(user_id)
-        
-        # 保存数据
-        if self._save_friends_data():
-            return True, f"✅ 成功添加好友 {friend_id}"
-        else:
-            # 回滚操作
-            self.friends_data[user_id].remove(friend_id)
-            self.friends_data[friend_id].remove(user_id)
-            return False, "❌ 添加好友失败，请稍后重试"
+        return self.friend_graph.add_friend(user_id, friend_id)
     
     def remove_friend(self, user_id: str, friend_id: str) -> (bool, str):
         """
         移除好友
         """
-        # 检查用户数据结构
-        if user_id not in self.friends_data or friend_id not in self.friends_data:
-            return False, "❌ 好友关系不存在"
-        
-        # 检查是否是好友
-        if friend_id not in self.friends_data[user_id]:
-            return False, "❌ 你们不是好友"
-        
-        # 解除好友关系
-        self.friends_data[user_id].remove(friend_id)
-        self.friends_data[friend_id].remove(user_id)
-        
-        # 保存数据
-        if self._save_friends_data():
-            return True, f"✅ 已解除与 {friend_id} 的好友关系"
-        else:
-            # 回滚操作
-            self.friends_data[user_id].append(friend_id)
-            self.friends_data[friend_id].append(user_id)
-            return False, "❌ 移除好友失败，请稍后重试"
+        return self.friend_graph.remove_friend(user_id, friend_id)
     
     def create_group(self, creator_id: str, group_name: str) -> (bool, str, str):
         """
         创建群组
         返回: (成功与否, 提示信息, 群组ID)
         """
-        if not group_name or len(group_name.strip()) == 0:
-            return False, "❌ 群组名称不能为空", ""
-        
-        # 生成群组ID
-        group_id = str(uuid.uuid4())
-        
-        # 创建群组
-        self.groups_data[group_id] = {
-            "name": group_name.strip(),
-            "creator": creator_id,
-            "members": [creator_id],
-            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "type": "group"
-        }
-        
-        # 保存数据
-        if self._save_groups_data():
-            return True, f"✅ 群组 '{group_name}' 创建成功", group_id
-        else:
-            # 回滚操作
-            del self.groups_data[group_id]
-            return False, "❌ 创建群组失败，请稍后重试", ""
+        return self.group_store.create_group(creator_id, group_name)
     
     def add_group_member(self, group_id: str, user_id: str, admin_id: str) -> (bool, str):
         """
         添加群组成员
         """
-        # 检查群组是否存在
-        if group_id not in self.groups_data:
-            return False, "❌ 群组不存在"
-        
-        # 检查管理员权限
-        if self.groups_data[group_id]["creator"] != admin_id:
-            return False, "❌ 只有群主才能添加成员"
-        
-        # 检查用户是否已经在群里
-        if user_id in self.groups_data[group_id]["members"]:
-            return False, "❌ 用户已经在群组中"
-        
-        # 添加成员
-        self.groups_data[group_id]["members"].append(user_id)
-        
-        # 保存数据
-        if self._save_groups_data():
-            return True, f"✅ 用户 {user_id} 已成功加入群组"
-        else:
-            # 回滚操作
-            self.groups_data[group_id]["members"].remove(user_id)
-            return False, "❌ 添加成员失败，请稍后重试"
+        return self.group_store.add_member(group_id, user_id, admin_id)
     
     def remove_group_member(self, group_id: str, user_id: str, admin_id: str) -> (bool, str):
         """
         移除群组成员
         """
-        # 检查群组是否存在
-        if group_id not in self.groups_data:
-            return False, "❌ 群组不存在"
-        
-        # 检查管理员权限
-        if self.groups_data[group_id]["creator"] != admin_id:
-            return False, "❌ 只有群主才能移除成员"
-        
-        # 检查用户是否在群里
-        if user_id not in self.groups_data[group_id]["members"]:
-            return False, "❌ 用户不在群组中"
-        
-        # 群主不能移除自己
-        if user_id == admin_id:
-            return False, "❌ 群主不能移除自己，如需解散群组请使用解散功能"
-        
-        # 移除成员
-        self.groups_data[group_id]["members"].remove(user_id)
-        
-        # 保存数据
-        if self._save_groups_data():
-            return True, f"✅ 用户 {user_id} 已被移除出群组"
-        else:
-            # 回滚操作
-            self.groups_data[group_id]["members"].append(user_id)
-            return False, "❌ 移除成员失败，请稍后重试"
+        return self.group_store.remove_member(group_id, user_id, admin_id)
     
     def can_access_conversation(self, user_id: str, conversation_id: str) -> bool:
         """
@@ -258,36 +102,48 @@ class FriendManager:
         if conversation_id == self.BROADCAST_ROOM_ID:
             return True
         
-        # 检查是否是好友对话
-        for user, friends in self.friends_data.items():
-            if user == user_id and conversation_id in friends:
-                return True
-            if user == conversation_id and user_id in friends:
-                return True
+        # 检查是否是好友对话（好友关系是双向的，查自己的好友集合即可）
+        self.friend_graph.refresh()
+        if conversation_id in self.friends_data.get(user_id, ()):
+            return True
         
         # 检查是否是群组成员
-        if conversation_id in self.groups_data:
-            return user_id in self.groups_data[conversation_id]["members"]
-        
-        return False
+        return bool(self.group_store.is_member(conversation_id, user_id))
+    
+    def get_accessible_conversations(self, user_id: str) -> Set[str]:
+        """
+        获取用户可以访问的全部会话ID，与 can_access_conversation 的规则一致
+        用于一次性限定搜索范围，而不是逐条检查
+        """
+        accessible = {self.BROADCAST_ROOM_ID}
+        # 自己的好友对话（好友关系是双向的）
+        accessible.update(self.friend_graph.get_friends(user_id))
+        # 所在的群组（查反向索引）
+        accessible.update(self.group_store.get_group_ids(user_id))
+        return accessible
     
     def get_user_friends(self, user_id: str) -> List[str]:
         """
         获取用户的所有好友
         """
-        if user_id not in self.friends_data:
+        return sorted(self.friend_graph.get_friends(user_id))
+    
+    def suggest_friends(self, user_id: str, limit: int = 10) -> List[Dict]:
+        """
+        推荐可能认识的人：好友的好友以及同群组的同学，按共同好友数和共同群组数排序
+        返回: [{"user", "mutual_friends", "shared_groups", "score"}, ...]
+        """
+        try:
+            return self.friend_graph.suggest(user_id, limit)
+        except Exception as e:
+            print(f"❌ 获取好友推荐失败: {e}")
             return []
-        return self.friends_data[user_id]
     
     def get_user_groups(self, user_id: str) -> Dict[str, Dict]:
         """
         获取用户加入的所有群组
         """
-        user_groups = {}
-        for group_id, group_info in self.groups_data.items():
-            if group_id != self.BROADCAST_ROOM_ID and user_id in group_info["members"]:
-                user_groups[group_id] = group_info
-        return user_groups
+        return self.group_store.get_user_groups(user_id)
     
     def get_conversation_name(self, conversation_id: str) -> str:
         """
@@ -298,8 +154,9 @@ class FriendManager:
             return "中考加油广播室"
         
         # 检查是否是群组
-        if conversation_id in self.groups_data:
-            return self.groups_data[conversation_id]["name"]
+        group_info = self.group_store.get(conversation_id)
+        if group_info is not None:
+            return group_info["name"]
         
         # 默认为用户ID
         return conversation_id
@@ -310,6 +167,7 @@ class FriendManager:
         返回: 所有群组的完整数据
         """
         try:
+            self.group_store.refresh()
             print(f"✅ 获取所有群组，共 {len(self.groups_data)} 个群组")
             return self.groups_data
         except Exception as e:
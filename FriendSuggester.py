@@ -0,0 +1,152 @@
+# FriendSuggester.py
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Set, Iterable, Optional
+
+class FriendSuggester:
+    """
+    "可能认识的人" 推荐
+    从用户出发在好友图上做有界的广度优先搜索：好友的好友是候选人，
+    同一个群组的同学也是候选人；按共同好友数和共同群组数打分排序
+
+    每个用户的推荐结果会缓存，好友关系或群成员变化时只让受影响用户的缓存失效：
+    好友关系 (a, b) 变化影响 a、b 以及他们的好友，群成员变化影响该群的全部成员
+
+    缓存由自己的锁保护，群组仓库的通知可能在其他线程里让缓存失效；
+    计算期间发生过失效时，算出的结果只返回、不写入缓存
+    """
+
+    # 每增加一个共同群组加的分数（一个共同好友计 1 分）
+    GROUP_WEIGHT = 0.5
+    # 一次推荐最多检查的好友关系和群成员条数，超大的好友列表或群组不会拖慢推荐
+    MAX_SCANNED = 20000
+    # 每个用户缓存的推荐条数，以及最多缓存多少个用户的结果
+    MAX_SUGGESTIONS = 50
+    CACHE_SIZE = 1024
+
+    def __init__(self, friends_data: Dict[str, Set[str]], group_store=None):
+        """
+        初始化推荐器
+
+        参数:
+        - friends_data: 好友邻接集合（用户 -> 好友集合），推荐器直接读取，不复制
+        - group_store: 共享的群组仓库，为空时只按共同好友推荐
+        """
+        self.friends_data = friends_data
+        self.group_store = group_store
+        # 推荐缓存：用户 -> 排好序的推荐列表，最久未使用的先淘汰
+        self._cache: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        # 每次失效加一，用来发现计算期间发生的失效
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def suggest(self, user_id: str, limit: int = 10) -> List[Dict]:
+        """
+        为用户推荐可能认识的人
+
+        返回:
+        - 按分数从高到低排列的列表，每项为
+          {"user": 用户名, "mutual_friends": 共同好友数, "shared_groups": 共同群组数, "score": 分数}
+        """
+        with self._lock:
+            suggestions = self._cache.get(user_id)
+            if suggestions is not None:
+                self._cache.move_to_end(user_id)
+            generation = self._generation
+        if suggestions is None:
+            suggestions = self._compute(user_id)
+            with self._lock:
+                if generation == self._generation:
+                    self._cache[user_id] = suggestions
+                    if len(self._cache) > self.CACHE_SIZE:
+                        self._cache.popitem(last=False)
+        return [dict(item) for item in suggestions[:limit]]
+
+    def _compute(self, user_id: str) -> List[Dict]:
+        """
+        有界广度优先搜索：第一层是用户的好友，第二层是好友的好友；
+        再加上用户所在群组的其他成员。检查的边数超过 MAX_SCANNED 时提前停止
+        """
+        friends = self.friends_data.get(user_id, set())
+        mutual: Dict[str, int] = {}
+        shared: Dict[str, int] = {}
+        budget = self.MAX_SCANNED
+
+        # 好友的好友：每经过一个好友，候选人的共同好友数加一
+        for friend in sorted(friends):
+            for candidate in self.friends_data.get(friend, ()):
+                budget -= 1
+                if candidate != user_id and candidate not in friends:
+                    mutual[candidate] = mutual.get(candidate, 0) + 1
+                if budget <= 0:
+                    break
+            if budget <= 0:
+                break
+
+        # 同群组的同学：每个共同群组加一
+        if self.group_store is not None and budget > 0:
+            for group_id in sorted(self.group_store.get_group_ids(user_id)):
+                group_info = self.group_store.groups.get(group_id)
+                if group_info is None:
+                    continue
+                for candidate in group_info["members"]:
+                    budget -= 1
+                    if candidate != user_id and candidate not in friends:
+                        shared[candidate] = shared.get(candidate, 0) + 1
+                    if budget <= 0:
+                        break
+                if budget <= 0:
+                    break
+
+        suggestions = []
+        for candidate in mutual.keys() | shared.keys():
+            mutual_count = mutual.get(candidate, 0)
+            shared_count = shared.get(candidate, 0)
+            suggestions.append({
+                "user": candidate,
+                "mutual_friends": mutual_count,
+                "shared_groups": shared_count,
+                "score": mutual_count + self.GROUP_WEIGHT * shared_count
+            })
+        suggestions.sort(key=lambda item: (-item["score"], -item["mutual_friends"], item["user"]))
+        return suggestions[:self.MAX_SUGGESTIONS]
+
+    def invalidate_users(self, users: Iterable[str]):
+        """
+        让指定用户的推荐缓存失效
+        """
+        with self._lock:
+            self._generation += 1
+            for user in users:
+                self._cache.pop(user, None)
+
+    def invalidate_friendship(self, user_id: str, friend_id: str):
+        """
+        好友关系 (user_id, friend_id) 变化后调用：
+        两人自己的推荐变了，两人的好友的共同好友数也可能变了
+        """
+        self.invalidate_users((user_id, friend_id))
+        self.invalidate_users(self.friends_data.get(user_id, ()))
+        self.invalidate_users(self.friends_data.get(friend_id, ()))
+
+    def invalidate_group(self, group_id: Optional[str], user_id: Optional[str] = None):
+        """
+        群成员变化后调用：该成员和群里其他成员的共同群组数变了
+        group_id 为空表示群组数据整体重新加载，清空全部缓存
+        """
+        if group_id is None or self.group_store is None:
+            self.clear()
+            return
+        if user_id is not None:
+            self.invalidate_users((user_id,))
+        group_info = self.group_store.groups.get(group_id)
+        if group_info is not None:
+            self.invalidate_users(group_info["members"])
+
+    def clear(self):
+        """
+        清空全部推荐缓存
+        """
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
@@ -1,25 +1,27 @@
 # Group.py
-import json
-import os
-import uuid
 from pathlib import Path
-from datetime import datetime
-from typing import List, Dict, Set
+from typing import Dict
+from StorageBackend import create_storage_backend
+from GroupStore import GroupStore
 
 class Group:
     """
     群组功能模块
     处理群组创建、成员管理和群组聊天功能
     支持模块化系统和独立运行模式
+
+    群组数据由共享的 GroupStore 管理，与 FriendManager 共用同一份内存数据和同一个写入者；
+    其中维护了用户 -> 所在群组ID 的反向索引，查询用户的群组时不需要遍历全部群组
     """
     
-    def __init__(self, main_manager=None, data_dir="data"):
+    def __init__(self, main_manager=None, data_dir="data", storage=None):
         """
         初始化群组模块
         
         Args:
             main_manager: 主管理器实例，用于模块化系统
             data_dir: 数据存储目录
+            storage: 存储后端，模块化系统中默认使用主管理器的共享后端
         """
         self.main_manager = main_manager
         
@@ -32,164 +34,58 @@ class Group:
         # 确保数据目录存在
         self.data_dir.mkdir(exist_ok=True)
         
-        # 群组数据文件
-        self.groups_file = self.data_dir / "groups.json"
-        
-        # 加载数据
-        self.groups_data = self._load_groups_data()
+        # 存储后端
+        if storage is None and main_manager is not None:
+            storage = getattr(main_manager, 'storage', None)
+        self.storage = storage if storage is not None else create_storage_backend(self.data_dir)
         
         # 固定会话ID
-        self.BROADCAST_ROOM_ID = "BROADCAST_ROOM"
+        self.BROADCAST_ROOM_ID = GroupStore.BROADCAST_ROOM_ID
+        
+        # 加载数据；同一存储后端的群组数据只加载一份，与 FriendManager 共用
+        self.group_store = GroupStore.shared(self.storage)
         
         print("✅ 群组管理系统初始化完成")
     
-    def _load_groups_data(self) -> Dict:
-        """
-        加载群组数据
-        """
-        try:
-            if self.groups_file.exists():
-                with open(self.groups_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    print(f"✅ 加载群组数据，共 {len(data)} 个群组")
-                    return data
-            else:
-                print("📝 群组数据文件不存在，创建新文件")
-                # 创建默认的广播室
-                default_groups = {
-                    self.BROADCAST_ROOM_ID: {
-                        "name": "中考加油广播室",
-                        "creator": "系统",
-                        "members": [],
-                        "created_at": "2024-01-01 00:00:00",
-                        "type": "broadcast"
-                    }
-                }
-                self._save_groups_data(default_groups)
-                return default_groups
-        except Exception as e:
-            print(f"❌ 加载群组数据失败: {e}")
-            return {}
-    
-    def _save_groups_data(self, data=None):
+    @property
+    def groups_data(self) -> Dict[str, Dict]:
         """
-        保存群组数据
+        全部群组数据（共享群组仓库中的唯一副本）
         """
-        try:
-            if data is None:
-                data = self.groups_data
-            with open(self.groups_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            print(f"❌ 保存群组数据失败: {e}")
-            return False
+        return self.group_store.groups
     
     def create_group(self, creator_id, group_name):
         """
         创建群组
         返回: (成功与否, 提示信息, 群组ID)
         """
-        if not group_name or len(group_name.strip()) == 0:
-            return False, "❌ 群组名称不能为空", ""
-        
-        # 生成群组ID
-        group_id = str(uuid.uuid4())
-        
-        # 创建群组
-        self.groups_data[group_id] = {
-            "name": group_name.strip(),
-            "creator": creator_id,
-            "members": [creator_id],
-            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "type": "group"
-        }
-        
-        # 保存数据
-        if self._save_groups_data():
-            return True, f"✅ 群组 '{group_name}' 创建成功", group_id
-        else:
-            # 回滚操作
-            del self.groups_data[group_id]
-            return False, "❌ 创建群组失败，请稍后重试", ""
+        return self.group_store.create_group(creator_id, group_name)
     
     def add_group_member(self, group_id, user_id, admin_id):
         """
         添加群组成员
         返回: (成功与否, 提示信息)
         """
-        # 检查群组是否存在
-        if group_id not in self.groups_data:
-            return False, "❌ 群组不存在"
-        
-        # 检查管理员权限
-        if self.groups_data[group_id]["creator"] != admin_id:
-            return False, "❌ 只有群主才能添加成员"
-        
-        # 检查用户是否已经在群里
-        if user_id in self.groups_data[group_id]["members"]:
-            return False, "❌ 用户已经在群组中"
-        
-        # 添加成员
-        self.groups_data[group_id]["members"].append(user_id)
-        
-        # 保存数据
-        if self._save_groups_data():
-            return True, f"✅ 用户 {user_id} 已成功加入群组"
-        else:
-            # 回滚操作
-            self.groups_data[group_id]["members"].remove(user_id)
-            return False, "❌ 添加成员失败，请稍后重试"
+        return self.group_store.add_member(group_id, user_id, admin_id)
     
     def remove_group_member(self, group_id, user_id, admin_id):
         """
         移除群组成员
         返回: (成功与否, 提示信息)
         """
-        # 检查群组是否存在
-        if group_id not in self.groups_data:
-            return False, "❌ 群组不存在"
-        
-        # 检查管理员权限
-        if self.groups_data[group_id]["creator"] != admin_id:
-            return False, "❌ 只有群主才能移除成员"
-        
-        # 检查用户是否在群里
-        if user_id not in self.groups_data[group_id]["members"]:
-            return False, "❌ 用户不在群组中"
-        
-        # 群主不能移除自己
-        if user_id == admin_id:
-            return False, "❌ 群主不能移除自己，如需解散群组请使用解散功能"
-        
-        # 移除成员
-        self.groups_data[group_id]["members"].remove(user_id)
-        
-        # 保存数据
-        if self._save_groups_data():
-            return True, f"✅ 用户 {user_id} 已被移除出群组"
-        else:
-            # 回滚操作
-            self.groups_data[group_id]["members"].append(user_id)
-            return False, "❌ 移除成员失败，请稍后重试"
+        return self.group_store.remove_member(group_id, user_id, admin_id)
     
     def get_user_groups(self, user_id):
         """
         获取用户加入的所有群组
         """
-        user_groups = {}
-        for group_id, group_info in self.groups_data.items():
-            if group_id != self.BROADCAST_ROOM_ID and user_id in group_info["members"]:
-                user_groups[group_id] = group_info
-        return user_groups
+        return self.group_store.get_user_groups(user_id)
     
     def get_group_info(self, group_id):
         """
         获取群组信息
         """
-        if group_id in self.groups_data:
-            return self.groups_data[group_id]
-        return None
+        return self.group_store.get(group_id)
     
     def get_broadcast_room_id(self):
         """
@@ -206,8 +102,9 @@ class Group:
             return True
         
         # 检查是否是群组成员
-        if conversation_id in self.groups_data:
-            return user_id in self.groups_data[conversation_id]["members"]
+        is_member = self.group_store.is_member(conversation_id, user_id)
+        if is_member is not None:
+            return is_member
         
         # 如果在模块化系统中，还需要检查好友关系
         if self.main_manager:
@@ -231,8 +128,9 @@ class Group:
             return "中考加油广播室"
         
         # 检查是否是群组
-        if conversation_id in self.groups_data:
-            return self.groups_data[conversation_id]["name"]
+        group_info = self.group_store.get(conversation_id)
+        if group_info is not None:
+            return group_info["name"]
         
         # 如果在模块化系统中，尝试通过好友管理器获取用户名称
         if self.main_manager:
@@ -0,0 +1,301 @@
+# GroupStore.py
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Callable
+from StorageBackend import StorageBackend
+from SharedDocument import SharedDocument
+
+class GroupStore(SharedDocument):
+    """
+    群组仓库
+    群组数据在进程内只有一份（见 shared），FriendManager 和 Group 都通过它读写，
+    所有修改都在同一把锁下完成并立即保存，不会出现两个副本互相覆盖的情况
+
+    成员在内存中是集合，并维护 用户 -> 所在群组ID 的反向索引；
+    保存时集合写成列表，groups 文档的格式不变
+
+    增删成员只保存一条成员变更（存储后端支持时追加到变更日志），不重写整个群组文档
+
+    多进程共用同一份数据时，通过存储后端的文档版本发现其他进程的修改并重新加载
+    （见 SharedDocument）：每次修改前都会检查，读取时最多每 CHECK_INTERVAL 秒检查一次
+
+    成员变化时通知订阅者（例如好友推荐的缓存失效）
+    """
+
+    DOCUMENT_NAME = "groups"
+    DOCUMENT_LABEL = "群组数据"
+
+    BROADCAST_ROOM_ID = "BROADCAST_ROOM"
+
+    def __init__(self, storage: StorageBackend):
+        """
+        初始化群组仓库并从存储后端加载
+
+        参数:
+        - storage: 负责持久化的存储后端
+        """
+        super().__init__(storage)
+        # 群组数据：群组ID -> 群组信息（members 为集合）
+        self.groups: Dict[str, Dict] = {}
+        # 反向成员索引：用户 -> 所在群组ID集合（不含广播室）
+        self.user_groups_index: Dict[str, Set[str]] = {}
+        # 变化订阅者：callback(event, group_id, user_id)
+        self._subscribers: List[Callable] = []
+        self._load()
+
+    def _load(self):
+        """
+        从存储后端加载群组数据，首次运行时创建默认的广播室
+        """
+        try:
+            data = self.storage.load_document("groups")
+        except Exception as e:
+            print(f"❌ 加载群组数据失败: {e}")
+            data = {}
+        if data is None:
+            print("📝 群组数据文件不存在，创建新文件")
+            data = {
+                self.BROADCAST_ROOM_ID: {
+                    "name": "中考加油广播室",
+                    "creator": "系统",
+                    "members": [],
+                    "created_at": "2024-01-01 00:00:00",
+                    "type": "broadcast"
+                }
+            }
+            self.groups = data
+            self._save()
+        else:
+            print(f"✅ 加载群组数据，共 {len(data)} 个群组")
+        for group_info in data.values():
+            group_info["members"] = set(group_info.get("members", []))
+        self.groups = data
+        self.user_groups_index = self._build_user_groups_index()
+        self._remember_version()
+
+    def _build_user_groups_index(self) -> Dict[str, Set[str]]:
+        """
+        根据群组数据建立 用户 -> 群组ID 的反向索引
+        """
+        index: Dict[str, Set[str]] = {}
+        for group_id, group_info in self.groups.items():
+            if group_id == self.BROADCAST_ROOM_ID:
+                continue
+            for member in group_info["members"]:
+                index.setdefault(member, set()).add(group_id)
+        return index
+
+    def _index_member(self, user_id: str, group_id: str):
+        """
+        在反向索引中记录用户加入了群组
+        """
+        self.user_groups_index.setdefault(user_id, set()).add(group_id)
+
+    def _unindex_member(self, user_id: str, group_id: str):
+        """
+        从反向索引中移除用户与群组的对应关系
+        """
+        group_ids = self.user_groups_index.get(user_id)
+        if group_ids is not None:
+            group_ids.discard(group_id)
+            if not group_ids:
+                del self.user_groups_index[user_id]
+
+    def _reloaded(self):
+        """
+        被其他进程修改后重新加载，通知订阅者
+        """
+        self._notify("reload", None, None)
+
+    def subscribe(self, callback: Callable) -> None:
+        """
+        订阅群组变化，callback(event, group_id, user_id) 在变化保存后调用
+        event 为 "create"、"add_member"、"remove_member"，
+        或 "reload"（数据被其他进程修改后重新加载，group_id 和 user_id 为 None）
+        回调在仓库的锁内执行，应尽快返回
+        """
+        with self._lock:
+            if callback not in self._subscribers:
+                self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable) -> None:
+        """
+        取消订阅，未订阅时忽略
+        """
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _notify(self, event: str, group_id: Optional[str], user_id: Optional[str]) -> None:
+        """
+        通知全部订阅者，单个订阅者出错不影响其他订阅者
+        """
+        for callback in list(self._subscribers):
+            try:
+                callback(event, group_id, user_id)
+            except Exception as e:
+                print(f"❌ 群组变化通知失败: {e}")
+
+    def _save(self, changed_groups=None) -> bool:
+        """
+        保存群组数据并记录保存后的文档版本，提供changed_groups时只写入这些群组
+        """
+        try:
+            if changed_groups is None:
+                saved = self.storage.save_document("groups", self.groups)
+            else:
+                saved = self.storage.save_entries("groups", self.groups, changed_groups)
+        except Exception as e:
+            print(f"❌ 保存群组数据失败: {e}")
+            return False
+        if saved:
+            self._remember_version()
+        return saved
+
+    def _save_member_edge(self, op: str, group_id: str, user_id: str) -> bool:
+        """
+        保存一条成员增删并记录保存后的文档版本
+        """
+        try:
+            saved = self.storage.save_edges("groups", self.groups, [
+                {"op": op, "key": group_id, "field": "members", "value": user_id}
+            ])
+        except Exception as e:
+            print(f"❌ 保存群组数据失败: {e}")
+            return False
+        if saved:
+            self._remember_version()
+        return saved
+
+    def get(self, group_id: str) -> Optional[Dict]:
+        """
+        获取群组信息，不存在时返回 None
+        """
+        self.refresh()
+        return self.groups.get(group_id)
+
+    def is_member(self, group_id: str, user_id: str) -> Optional[bool]:
+        """
+        检查用户是否是群组成员，群组不存在时返回 None
+        """
+        self.refresh()
+        group_info = self.groups.get(group_id)
+        if group_info is None:
+            return None
+        return user_id in group_info["members"]
+
+    def get_group_ids(self, user_id: str) -> Set[str]:
+        """
+        用户所在的全部群组ID（不含广播室），只查反向索引
+        """
+        self.refresh()
+        return self.user_groups_index.get(user_id, set())
+
+    def get_user_groups(self, user_id: str) -> Dict[str, Dict]:
+        """
+        获取用户加入的所有群组，按创建时间排列
+        """
+        with self._lock:
+            group_ids = sorted(self.get_group_ids(user_id),
+                               key=lambda group_id: self.groups[group_id].get("created_at", ""))
+            return {group_id: self.groups[group_id] for group_id in group_ids}
+
+    def create_group(self, creator_id: str, group_name: str) -> (bool, str, str):
+        """
+        创建群组
+        返回: (成功与否, 提示信息, 群组ID)
+        """
+        if not group_name or len(group_name.strip()) == 0:
+            return False, "❌ 群组名称不能为空", ""
+
+        with self._lock:
+            self.refresh(force=True)
+            # 生成群组ID
+            group_id = str(uuid.uuid4())
+
+            # 创建群组
+            self.groups[group_id] = {
+                "name": group_name.strip(),
+                "creator": creator_id,
+                "members": {creator_id},
+                "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "type": "group"
+            }
+
+            # 保存数据
+            if self._save(changed_groups=[group_id]):
+                self._index_member(creator_id, group_id)
+                self._notify("create", group_id, creator_id)
+                return True, f"✅ 群组 '{group_name}' 创建成功", group_id
+            else:
+                # 回滚操作
+                del self.groups[group_id]
+                return False, "❌ 创建群组失败，请稍后重试", ""
+
+    def add_member(self, group_id: str, user_id: str, admin_id: str) -> (bool, str):
+        """
+        添加群组成员
+        返回: (成功与否, 提示信息)
+        """
+        with self._lock:
+            self.refresh(force=True)
+            # 检查群组是否存在
+            if group_id not in self.groups:
+                return False, "❌ 群组不存在"
+
+            # 检查管理员权限
+            if self.groups[group_id]["creator"] != admin_id:
+                return False, "❌ 只有群主才能添加成员"
+
+            # 检查用户是否已经在群里
+            if user_id in self.groups[group_id]["members"]:
+                return False, "❌ 用户已经在群组中"
+
+            # 添加成员
+            self.groups[group_id]["members"].add(user_id)
+
+            # 保存数据
+            if self._save_member_edge("add", group_id, user_id):
+                self._index_member(user_id, group_id)
+                self._notify("add_member", group_id, user_id)
+                return True, f"✅ 用户 {user_id} 已成功加入群组"
+            else:
+                # 回滚操作
+                self.groups[group_id]["members"].discard(user_id)
+                return False, "❌ 添加成员失败，请稍后重试"
+
+    def remove_member(self, group_id: str, user_id: str, admin_id: str) -> (bool, str):
+        """
+        移除群组成员
+        返回: (成功与否, 提示信息)
+        """
+        with self._lock:
+            self.refresh(force=True)
+            # 检查群组是否存在
+            if group_id not in self.groups:
+                return False, "❌ 群组不存在"
+
+            # 检查管理员权限
+            if self.groups[group_id]["creator"] != admin_id:
+                return False, "❌ 只有群主才能移除成员"
+
+            # 检查用户是否在群里
+            if user_id not in self.groups[group_id]["members"]:
+                return False, "❌ 用户不在群组中"
+
+            # 群主不能移除自己
+            if user_id == admin_id:
+                return False, "❌ 群主不能移除自己，如需解散群组请使用解散功能"
+
+            # 移除成员
+            self.groups[group_id]["members"].discard(user_id)
+
+            # 保存数据
+            if self._save_member_edge("remove", group_id, user_id):
+                self._unindex_member(user_id, group_id)
+                self._notify("remove_member", group_id, user_id)
+                return True, f"✅ 用户 {user_id} 已被移除出群组"
+            else:
+                # 回滚操作
+                self.groups[group_id]["members"].add(user_id)
+                return False, "❌ 移除成员失败，请稍后重试"
@@ -13,6 +13,7 @@ from friend import Friend
 from Group import Group
 from countdown import Countdown
 from encouragement import Encouragement
+from StorageBackend import create_storage_backend
 
 class MainManager:
     """
@@ -20,15 +21,26 @@ class MainManager:
     作为整个应用的中央协调器，管理所有功能模块
     """
     
-    def __init__(self, data_dir="data"):
+    def __init__(self, data_dir="data", storage_mode="json", write_behind=None, history_tail=None):
         """
         初始化主管理器
+        
+        参数:
+        - data_dir: 数据存储目录
+        - storage_mode: 存储模式，"json"（默认）、"jsonl"、"segmented" 或 "sqlite"
+        - write_behind: 消息延迟批量写入配置，见 create_storage_backend
+        - history_tail: 启动时每个会话只加载最新的这么多条消息（segmented/sqlite 模式），
+          为空时加载全部历史
         """
         self.data_dir = data_dir
+        self.history_tail = history_tail
         
         # 确保数据目录存在
         self._ensure_data_dir()
         
+        # 所有管理器共享同一个存储后端
+        self.storage = create_storage_backend(self.data_dir, storage_mode, write_behind)
+        
         # 初始化各个管理器
         self.init_managers()
         
@@ -51,9 +63,10 @@ class MainManager:
         初始化所有功能管理器
         """
         # 核心管理器
-        self.user_manager = UserManager(self.data_dir)
-        self.chat_manager = ChatManager(self.data_dir)
-        self.friend_manager = FriendManager(self.data_dir)
+        self.user_manager = UserManager(self.data_dir, storage=self.storage)
+        self.chat_manager = ChatManager(self.data_dir, storage=self.storage,
+                                        history_tail=self.history_tail)
+        self.friend_manager = FriendManager(self.data_dir, storage=self.storage)
         self.gui_manager = GUIManager()
         
         # 初始化所有功能模块，确保顺序正确
@@ -138,6 +151,13 @@ class MainManager:
         关闭应用程序
         """
         print("👋 感谢使用中考加油聊天室，再见！")
+        # 写入尚未保存的已读状态和发送者计数，再关闭存储后端，确保延迟写入的消息全部落盘
+        try:
+            if getattr(self, 'chat_manager', None) is not None:
+                self.chat_manager.message_store.save_deferred_state()
+            self.storage.close()
+        except Exception as e:
+            print(f"❌ 关闭存储后端时出错: {e}")
         sys.exit(0)
 
 # 启动应用的快捷方式
@@ -0,0 +1,196 @@
+# MessageLog.py
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import List, Dict, Callable
+
+class MessageLog:
+    """
+    追加式消息日志（JSON Lines 格式）
+    每条消息占一行，发送消息时只在文件末尾追加一行，
+    不再随历史记录增长而重写整个文件
+
+    写到一半退出会在末尾留下不完整的一行，读取时会跳过它；
+    第一次追加前先截掉这段残行，新写入的行不会接在残行后面一起损坏
+    """
+
+    def __init__(self, log_file):
+        """
+        初始化消息日志
+
+        参数:
+        - log_file: 日志文件路径（通常为 data/messages.jsonl）
+        """
+        self.log_file = Path(log_file)
+        # 是否已经检查过文件末尾的残行
+        self._tail_checked = False
+
+    def exists(self) -> bool:
+        """
+        检查日志文件是否已经存在
+        """
+        return self.log_file.exists()
+
+    def migrate_from_json(self, legacy_file) -> int:
+        """
+        从旧版 messages.json 一次性迁移到日志文件
+        日志文件已存在时视为已迁移，不会重复执行
+
+        返回:
+        - 迁移的消息数量
+        """
+        legacy_file = Path(legacy_file)
+        if self.exists() or not legacy_file.exists():
+            return 0
+
+        try:
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                messages = json.load(f)
+        except Exception as e:
+            print(f"❌ 读取旧版聊天记录失败，跳过迁移: {e}")
+            return 0
+
+        if not self.rewrite(messages):
+            return 0
+        print(f"✅ 已将 {len(messages)} 条历史消息迁移到 {self.log_file.name}")
+        return len(messages)
+
+    def load(self) -> List[Dict]:
+        """
+        重放日志，按写入顺序返回全部消息
+        最后一行如果因为异常退出而不完整，会被忽略
+        """
+        messages = []
+        if not self.exists():
+            return messages
+
+        with open(self.log_file, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    messages.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"⚠️ 跳过损坏的日志行: 第 {line_number} 行")
+        return messages
+
+    def append(self, message: Dict, fsync: bool = False) -> bool:
+        """
+        追加一条消息到日志末尾
+        """
+        return self.append_many([message], fsync)
+
+    def append_many(self, messages: List[Dict], fsync: bool = False) -> bool:
+        """
+        一次性追加多条消息（批量提交时使用）
+
+        参数:
+        - messages: 要追加的消息
+        - fsync: 写入后是否强制刷盘
+        """
+        try:
+            lines = "".join(json.dumps(message, ensure_ascii=False) + "\n" for message in messages)
+            if not self._tail_checked:
+                self._truncate_partial_line()
+                self._tail_checked = True
+            with open(self.log_file, 'a', encoding='utf-8') as f:
+                f.write(lines)
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            return True
+        except Exception as e:
+            # 这次写入可能也只写了一部分，下次追加前重新检查
+            self._tail_checked = False
+            print(f"❌ 追加聊天记录时出错: {e}")
+            return False
+
+    def _truncate_partial_line(self):
+        """
+        文件不以换行结尾时（上次写入中断），截掉最后一个换行之后的残行
+        """
+        try:
+            size = self.log_file.stat().st_size
+        except FileNotFoundError:
+            return
+        if size == 0:
+            return
+        with open(self.log_file, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == b"\n":
+                return
+            # 从末尾向前分块查找最后一个换行
+            position = size
+            while position > 0:
+                step = min(4096, position)
+                position -= step
+                f.seek(position)
+                newline = f.read(step).rfind(b"\n")
+                if newline >= 0:
+                    f.truncate(position + newline + 1)
+                    break
+            else:
+                f.truncate(0)
+        print(f"⚠️ {self.log_file.name} 末尾有不完整的一行（上次写入中断），已截掉")
+
+    def compact(self, keep: Callable[[Dict], bool], lock) -> bool:
+        """
+        只保留 keep(message) 为真的消息重写日志，重写期间其他线程可以继续追加
+        先在 lock 外过滤已有内容并写入临时文件，再在 lock 内把期间追加的行补到末尾后替换；
+        lock 是所有追加和重写共用的锁。日志在此期间被整体重写过时放弃，返回 False 等待下次压缩
+        """
+        if not self.exists():
+            return True
+        temp_file = self.log_file.with_suffix(self.log_file.suffix + ".compact")
+        try:
+            with lock:
+                before = os.stat(self.log_file)
+            with open(self.log_file, 'rb') as f:
+                data = f.read(before.st_size)
+            # 只处理完整的行，末尾的残行留给之后的追加检查
+            offset = data.rfind(b"\n") + 1
+            with open(temp_file, 'wb') as out:
+                for line in data[:offset].splitlines(keepends=True):
+                    try:
+                        message = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if keep(message):
+                        out.write(line)
+            with lock:
+                current = os.stat(self.log_file)
+                if current.st_ino != before.st_ino or current.st_size < offset:
+                    temp_file.unlink(missing_ok=True)
+                    return False
+                with open(self.log_file, 'rb') as f, open(temp_file, 'ab') as out:
+                    f.seek(offset)
+                    shutil.copyfileobj(f, out)
+                os.replace(temp_file, self.log_file)
+                self._tail_checked = False
+            return True
+        except Exception as e:
+            temp_file.unlink(missing_ok=True)
+            print(f"❌ 压缩聊天日志时出错: {e}")
+            return False
+
+    def rewrite(self, messages: List[Dict], fsync: bool = False) -> bool:
+        """
+        用给定的消息列表整体重写日志（用于迁移和清空会话）
+        先写临时文件再替换，避免写到一半时丢失原日志
+        """
+        temp_file = self.log_file.with_suffix(self.log_file.suffix + ".tmp")
+        try:
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                for message in messages:
+                    f.write(json.dumps(message, ensure_ascii=False) + "\n")
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temp_file, self.log_file)
+            self._tail_checked = True
+            return True
+        except Exception as e:
+            print(f"❌ 重写聊天日志时出错: {e}")
+            return False
@@ -0,0 +1,180 @@
+# MessageRecord.py
+import sys
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterable, Optional
+
+# 消息时间的字符串格式（与旧版 messages.json 保持一致）
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+@lru_cache(maxsize=4096)
+def parse_timestamp(timestamp: str) -> int:
+    """
+    把 "YYYY-mm-dd HH:MM:SS" 格式的本地时间转换为整数时间戳（秒）
+    同一秒内的大量消息共享缓存结果；无法解析时返回 0
+    """
+    try:
+        return int(datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+@lru_cache(maxsize=4096)
+def format_timestamp(ts: int) -> str:
+    """
+    把整数时间戳（秒）格式化为 "YYYY-mm-dd HH:MM:SS" 本地时间
+    """
+    return datetime.fromtimestamp(ts).strftime(TIMESTAMP_FORMAT)
+
+def assign_missing_ids(messages: Iterable["MessageRecord"], next_id: int = 1,
+                       last_seq: Optional[Dict[str, int]] = None) -> int:
+    """
+    按消息顺序（即发送顺序）为缺少 id/seq 的消息分配全局ID和会话内序号，已有编号保持不变
+    MessageStore 加载旧数据和分段存储迁移旧数据都使用这一套规则
+
+    参数:
+    - next_id: 下一个可用的全局ID
+    - last_seq: 会话ID -> 已分配的最大序号，原地更新
+
+    返回:
+    - 分配后下一个可用的全局ID
+    """
+    if last_seq is None:
+        last_seq = {}
+    for message in messages:
+        conversation_id = message.recipient_id
+        if not message.id:
+            message.id = next_id
+        next_id = max(next_id, message.id + 1)
+        seq = last_seq.get(conversation_id, 0)
+        if not message.seq:
+            message.seq = seq + 1
+        last_seq[conversation_id] = max(seq, message.seq)
+    return next_id
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class MessageRecord:
+    """
+    紧凑的内存消息记录
+    使用 __slots__ 存储字段，发送者和会话ID经过字符串驻留，时间保存为整数时间戳，
+    比每条消息一个四键字典节省大量内存
+    无法解析的时间（ts 为 0）原样保存在 extra["timestamp"] 中，写回时不会变成 1970 年
+
+    同时兼容字典式访问（msg['sender']、msg.get('timestamp')），
+    GUI 和旧代码无需修改；持久化时通过 to_dict() 转回字典
+    """
+
+    __slots__ = ("id", "seq", "sender", "recipient_id", "content", "ts", "extra")
+
+    # 通过字典方式可以访问的键
+    FIELDS = ("sender", "recipient_id", "content", "timestamp", "id", "seq")
+
+    def __init__(self, sender: str, recipient_id: Optional[str], content: str, ts: int,
+                 id: int = 0, seq: int = 0, extra: Optional[Dict] = None):
+        self.id = id
+        self.seq = seq
+        self.sender = _intern(sender)
+        self.recipient_id = _intern(recipient_id)
+        self.content = content
+        self.ts = ts
+        # 未知字段原样保留，保证读写不丢数据（通常为 None）
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "MessageRecord":
+        """
+        从持久化的字典创建记录
+        """
+        if isinstance(data, MessageRecord):
+            return data
+        extra = {key: value for key, value in data.items()
+                 if key not in cls.FIELDS} or None
+        timestamp = data.get("timestamp", "")
+        ts = parse_timestamp(timestamp)
+        if not ts and timestamp:
+            extra = dict(extra or {}, timestamp=timestamp)
+        return cls(
+            sender=data.get("sender", ""),
+            recipient_id=data.get("recipient_id"),
+            content=data.get("content", ""),
+            ts=ts,
+            id=data.get("id", 0),
+            seq=data.get("seq", 0),
+            extra=extra
+        )
+
+    def to_dict(self) -> Dict:
+        """
+        转换为持久化使用的字典
+        """
+        data = {
+            "sender": self.sender,
+            "recipient_id": self.recipient_id,
+            "content": self.content,
+            "timestamp": self.timestamp,
+            "id": self.id,
+            "seq": self.seq
+        }
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    @property
+    def timestamp(self) -> str:
+        if self.extra and "timestamp" in self.extra:
+            return self.extra["timestamp"]
+        return format_timestamp(self.ts)
+
+    # ---- 字典兼容接口 ----
+
+    def __getitem__(self, key: str):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        if key == "timestamp":
+            self.ts = parse_timestamp(value)
+            if self.extra:
+                self.extra.pop("timestamp", None)
+            if not self.ts and value:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra["timestamp"] = value
+        elif key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.FIELDS or bool(self.extra and key in self.extra)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, MessageRecord):
+            return self.to_dict() == other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"MessageRecord({self.to_dict()!r})"
@@ -0,0 +1,878 @@
+# MessageStore.py
+import atexit
+import bisect
+import heapq
+import itertools
+import threading
+import weakref
+from typing import List, Dict, Optional, Set, Iterable, Callable
+from StorageBackend import StorageBackend
+from MessageRecord import MessageRecord, assign_missing_ids
+from SearchIndex import SearchIndex
+
+class MessageStore:
+    """
+    内存消息仓库
+    按会话ID索引全部消息，并通过存储后端持久化；
+    ChatManager 和 chat.Chat 都通过它读写消息
+
+    每条消息都有全局唯一、单调递增的 id，以及会话内单调递增的 seq，
+    客户端可以记住看到的最后一个 seq，只拉取之后的增量消息
+
+    内存中的消息以 MessageRecord 紧凑保存，写入存储后端时再转换为字典
+
+    清空会话时只写一条很小的墓碑记录（该会话的 seq 水位线），
+    水位线以下的消息立即隐藏；真正从存储中删除由后台压缩任务稍后完成
+
+    会话内的消息始终按时间（时间戳，相同时按 id）排列：新消息追加在末尾，
+    带有原始时间的导入消息用二分查找插入到对应位置，读取历史时不需要再排序；
+    seq 是到达顺序，导入的消息分配最新的 seq，增量拉取和已读水位线都按 seq 计算
+
+    每个用户在每个会话中有一个已读水位线（看到的最后一个 seq），
+    未读数就是会话最新 seq 与水位线之差，不需要逐条统计；
+    每个会话按发送者记录消息条数（sender_counts 文档），统计发送条数不需要加载历史，
+    这两份数据都在发送后延迟合并写入（见 save_deferred_state）
+
+    设置 tail_size 后启动时每个会话只加载最新的 tail_size 条消息，
+    更早的历史在向上翻页或需要完整会话时再按需从存储中读取
+
+    消息内容的倒排索引在第一次搜索时建立（指定 index_dir 时从磁盘读取），
+    之后随发送和清空增量维护
+
+    同一个存储后端在进程内只对应一个仓库（见 shared），ChatManager 和 chat.Chat
+    共用同一份内存消息；消息变化时通知订阅者，界面无需轮询即可刷新
+    """
+
+    # 清空会话后多久开始后台压缩（秒），期间的多次清空合并为一次压缩
+    COMPACTION_DELAY = 2.0
+    # 发送消息推进的已读水位线和发送者计数延迟多久写入存储（秒），期间的多次发送合并为一次写入
+    DEFERRED_SAVE_DELAY = 2.0
+
+    # 进程内共享的仓库：数据位置（见 StorageBackend.location）-> 消息仓库，
+    # 同一份数据上的多个后端实例共用一个仓库，没有使用者后自动移除
+    _shared: "weakref.WeakValueDictionary[object, MessageStore]" = weakref.WeakValueDictionary()
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, storage: StorageBackend, tail_size: Optional[int] = None) -> "MessageStore":
+        """
+        获取存储后端所在数据位置的共享消息仓库，不存在时创建
+        搜索索引目录由存储后端决定（见 StorageBackend.search_index_dir），与创建顺序无关；
+        tail_size 只在第一次创建时生效，之后的调用直接返回已有的仓库
+        """
+        key = storage.location() or storage
+        with cls._shared_lock:
+            store = cls._shared.get(key)
+            if store is None:
+                store = cls(storage, tail_size=tail_size, index_dir=storage.search_index_dir())
+                cls._shared[key] = store
+            return store
+
+    def __init__(self, storage: StorageBackend, tail_size: Optional[int] = None, index_dir=None):
+        """
+        初始化消息仓库
+
+        参数:
+        - storage: 负责持久化的存储后端
+        - tail_size: 启动时每个会话预先加载的消息条数，为空时加载全部历史
+        - index_dir: 搜索索引的持久化目录，为空时索引只保存在内存中
+        """
+        self.storage = storage
+        self.tail_size = tail_size
+        self.index_dir = index_dir
+        # 会话索引：recipient_id -> 该会话的消息列表（按时间顺序）
+        self.conversations: Dict[str, List[MessageRecord]] = {}
+        # 时间顺序与 seq 顺序不一致（导入过更早的消息）的会话，这些会话不能按 seq 二分查找
+        self._out_of_order: Set[str] = set()
+        # 下一条消息的全局ID，以及每个会话已分配的最大序号
+        self._next_id = 1
+        self._last_seq: Dict[str, int] = {}
+        # 墓碑：会话ID -> {"seq": 清空时的最大序号, "max_id": 清空时的最大全局ID}
+        self.tombstones: Dict[str, Dict] = {}
+        # 已清空但尚未从存储中物理删除的会话
+        self._pending_compaction: Set[str] = set()
+        self._compaction_timer = None
+        # 只加载了尾部、存储中可能还有更早消息的会话
+        self._partial: Set[str] = set()
+        # 搜索索引，第一次搜索时建立
+        self._search_index: Optional[SearchIndex] = None
+        # 最后活动表：会话ID -> 该会话最新的一条消息，发送时更新，列出最近会话时无需扫描消息
+        self.last_messages: Dict[str, MessageRecord] = {}
+        # 发送者索引：发送者 -> 他发送的消息（按时间顺序），列表长度即发送条数
+        self._by_sender: Dict[str, List[MessageRecord]] = {}
+        # 已读水位线：用户 -> {会话ID: 已读到的 seq}
+        self.read_marks: Dict[str, Dict[str, int]] = {}
+        # 发送者计数：会话ID -> {"seq": 已计入的最大 seq, "counts": {发送者: 条数}}，
+        # 以及全部会话合计的发送者 -> 条数
+        self.sender_counts: Dict[str, Dict] = {}
+        self._sender_totals: Dict[str, int] = {}
+        # 已读水位线有变化、尚未写入存储的用户，发送者计数有变化的会话，以及延迟写入的定时器
+        self._dirty_read_marks: Set[str] = set()
+        self._dirty_sender_counts: Set[str] = set()
+        self._deferred_timer = None
+        # 保证延迟写入的数据按修改顺序写入，较早的快照不会覆盖较新的
+        self._deferred_save_lock = threading.Lock()
+        # 是否已经从存储加载过，共享仓库只需加载一次
+        self.loaded = False
+        # 变化订阅者：callback(event, conversation_id, messages)
+        self._subscribers: List[Callable] = []
+        self._lock = threading.RLock()
+
+    def load(self) -> bool:
+        """
+        从存储后端加载全部消息并建立索引
+
+        返回:
+        - 存储中是否已经有消息记录（False 表示首次运行）
+        """
+        messages = None
+        if self.tail_size:
+            messages = self.storage.load_recent_messages(self.tail_size)
+            # 旧版消息需要整体补齐编号，只能退回完整加载
+            if messages is not None and any("id" not in msg or "seq" not in msg for msg in messages):
+                messages = None
+        tail_only = messages is not None
+        if messages is None:
+            messages = self.storage.load_messages()
+        # 旧版消息没有 id/seq，补齐后整体保存一次，之后的ID保持稳定
+        needs_upgrade = any("id" not in msg or "seq" not in msg for msg in messages or [])
+        with self._lock:
+            self.tombstones = self.storage.load_document("tombstones") or {}
+            self.read_marks = self.storage.load_document("read_marks") or {}
+            self._index_messages([MessageRecord.from_dict(msg) for msg in messages or []])
+            # 最早到达的已加载消息紧接着水位线时，该会话已经完整
+            self._partial = {cid for cid in self.conversations
+                             if self._first_loaded_seq(cid) > self._watermark(cid) + 1} if tail_only else set()
+            # 尾部中有导入的消息时，存储中更早到达的消息可能比它们新，补齐完整历史才能正确排列
+            for cid in self._partial & self._out_of_order:
+                self._load_older(cid)
+            self._init_sender_counts(self.storage.load_document("sender_counts") or {})
+            if needs_upgrade:
+                self.save_all()
+            self.loaded = True
+        # 上次退出前没来得及压缩的会话，重新安排压缩
+        if self._pending_compaction:
+            self._schedule_compaction()
+        self._schedule_deferred_save()
+        return messages is not None
+
+    def _watermark(self, conversation_id: str) -> int:
+        """
+        会话的清空水位线，seq 不超过它的消息已被清空
+        """
+        tombstone = self.tombstones.get(conversation_id)
+        return tombstone["seq"] if tombstone else 0
+
+    def _index_messages(self, messages: List[MessageRecord]):
+        """
+        按会话重建索引，并恢复ID和序号计数器
+        已被墓碑隐藏的消息不进入索引
+        """
+        self.conversations = {}
+        if self._search_index is not None:
+            self._search_index.close()
+        self._search_index = None
+        # 清空过的会话从水位线继续编号，ID 也不会复用
+        self._last_seq = {cid: tombstone["seq"] for cid, tombstone in self.tombstones.items()}
+        self._next_id = max((tombstone.get("max_id", 0) for tombstone in self.tombstones.values()),
+                            default=0) + 1
+        self._next_id = assign_missing_ids(messages, self._next_id, self._last_seq)
+        for message in messages:
+            conversation_id = message.recipient_id
+            if message.seq <= self._watermark(conversation_id):
+                self._pending_compaction.add(conversation_id)
+                continue
+            self.conversations.setdefault(conversation_id, []).append(message)
+        # 存储按全局ID返回消息，导入过历史消息的会话需要按时间重新排列（已有序时只需线性时间）
+        for bucket in self.conversations.values():
+            bucket.sort(key=_time_order)
+        self._out_of_order = {cid for cid, bucket in self.conversations.items() if not _seq_ordered(bucket)}
+        self.last_messages = {cid: bucket[-1] for cid, bucket in self.conversations.items()}
+        self._by_sender = {}
+        self._index_senders(heapq.merge(*self.conversations.values(), key=_time_order))
+
+    def _init_sender_counts(self, saved: Dict[str, Dict]):
+        """
+        恢复每个会话的发送者计数，调用方持有锁
+        只加载了尾部的会话使用存储中的计数，再补上计数之后到达、已在尾部中的消息；
+        计数缺失或落后于已加载部分时补齐该会话的历史重新统计。
+        计数的 seq 不超过清空水位线时，说明计数写入后会话被清空过，从零开始
+        """
+        self.sender_counts = {}
+        self._sender_totals = {}
+        for cid, last_seq in self._last_seq.items():
+            watermark = self._watermark(cid)
+            entry = saved.get(cid) or {}
+            counted = entry.get("seq", 0)
+            counts = dict(entry.get("counts", {})) if counted > watermark else {}
+            counted = max(counted, watermark)
+            usable = cid in self._partial and counted <= last_seq \
+                and self._first_loaded_seq(cid) <= counted + 1
+            if not usable:
+                self._load_older(cid)
+                counts, counted = {}, watermark
+            for message in self.conversations.get(cid, []):
+                if message.seq > counted:
+                    counts[message.sender] = counts.get(message.sender, 0) + 1
+            self.sender_counts[cid] = {"seq": last_seq, "counts": counts}
+            if self.sender_counts[cid] != saved.get(cid):
+                self._dirty_sender_counts.add(cid)
+            for sender, count in counts.items():
+                self._sender_totals[sender] = self._sender_totals.get(sender, 0) + count
+
+    def _count_sender(self, message: MessageRecord):
+        """
+        把一条新消息计入发送者计数，调用方持有锁
+        """
+        entry = self.sender_counts.setdefault(message.recipient_id, {"seq": 0, "counts": {}})
+        entry["seq"] = max(entry["seq"], message.seq)
+        entry["counts"][message.sender] = entry["counts"].get(message.sender, 0) + 1
+        self._sender_totals[message.sender] = self._sender_totals.get(message.sender, 0) + 1
+        self._dirty_sender_counts.add(message.recipient_id)
+
+    def _index_senders(self, records: Iterable[MessageRecord]):
+        """
+        把按时间顺序排列的消息追加到发送者索引
+        """
+        for record in records:
+            self._by_sender.setdefault(record.sender, []).append(record)
+
+    def _unindex_senders(self, records: Iterable[MessageRecord]):
+        """
+        从发送者索引中删除消息，只重建涉及到的发送者
+        """
+        removed: Dict[str, Set[int]] = {}
+        for record in records:
+            removed.setdefault(record.sender, set()).add(record.id)
+        for sender, ids in removed.items():
+            remaining = [msg for msg in self._by_sender.get(sender, []) if msg.id not in ids]
+            if remaining:
+                self._by_sender[sender] = remaining
+            else:
+                self._by_sender.pop(sender, None)
+
+    def _first_loaded_seq(self, conversation_id: str) -> int:
+        """
+        会话已加载消息中最小的 seq，没有已加载消息时为 0
+        """
+        bucket = self.conversations.get(conversation_id)
+        if not bucket:
+            return 0
+        if conversation_id in self._out_of_order:
+            return min(msg.seq for msg in bucket)
+        return bucket[0].seq
+
+    def _load_older(self, conversation_id: str, limit: Optional[int] = None) -> int:
+        """
+        从存储中读取会话已加载部分之前到达的 limit 条消息（为空时读取全部），按时间合并到索引桶
+
+        返回:
+        - 新加载的消息条数
+        """
+        with self._lock:
+            if conversation_id not in self._partial:
+                return 0
+            before_seq = self._first_loaded_seq(conversation_id) or None
+            try:
+                older = self.storage.load_conversation_messages(conversation_id, before_seq, limit)
+            except Exception as e:
+                print(f"❌ 加载更早的聊天记录时出错: {e}")
+                return 0
+            watermark = self._watermark(conversation_id)
+            records = [MessageRecord.from_dict(msg) for msg in older if msg.get("seq", 0) > watermark]
+            # 没有读满，或者已经读到水位线，说明更早的消息都已加载
+            if not limit or len(older) < limit or len(records) < len(older) \
+                    or (records and records[0].seq == watermark + 1):
+                self._partial.discard(conversation_id)
+            if records:
+                records.sort(key=_time_order)
+                # 原地合并，保证调用方持有的桶引用仍然有效；通常直接接在前部，两段有序数据的排序只需线性时间
+                bucket = self.conversations.setdefault(conversation_id, [])
+                bucket[:] = sorted(records + bucket, key=_time_order)
+                if not _seq_ordered(bucket):
+                    self._out_of_order.add(conversation_id)
+                self.last_messages[conversation_id] = bucket[-1]
+                # 更早的消息可能与该发送者在其它会话的消息交错，按时间合并
+                by_sender: Dict[str, List[MessageRecord]] = {}
+                for record in records:
+                    by_sender.setdefault(record.sender, []).append(record)
+                for sender, older_records in by_sender.items():
+                    self._by_sender[sender] = sorted(older_records + self._by_sender.get(sender, []),
+                                                     key=_time_order)
+            return len(records)
+
+    def _load_all(self):
+        """
+        加载所有会话尚未加载的历史
+        """
+        with self._lock:
+            for conversation_id in list(self._partial):
+                self._load_older(conversation_id)
+
+    @property
+    def messages(self) -> List[MessageRecord]:
+        """
+        全部消息（按时间顺序合并各会话索引）
+        """
+        with self._lock:
+            self._load_all()
+            buckets = list(self.conversations.values())
+        # 各会话桶都按时间排列，直接归并
+        return list(heapq.merge(*buckets, key=_time_order))
+
+    def _message_dicts(self) -> List[Dict]:
+        """
+        全部消息的字典形式，供需要整体重写的存储后端使用
+        """
+        return [message.to_dict() for message in self.messages]
+
+    def __len__(self) -> int:
+        """
+        已加载到内存的消息条数
+        """
+        return sum(len(bucket) for bucket in self.conversations.values())
+
+    def get_conversation(self, conversation_id: str) -> List[MessageRecord]:
+        """
+        获取会话的完整消息列表（内部列表，调用方不要修改）
+        """
+        self._load_older(conversation_id)
+        return self.conversations.get(conversation_id, [])
+
+    def get_last_message(self, conversation_id: str) -> Optional[MessageRecord]:
+        """
+        会话最新的一条消息，没有消息时为 None
+        """
+        return self.last_messages.get(conversation_id)
+
+    def sort_by_last_activity(self, conversation_ids: Iterable[str]) -> List[str]:
+        """
+        按最后活动时间从新到旧排列会话，没有消息的会话排在最后
+        只查最后活动表，耗时与会话数成正比
+        """
+        def activity(conversation_id):
+            last = self.last_messages.get(conversation_id)
+            return (last.ts, last.id) if last is not None else (0, 0)
+        return sorted(conversation_ids, key=activity, reverse=True)
+
+    def subscribe(self, callback: Callable) -> None:
+        """
+        订阅消息变化，callback(event, conversation_id, messages) 在变化写入存储后调用
+        event 为 "append"（新消息）、"import"（导入消息）、"clear"（会话被清空）
+        或 "reload"（全部内容被替换，conversation_id 为 None）
+        """
+        with self._lock:
+            if callback not in self._subscribers:
+                self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable) -> None:
+        """
+        取消订阅，未订阅时忽略
+        """
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _notify(self, event: str, conversation_id: Optional[str], messages: List[MessageRecord]) -> None:
+        """
+        通知全部订阅者；在锁外调用，订阅者可以直接读取仓库
+        单个订阅者出错不影响其他订阅者和写入结果
+        """
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(event, conversation_id, messages)
+            except Exception as e:
+                print(f"❌ 消息变化通知失败: {e}")
+
+    def append(self, message: Dict) -> bool:
+        """
+        添加一条新消息并持久化，保存失败时回滚
+        """
+        message = MessageRecord.from_dict(message)
+        conversation_id = message.recipient_id
+        with self._lock:
+            # 分配全局ID和会话内序号
+            previous_seq = self._last_seq.get(conversation_id, 0)
+            message.id = self._next_id
+            message.seq = previous_seq + 1
+            self._next_id += 1
+            self._last_seq[conversation_id] = message.seq
+            
+            bucket = self.conversations.setdefault(conversation_id, [])
+            # 时间戳早于会话最新消息（例如发送方时钟回拨）时按时间插入，最新消息不会后退
+            position = bisect.bisect_right(bucket, _time_order(message), key=_time_order)
+            bucket.insert(position, message)
+            try:
+                saved = self.storage.append_message(message.to_dict(), self._message_dicts)
+            except Exception as e:
+                print(f"❌ 保存聊天记录时出错: {e}")
+                saved = False
+            if not saved:
+                del bucket[position]
+                if not bucket:
+                    del self.conversations[conversation_id]
+                self._next_id -= 1
+                self._last_seq[conversation_id] = previous_seq
+            else:
+                if position < len(bucket) - 1:
+                    self._out_of_order.add(conversation_id)
+                self.last_messages[conversation_id] = bucket[-1]
+                bisect.insort(self._by_sender.setdefault(message.sender, []), message, key=_time_order)
+                self._count_sender(message)
+                # 自己发的消息不算未读；只更新内存，稍后合并写入，发送时不重写已读文档
+                self._advance_read_mark(message.sender, conversation_id, message.seq)
+                if self._search_index is not None:
+                    # 保存成功后才加入索引，回滚的消息ID会被复用，不能留在磁盘索引里
+                    self._search_index.add(message)
+        if saved:
+            self._schedule_deferred_save()
+            self._notify("append", conversation_id, [message])
+        return saved
+
+    def import_messages(self, messages: List[Dict]) -> bool:
+        """
+        导入带有原始时间的消息（例如从备份合并），可能早于会话中已有的消息
+        导入的消息用二分查找插入到会话、发送者索引中原始时间的位置，会话最新消息不会因此后退；
+        已有消息的 seq 保持不变，导入的消息按时间依次分配当前最后一个 seq 之后的序号，
+        因此增量拉取能取到它们，对其他成员也计为未读
+        导入的消息和新消息一样追加保存，保存失败时整体回滚
+        """
+        if not messages:
+            return True
+        with self._lock:
+            records = sorted((MessageRecord.from_dict(msg) for msg in messages), key=lambda msg: msg.ts)
+            previous_next_id = self._next_id
+            previous_seqs: Dict[str, int] = {}
+            for record in records:
+                conversation_id = record.recipient_id
+                if conversation_id not in previous_seqs:
+                    previous_seqs[conversation_id] = self._last_seq.get(conversation_id, 0)
+                    # 先补齐完整历史，导入的消息才能插入到正确的时间位置
+                    self._load_older(conversation_id)
+                record.id = self._next_id
+                record.seq = self._last_seq.get(conversation_id, 0) + 1
+                self._next_id += 1
+                self._last_seq[conversation_id] = record.seq
+                bisect.insort(self.conversations.setdefault(conversation_id, []), record, key=_time_order)
+            try:
+                saved = self.storage.append_messages([record.to_dict() for record in records], self._message_dicts)
+            except Exception as e:
+                print(f"❌ 保存聊天记录时出错: {e}")
+                saved = False
+            if not saved:
+                for conversation_id, previous_seq in previous_seqs.items():
+                    bucket = self.conversations[conversation_id]
+                    # 导入的消息ID都不小于导入前的下一个ID
+                    bucket[:] = [msg for msg in bucket if msg.id < previous_next_id]
+                    if not bucket:
+                        del self.conversations[conversation_id]
+                    self._last_seq[conversation_id] = previous_seq
+                self._next_id = previous_next_id
+                return False
+            for record in records:
+                bisect.insort(self._by_sender.setdefault(record.sender, []), record, key=_time_order)
+                self._count_sender(record)
+            for conversation_id in previous_seqs:
+                bucket = self.conversations[conversation_id]
+                if not _seq_ordered(bucket):
+                    self._out_of_order.add(conversation_id)
+                self.last_messages[conversation_id] = bucket[-1]
+            if self._search_index is not None:
+                self._search_index.add_many(records)
+        self._schedule_deferred_save()
+        for conversation_id in previous_seqs:
+            self._notify("import", conversation_id,
+                         [record for record in records if record.recipient_id == conversation_id])
+        return True
+
+    def save_all(self, messages: Optional[List[Dict]] = None) -> bool:
+        """
+        整体保存全部消息；提供 messages 时以它替换当前内容
+        """
+        with self._lock:
+            if messages is not None:
+                self._index_messages([MessageRecord.from_dict(msg) for msg in messages])
+                self._partial.clear()
+                self._init_sender_counts({})
+            try:
+                saved = self.storage.save_messages(self._message_dicts())
+                if saved:
+                    # 整体重写只包含可见消息，等同于完成了压缩
+                    self._pending_compaction.clear()
+            except Exception as e:
+                print(f"❌ 保存聊天记录时出错: {e}")
+                return False
+        if saved and messages is not None:
+            self._schedule_deferred_save()
+            # 内容被整体替换，订阅者需要重新读取全部会话
+            self._notify("reload", None, [])
+        return saved
+
+    def clear_conversation(self, conversation_id: str) -> bool:
+        """
+        清空一个会话：丢弃该会话的索引桶并写入墓碑，不重写消息存储
+        会话序号不会重置，之后的新消息序号继续递增
+        """
+        return self._clear([conversation_id])
+
+    def clear_all(self) -> bool:
+        """
+        清空全部会话
+        """
+        with self._lock:
+            conversation_ids = list(self.conversations)
+        return self._clear(conversation_ids)
+
+    def _clear(self, conversation_ids: List[str]) -> bool:
+        """
+        为指定会话写入墓碑，隐藏当前所有消息；写入失败时恢复
+        """
+        with self._lock:
+            conversation_ids = [cid for cid in conversation_ids if self.conversations.get(cid)]
+            if not conversation_ids:
+                return True
+
+            previous = {cid: self.tombstones.get(cid) for cid in conversation_ids}
+            removed = {cid: self.conversations.pop(cid) for cid in conversation_ids}
+            for cid in conversation_ids:
+                self.last_messages.pop(cid, None)
+            for cid in conversation_ids:
+                self.tombstones[cid] = {"seq": self._last_seq.get(cid, 0), "max_id": self._next_id - 1}
+            try:
+                saved = self.storage.save_entries("tombstones", self.tombstones, conversation_ids)
+            except Exception as e:
+                print(f"❌ 清空消息失败: {e}")
+                saved = False
+
+            if not saved:
+                self.conversations.update(removed)
+                self.last_messages.update({cid: bucket[-1] for cid, bucket in removed.items()})
+                for cid, tombstone in previous.items():
+                    if tombstone is None:
+                        del self.tombstones[cid]
+                    else:
+                        self.tombstones[cid] = tombstone
+                return False
+            self._pending_compaction.update(conversation_ids)
+            self._out_of_order.difference_update(conversation_ids)
+            for cid in conversation_ids:
+                # 清空后计数从零开始；计数稍后写入，写入前重启时按水位线判断计数已过期
+                entry = self.sender_counts.get(cid, {"counts": {}})
+                for sender, count in entry["counts"].items():
+                    self._sender_totals[sender] -= count
+                    if not self._sender_totals[sender]:
+                        del self._sender_totals[sender]
+                self.sender_counts[cid] = {"seq": self._watermark(cid), "counts": {}}
+                self._dirty_sender_counts.add(cid)
+            self._unindex_senders(record for records in removed.values() for record in records)
+            if self._search_index is not None:
+                for records in removed.values():
+                    self._search_index.remove_many(records)
+
+        self._schedule_compaction()
+        self._schedule_deferred_save()
+        for cid in conversation_ids:
+            self._notify("clear", cid, [])
+        return True
+
+    def _schedule_compaction(self):
+        """
+        安排一次后台压缩，已安排时不重复安排
+        """
+        with self._lock:
+            if self._compaction_timer is not None:
+                return
+            self._compaction_timer = threading.Timer(self.COMPACTION_DELAY, self._run_compaction)
+            self._compaction_timer.daemon = True
+            self._compaction_timer.start()
+
+    def _run_compaction(self):
+        with self._lock:
+            self._compaction_timer = None
+        if not self.compact():
+            # 压缩失败时稍后重试，墓碑保证在此期间消息仍然隐藏
+            self._schedule_compaction()
+
+    def compact(self) -> bool:
+        """
+        从存储中物理删除被墓碑隐藏的消息
+        """
+        with self._lock:
+            if not self._pending_compaction:
+                return True
+            watermarks = {cid: self._watermark(cid) for cid in self._pending_compaction}
+        # 在锁外压缩：整体重写消息文件期间，发送和读取消息不用等待
+        try:
+            compacted = self.storage.compact_messages(watermarks, self._message_dicts)
+        except Exception as e:
+            print(f"❌ 压缩聊天记录时出错: {e}")
+            compacted = False
+        if compacted:
+            with self._lock:
+                for cid, watermark in watermarks.items():
+                    # 压缩期间又被清空过的会话水位线更高，还需要再压缩一次
+                    if self._watermark(cid) == watermark:
+                        self._pending_compaction.discard(cid)
+        return compacted
+
+    @property
+    def search_index(self) -> SearchIndex:
+        """
+        消息内容的倒排索引，第一次访问时读取磁盘索引或从全部消息建立
+        """
+        with self._lock:
+            if self._search_index is None:
+                index = SearchIndex(self.index_dir)
+                index.load(self.messages, self._next_id - 1)
+                self._search_index = index
+            return self._search_index
+
+    def search(self, keyword: str, conversation_id: Optional[str] = None) -> List[MessageRecord]:
+        """
+        搜索内容包含关键词的消息（不区分大小写），按发送顺序返回
+        """
+        with self._lock:
+            return self.search_index.search(keyword, conversation_id)
+
+    def search_ranked(self, keyword: str, conversation_id: Optional[str] = None, limit: int = 20,
+                      cursor: Optional[str] = None, conversation_ids: Optional[Set[str]] = None) -> Dict:
+        """
+        按相关度排序的分页搜索，见 SearchIndex.search_ranked
+        """
+        with self._lock:
+            return self.search_index.search_ranked(keyword, conversation_id, limit, cursor,
+                                                   conversation_ids=conversation_ids)
+
+    def query(self, sender: Optional[str] = None, conversation_ids: Optional[Set[str]] = None,
+              start=None, end=None, keywords: Optional[List[str]] = None, match_all: bool = True,
+              limit: Optional[int] = None) -> List[MessageRecord]:
+        """
+        按发送者、会话、时间范围和关键词组合查询，见 SearchIndex.query
+        """
+        with self._lock:
+            return self.search_index.query(sender, conversation_ids, start, end, keywords, match_all, limit)
+
+    def mark_read(self, user_id: str, conversation_id: str, seq: Optional[int] = None) -> bool:
+        """
+        把用户在会话中的已读水位线推进到 seq（默认为会话最新消息），水位线不会后退
+        立即写入存储，连同尚未写入的其他水位线
+        """
+        with self._lock:
+            if seq is None:
+                seq = self.get_last_seq(conversation_id)
+            if not self._advance_read_mark(user_id, conversation_id, seq):
+                return True
+        return self.save_read_marks()
+
+    def _advance_read_mark(self, user_id: str, conversation_id: str, seq: int) -> bool:
+        """
+        在内存中推进已读水位线并记录待写入的用户，调用方持有锁
+
+        返回:
+        - 水位线是否前进了
+        """
+        marks = self.read_marks.setdefault(user_id, {})
+        if seq <= marks.get(conversation_id, 0):
+            return False
+        marks[conversation_id] = seq
+        self._dirty_read_marks.add(user_id)
+        return True
+
+    def _schedule_deferred_save(self):
+        """
+        安排一次延迟写入已读水位线和发送者计数，已安排时不重复安排；进程退出前会写入剩余的修改
+        """
+        with self._lock:
+            if self._deferred_timer is not None or not (self._dirty_read_marks or self._dirty_sender_counts):
+                return
+            self._deferred_timer = threading.Timer(self.DEFERRED_SAVE_DELAY, self._run_deferred_save)
+            self._deferred_timer.daemon = True
+            self._deferred_timer.start()
+            atexit.register(self.save_deferred_state)
+
+    def _run_deferred_save(self):
+        with self._lock:
+            self._deferred_timer = None
+        saved = self.save_deferred_state()
+        with self._lock:
+            # 写入期间又有新的修改时，新安排的写入仍需要退出时的保障
+            if saved and not (self._dirty_read_marks or self._dirty_sender_counts) \
+                    and self._deferred_timer is None:
+                atexit.unregister(self.save_deferred_state)
+        if not saved:
+            # 写入失败时稍后重试，内存中的数据仍然有效
+            self._schedule_deferred_save()
+
+    def save_deferred_state(self) -> bool:
+        """
+        把尚未写入的已读水位线和发送者计数写入存储
+        """
+        read_marks_saved = self.save_read_marks()
+        return self.save_sender_counts() and read_marks_saved
+
+    def save_sender_counts(self) -> bool:
+        """
+        把有变化的会话的发送者计数写入存储，在仓库的锁外写入快照
+        """
+        with self._deferred_save_lock:
+            with self._lock:
+                if not self._dirty_sender_counts:
+                    return True
+                conversation_ids = list(self._dirty_sender_counts)
+                self._dirty_sender_counts.clear()
+                snapshot = {cid: {"seq": entry["seq"], "counts": dict(entry["counts"])}
+                            for cid, entry in self.sender_counts.items()}
+            try:
+                saved = self.storage.save_entries("sender_counts", snapshot, conversation_ids)
+            except Exception as e:
+                print(f"❌ 保存发送者计数时出错: {e}")
+                saved = False
+            if not saved:
+                with self._lock:
+                    self._dirty_sender_counts.update(conversation_ids)
+            return saved
+
+    def save_read_marks(self) -> bool:
+        """
+        把尚未写入的已读水位线写入存储
+        在仓库的锁外写入快照，发送消息不用等待存储
+        """
+        with self._deferred_save_lock:
+            with self._lock:
+                if not self._dirty_read_marks:
+                    return True
+                users = list(self._dirty_read_marks)
+                self._dirty_read_marks.clear()
+                snapshot = {user: dict(marks) for user, marks in self.read_marks.items()}
+            try:
+                saved = self.storage.save_entries("read_marks", snapshot, users)
+            except Exception as e:
+                print(f"❌ 保存已读状态时出错: {e}")
+                saved = False
+            if not saved:
+                with self._lock:
+                    self._dirty_read_marks.update(users)
+            return saved
+
+    def get_unread_count(self, user_id: str, conversation_id: str) -> int:
+        """
+        用户在会话中的未读消息数：最新 seq 减去已读水位线（清空过的消息不计）
+        """
+        read_seq = self.read_marks.get(user_id, {}).get(conversation_id, 0)
+        return max(0, self.get_last_seq(conversation_id) - max(read_seq, self._watermark(conversation_id)))
+
+    def get_sender_messages(self, sender: str, conversation_id: Optional[str] = None) -> List[MessageRecord]:
+        """
+        获取某个用户发送的消息（按时间顺序），可以限定会话
+        """
+        with self._lock:
+            if conversation_id is not None:
+                # 从发送者索引和会话中选择较短的一个过滤
+                sent = self._by_sender.get(sender, [])
+                bucket = self.get_conversation(conversation_id)
+                if len(bucket) < len(sent):
+                    return [msg for msg in bucket if msg.sender == sender]
+                return [msg for msg in sent if msg.recipient_id == conversation_id]
+            self._load_all()
+            return list(self._by_sender.get(sender, []))
+
+    def count_by_sender(self, sender: str) -> int:
+        """
+        用户发送的消息条数（不含已清空的消息）
+        直接读取发送者计数，不需要加载历史
+        """
+        return self._sender_totals.get(sender, 0)
+
+    def count_conversation(self, conversation_id: str) -> int:
+        """
+        会话中的消息条数（不含已清空的消息）
+        水位线之上的 seq 是连续的，条数就是两者之差，不需要加载历史
+        """
+        return self._last_seq.get(conversation_id, 0) - self._watermark(conversation_id)
+
+    def count_all(self) -> int:
+        """
+        全部会话的消息条数
+        """
+        with self._lock:
+            return sum(self.count_conversation(cid) for cid in self._last_seq)
+
+    def get_page(self, conversation_id: str, before: Optional[str] = None, limit: int = 50) -> Dict:
+        """
+        分页获取会话历史：返回游标之前最新的 limit 条消息
+
+        参数:
+        - conversation_id: 会话ID
+        - before: 上一页返回的 next_cursor（该页第一条消息的 "时间戳:id"），为空时从最新消息开始
+        - limit: 每页条数
+
+        返回:
+        - {"messages": 按时间顺序的消息, "next_cursor": 更早一页的游标（没有更多时为 None）}
+        """
+        before_key = None
+        if before is not None:
+            try:
+                ts, message_id = str(before).split(":")
+                before_key = (int(ts), int(message_id))
+            except (TypeError, ValueError):
+                raise ValueError(f"无效的分页游标: {before}")
+        limit = max(0, limit)
+
+        with self._lock:
+            bucket = self.conversations.get(conversation_id, [])
+            end = self._page_end(bucket, before_key)
+            if end < limit and conversation_id in self._partial:
+                # 翻到了已加载部分的开头，只从存储中补读这一页缺少的条数
+                self._load_older(conversation_id, limit - end)
+                bucket = self.conversations.get(conversation_id, [])
+                end = self._page_end(bucket, before_key)
+            start = max(0, end - limit)
+            # 只切出本页，不复制整个会话
+            page = bucket[start:end]
+            has_more = start > 0 or conversation_id in self._partial
+        return {
+            "messages": page,
+            "next_cursor": f"{page[0].ts}:{page[0].id}" if page and has_more else None
+        }
+
+    @staticmethod
+    def _page_end(bucket: List[MessageRecord], before_key: Optional[tuple]) -> int:
+        if before_key is None:
+            return len(bucket)
+        # 会话内消息按时间排列，二分查找游标位置
+        return bisect.bisect_left(bucket, before_key, key=_time_order)
+
+    def get_messages_since(self, conversation_id: str, seq: int) -> List[MessageRecord]:
+        """
+        获取会话中序号大于 seq 的消息（增量拉取），按 seq 递增返回
+        """
+        with self._lock:
+            first_seq = self._first_loaded_seq(conversation_id)
+            if not first_seq or first_seq > seq + 1:
+                # 请求的起点早于已加载部分，需要补读更早的历史
+                self._load_older(conversation_id)
+            bucket = self.conversations.get(conversation_id, [])
+            if conversation_id in self._out_of_order:
+                # 导入过更早的消息，时间顺序不是 seq 顺序，只能逐条过滤
+                return sorted((msg for msg in bucket if msg.seq > seq), key=lambda msg: msg.seq)
+            start = bisect.bisect_right(bucket, seq, key=lambda msg: msg.seq)
+            return bucket[start:]
+
+    def get_last_seq(self, conversation_id: str) -> int:
+        """
+        获取会话已分配的最大序号，没有消息时为 0
+        """
+        return self._last_seq.get(conversation_id, 0)
+
+
+def _time_order(message: MessageRecord) -> tuple:
+    return (message.ts, message.id)
+
+
+def _seq_ordered(bucket: List[MessageRecord]) -> bool:
+    """
+    按时间排列的会话桶是否同时按 seq 递增
+    """
+    return all(a.seq < b.seq for a, b in zip(bucket, itertools.islice(bucket, 1, None)))
@@ -0,0 +1,851 @@
+# SearchIndex.py
+import atexit
+import bisect
+import heapq
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import List, Dict, Optional, Set, Iterable
+from datetime import datetime
+from MessageRecord import MessageRecord, parse_timestamp
+
+# 中日韩文字（汉字、假名、谚文）
+_CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+# 连续的中日韩文字，或者连续的其它字母数字（英文单词、数字）
+_TOKEN_PATTERN = re.compile(f"([{_CJK_CHARS}]+)|([^\\W_{_CJK_CHARS}]+)")
+_CJK_PATTERN = re.compile(f"[{_CJK_CHARS}]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    把消息内容切分为索引词
+    中文没有空格分词，按单字和相邻两字（二元组）切分；英文和数字按单词切分，统一小写
+    """
+    terms = []
+    for cjk, word in _TOKEN_PATTERN.findall(text.lower()):
+        if word:
+            terms.append(word)
+            continue
+        terms.extend(cjk)
+        terms.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return terms
+
+
+def query_terms(keyword: str) -> List[str]:
+    """
+    把搜索关键词切分为查询词
+    中文片段只需用二元组（单字片段用单字）就能覆盖；
+    英文单词之后还要到词表中做子串匹配
+    """
+    terms = []
+    for cjk, word in _TOKEN_PATTERN.findall(keyword.lower()):
+        if word:
+            terms.append(word)
+        elif len(cjk) == 1:
+            terms.append(cjk)
+        else:
+            terms.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return terms
+
+
+class SearchIndex:
+    """
+    消息内容的倒排索引
+    索引词 -> 包含该词的消息ID集合；搜索时先求各查询词的交集得到候选消息，
+    再对候选消息做一次子串校验，结果与逐条扫描完全一致
+
+    发送消息时增量加入，清空会话时增量删除，不需要重建
+    除内容外还按发送者、会话和时间建立索引，供组合条件查询（query）使用
+
+    指定 index_dir 时索引持久化到磁盘，重启后直接读取而不是重新分词：
+    - 新消息先在内存中积累，每 FLUSH_SIZE 条写成一个新的索引分段
+    - 分段按大小分层合并（见 MERGE_RATIO），同时丢掉已删除消息的ID；
+      合并只读写涉及的分段文件，在后台线程中进行，发送消息不用等待
+    - manifest.json 记录已索引的最大消息ID和该消息内容的校验和，
+      启动时据此判断索引是否仍与消息记录一致：落后时只补上缺少的消息，
+      不一致（消息记录被整体替换）时才重建
+    """
+
+    # 积累多少条新消息写一个分段
+    FLUSH_SIZE = 500
+    # 某个分段的大小不超过其后所有分段大小之和的 MERGE_RATIO 倍时，把它和其后的分段合并为一个：
+    # 分段大小从旧到新大致按倍数递减，分段数与消息总数成对数关系，每条索引只被重写对数次
+    MERGE_RATIO = 1.0
+
+    # BM25 参数
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+    # 时间衰减：得分每过多少天减半，以及再旧的消息也至少保留的得分比例
+    DECAY_HALF_LIFE_DAYS = 30
+    DECAY_FLOOR = 0.3
+
+    def __init__(self, index_dir=None):
+        """
+        初始化搜索索引
+
+        参数:
+        - index_dir: 索引持久化目录，为空时只保存在内存中
+        """
+        # 索引词 -> 消息ID集合
+        self._postings: Dict[str, Set[int]] = {}
+        # 英文/数字词表，用于关键词只是单词一部分时的子串匹配
+        self._words: Set[str] = set()
+        # 词表的二元组索引：相邻两个字符 -> 包含它的词（单字符的词以自身为键），
+        # 子串匹配只需检查候选词，不必扫描整个词表
+        self._word_grams: Dict[str, Set[str]] = {}
+        # 消息ID -> 消息记录
+        self._records: Dict[int, MessageRecord] = {}
+        # 全部消息内容的总长度，用于 BM25 的平均文档长度
+        self._total_length = 0
+        # 发送者 -> 消息ID集合，会话ID -> 消息ID集合，以及按 (时间, ID) 排序的时间索引
+        self._by_sender: Dict[str, Set[int]] = {}
+        self._by_conversation: Dict[str, Set[int]] = {}
+        self._by_time: List[tuple] = []
+
+        self.index_dir = Path(index_dir) if index_dir is not None else None
+        # 磁盘上的分段文件名（按写入顺序），每个分段的大小（索引项数），以及已分配的最大分段编号
+        self._segments: List[str] = []
+        self._segment_sizes: Dict[str, int] = {}
+        self._segment_counter = 0
+        # 分段列表和清单的锁：写入新分段与后台合并互斥
+        self._segments_lock = threading.Lock()
+        # 正在运行的后台合并线程
+        self._merge_thread: Optional[threading.Thread] = None
+        # 已写入磁盘的最大消息ID，以及尚未写入磁盘的新增索引
+        self._flushed_max_id = 0
+        self._pending: Dict[str, Set[int]] = {}
+        self._pending_count = 0
+        self._pending_max_id = 0
+        if self.index_dir is not None:
+            atexit.register(self.flush)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def add(self, record: MessageRecord):
+        """
+        把一条消息加入索引
+        """
+        self._add(record)
+        if self._pending_count >= self.FLUSH_SIZE:
+            self.flush()
+
+    def add_many(self, records: Iterable[MessageRecord]):
+        for record in records:
+            self._add(record)
+        if self._pending_count >= self.FLUSH_SIZE:
+            self.flush()
+
+    def _add(self, record: MessageRecord):
+        self._add_fields(record)
+        persistent = self.index_dir is not None
+        for term in set(tokenize(record.content)):
+            self._add_posting(term, record.id)
+            if persistent:
+                self._pending.setdefault(term, set()).add(record.id)
+        if persistent:
+            self._pending_count += 1
+            self._pending_max_id = max(self._pending_max_id, record.id)
+
+    def _add_fields(self, record: MessageRecord):
+        """
+        登记消息本身以及发送者、会话、时间索引（不涉及分词）
+        """
+        if record.id in self._records:
+            self._remove_fields(self._records[record.id])
+        self._records[record.id] = record
+        self._total_length += len(record.content)
+        self._by_sender.setdefault(record.sender, set()).add(record.id)
+        self._by_conversation.setdefault(record.recipient_id, set()).add(record.id)
+        entry = (record.ts, record.id)
+        # 新消息通常是最新的，直接追加到末尾
+        if not self._by_time or self._by_time[-1] <= entry:
+            self._by_time.append(entry)
+        else:
+            bisect.insort(self._by_time, entry)
+
+    def _remove_fields(self, record: MessageRecord, update_time: bool = True):
+        del self._records[record.id]
+        self._total_length -= len(record.content)
+        for index, key in ((self._by_sender, record.sender), (self._by_conversation, record.recipient_id)):
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(record.id)
+                if not ids:
+                    del index[key]
+        if update_time:
+            position = bisect.bisect_left(self._by_time, (record.ts, record.id))
+            if position < len(self._by_time) and self._by_time[position] == (record.ts, record.id):
+                del self._by_time[position]
+
+    def _add_posting(self, term: str, message_id: int):
+        postings = self._postings.get(term)
+        if postings is None:
+            postings = self._postings[term] = set()
+            if not _is_cjk(term):
+                self._add_word(term)
+        postings.add(message_id)
+
+    def _add_word(self, word: str):
+        self._words.add(word)
+        for gram in _word_grams(word):
+            self._word_grams.setdefault(gram, set()).add(word)
+
+    def _remove_word(self, word: str):
+        if word not in self._words:
+            return
+        self._words.discard(word)
+        for gram in _word_grams(word):
+            bucket = self._word_grams.get(gram)
+            if bucket is not None:
+                bucket.discard(word)
+                if not bucket:
+                    del self._word_grams[gram]
+
+    def remove(self, record: MessageRecord, update_time: bool = True) -> bool:
+        """
+        从索引中删除一条消息
+        """
+        removed = self._records.get(record.id)
+        if removed is None:
+            return False
+        self._remove_fields(removed, update_time)
+        for term in set(tokenize(removed.content)):
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            postings.discard(removed.id)
+            if not postings:
+                del self._postings[term]
+                self._remove_word(term)
+        return True
+
+    def remove_many(self, records: Iterable[MessageRecord]):
+        # 批量删除时时间索引最后统一过滤一次，避免逐条删除列表元素
+        removed_ids = {record.id for record in records if self.remove(record, update_time=False)}
+        if removed_ids:
+            self._by_time = [entry for entry in self._by_time if entry[1] not in removed_ids]
+
+    def clear(self):
+        self._postings.clear()
+        self._words.clear()
+        self._word_grams.clear()
+        self._records.clear()
+        self._total_length = 0
+        self._by_sender.clear()
+        self._by_conversation.clear()
+        self._by_time = []
+        self._pending.clear()
+        self._pending_count = 0
+        self._pending_max_id = 0
+
+    # ---- 持久化 ----
+
+    def load(self, records: List[MessageRecord], last_id: int) -> bool:
+        """
+        为当前全部消息准备索引：优先读取磁盘上的索引并补上落后的消息，
+        没有可用的磁盘索引时重新建立
+
+        参数:
+        - records: 当前可见的全部消息
+        - last_id: 已分配的最大消息ID（包括已清空的消息）
+
+        返回:
+        - 是否使用了磁盘上的索引
+        """
+        self.clear()
+        manifest = self._read_manifest() if self.index_dir is not None else None
+        records_by_id = {record.id: record for record in records}
+
+        self._segment_sizes = {}
+        if manifest is not None and self._manifest_matches(manifest, records_by_id, last_id):
+            try:
+                for segment in manifest["segments"]:
+                    size = 0
+                    with open(self.index_dir / segment, 'r', encoding='utf-8') as f:
+                        for term, ids in json.load(f).items():
+                            for message_id in ids:
+                                self._add_posting(term, message_id)
+                            size += len(ids)
+                    self._segment_sizes[segment] = size
+            except Exception as e:
+                print(f"⚠️ 读取搜索索引失败，将重新建立: {e}")
+                manifest = None
+        else:
+            manifest = None
+
+        if manifest is None:
+            self.clear()
+            self._segments = []
+            self._segment_sizes = {}
+            self._segment_counter = _segment_number(max(self._list_segment_files(), default=""))
+            self._flushed_max_id = 0
+            for record in records:
+                self._add(record)
+            self.merge()
+            return False
+
+        self._segments = list(manifest["segments"])
+        self._segment_counter = _segment_number(max(self._list_segment_files(), default=""))
+        self._flushed_max_id = manifest["max_id"]
+        for record in records:
+            self._add_fields(record)
+        # 上次退出前还没写入磁盘的消息，只补这一部分
+        missing = [record for record in records if record.id > self._flushed_max_id]
+        if missing:
+            self.add_many(missing)
+            self.flush()
+            print(f"🔎 搜索索引已补上 {len(missing)} 条消息")
+        return True
+
+    def _read_manifest(self) -> Optional[Dict]:
+        manifest_file = self.index_dir / "manifest.json"
+        if not manifest_file.exists():
+            return None
+        try:
+            with open(manifest_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"⚠️ 搜索索引清单损坏，将重新建立: {e}")
+            return None
+
+    def _manifest_matches(self, manifest: Dict, records_by_id: Dict[int, MessageRecord],
+                          last_id: int) -> bool:
+        """
+        检查磁盘索引是否仍然对应当前的消息记录
+        """
+        max_id = manifest.get("max_id", 0)
+        if max_id > last_id:
+            return False
+        record = records_by_id.get(max_id)
+        # 最后一条已索引消息已被清空时无法校验内容，只依赖ID
+        return record is None or manifest.get("checksum") == _checksum(record)
+
+    def _write_manifest(self, max_id: int):
+        record = self._records.get(max_id)
+        manifest = {
+            "segments": self._segments,
+            "max_id": max_id,
+            "checksum": _checksum(record) if record is not None else None
+        }
+        temp_file = self.index_dir / "manifest.json.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(temp_file, self.index_dir / "manifest.json")
+
+    def _list_segment_files(self) -> List[str]:
+        """
+        索引目录中的全部分段文件名，包括中断的合并留下、清单中没有的文件
+        """
+        if self.index_dir is None or not self.index_dir.exists():
+            return []
+        return [path.name for path in self.index_dir.glob("[0-9]*.json")]
+
+    def _new_segment_name(self) -> str:
+        """
+        分配一个新的分段文件名，调用方持有分段锁
+        """
+        self._segment_counter += 1
+        return f"{self._segment_counter:06d}.json"
+
+    def _write_segment(self, name: str, postings: Dict[str, Iterable[int]]) -> int:
+        """
+        写入一个分段文件
+
+        返回:
+        - 分段的大小（索引项数）
+        """
+        postings = {term: sorted(ids) for term, ids in postings.items()}
+        with open(self.index_dir / name, 'w', encoding='utf-8') as f:
+            json.dump(postings, f, ensure_ascii=False)
+        return sum(len(ids) for ids in postings.values())
+
+    def flush(self) -> bool:
+        """
+        把内存中新增的索引写成一个新分段，需要合并时交给后台线程
+        """
+        if self.index_dir is None or not self._pending_count:
+            return True
+        try:
+            self.index_dir.mkdir(parents=True, exist_ok=True)
+            with self._segments_lock:
+                name = self._new_segment_name()
+                self._segment_sizes[name] = self._write_segment(name, self._pending)
+                self._segments.append(name)
+                max_id = max(self._flushed_max_id, self._pending_max_id)
+                self._write_manifest(max_id)
+                self._flushed_max_id = max_id
+            self._pending.clear()
+            self._pending_count = 0
+            self._pending_max_id = 0
+        except Exception as e:
+            print(f"❌ 保存搜索索引时出错: {e}")
+            return False
+        self._schedule_merge()
+        return True
+
+    def _merge_candidates(self) -> List[str]:
+        """
+        需要合并的一组最新分段（见 MERGE_RATIO），不需要合并时为空，调用方持有分段锁
+        """
+        count = 1
+        total = self._segment_sizes.get(self._segments[-1], 0) if self._segments else 0
+        while count < len(self._segments):
+            size = self._segment_sizes.get(self._segments[-count - 1], 0)
+            if size > total * self.MERGE_RATIO:
+                break
+            total += size
+            count += 1
+        return self._segments[-count:] if count > 1 else []
+
+    def _schedule_merge(self):
+        """
+        有需要合并的分段时启动后台合并线程，已在运行时由它继续处理
+        """
+        with self._segments_lock:
+            if self._merge_thread is not None or not self._merge_candidates():
+                return
+            self._merge_thread = threading.Thread(target=self._run_merges, daemon=True)
+            self._merge_thread.start()
+
+    def _run_merges(self):
+        """
+        后台合并线程：依次合并，直到没有需要合并的分段
+        """
+        while True:
+            with self._segments_lock:
+                segments = self._merge_candidates()
+                if not segments:
+                    self._merge_thread = None
+                    return
+                name = self._new_segment_name()
+            if not self._merge_segments(segments, name):
+                # 合并失败时保留原有分段，下次写入分段时再尝试
+                with self._segments_lock:
+                    self._merge_thread = None
+                return
+
+    def _merge_segments(self, segments: List[str], name: str) -> bool:
+        """
+        把一组相邻的分段文件合并为一个，已删除消息的ID不再写入
+        只在替换分段列表和写清单时持有分段锁，读取和写入分段文件期间发送和搜索都不受影响
+        """
+        try:
+            postings: Dict[str, Set[int]] = {}
+            for segment in segments:
+                with open(self.index_dir / segment, 'r', encoding='utf-8') as f:
+                    for term, ids in json.load(f).items():
+                        postings.setdefault(term, set()).update(ids)
+            live = {term: [message_id for message_id in ids if message_id in self._records]
+                    for term, ids in postings.items()}
+            size = self._write_segment(name, {term: ids for term, ids in live.items() if ids})
+            with self._segments_lock:
+                start = self._segments.index(segments[0]) if segments[0] in self._segments else -1
+                if start < 0 or self._segments[start:start + len(segments)] != segments:
+                    # 合并期间索引被整体重建，结果作废
+                    (self.index_dir / name).unlink(missing_ok=True)
+                    return False
+                self._segments[start:start + len(segments)] = [name]
+                for segment in segments:
+                    self._segment_sizes.pop(segment, None)
+                self._segment_sizes[name] = size
+                self._write_manifest(self._flushed_max_id)
+            for segment in segments:
+                (self.index_dir / segment).unlink(missing_ok=True)
+            return True
+        except Exception as e:
+            print(f"❌ 合并搜索索引时出错: {e}")
+            (self.index_dir / name).unlink(missing_ok=True)
+            return False
+
+    def merge(self) -> bool:
+        """
+        用内存中的索引重写为一个分段，已删除消息的ID不再写入（重建索引时使用）
+        """
+        if self.index_dir is None:
+            return True
+        try:
+            self.index_dir.mkdir(parents=True, exist_ok=True)
+            postings = {term: [message_id for message_id in ids if message_id in self._records]
+                        for term, ids in self._postings.items()}
+            with self._segments_lock:
+                old_segments = self._segments
+                name = self._new_segment_name()
+                self._segment_sizes = {name: self._write_segment(name, {term: ids for term, ids in postings.items() if ids})}
+                self._segments = [name]
+                max_id = max([self._flushed_max_id, self._pending_max_id, *self._records], default=0)
+                self._write_manifest(max_id)
+                self._flushed_max_id = max_id
+            self._pending.clear()
+            self._pending_count = 0
+            self._pending_max_id = 0
+            for segment in old_segments:
+                (self.index_dir / segment).unlink(missing_ok=True)
+            return True
+        except Exception as e:
+            print(f"❌ 合并搜索索引时出错: {e}")
+            return False
+
+    def wait_for_merge(self):
+        """
+        等待正在进行的后台合并完成
+        """
+        with self._segments_lock:
+            thread = self._merge_thread
+        if thread is not None:
+            thread.join()
+
+    def close(self):
+        """
+        写入剩余的索引，等待后台合并完成，并停止退出时的自动保存
+        """
+        if self.index_dir is not None:
+            self.flush()
+            self.wait_for_merge()
+            atexit.unregister(self.flush)
+
+    def _term_postings(self, term: str) -> Set[int]:
+        """
+        查询词对应的消息ID集合
+        英文单词可能只是索引词的一部分（如 "math" 匹配 "mathematics"），合并词表中所有包含它的词
+        """
+        if _is_cjk(term):
+            return self._postings.get(term, set())
+        matched = [self._postings[word] for word in self._words_containing(term)]
+        if len(matched) == 1:
+            return matched[0]
+        return set().union(*matched)
+
+    def _words_containing(self, term: str) -> List[str]:
+        """
+        词表中包含 term 的词
+        从 term 的二元组中取候选词最少的一个，只校验这些候选词（term 本身是词时也在其中）
+        """
+        if len(term) == 1:
+            # 单个字符：自身就是词，或者出现在某个二元组中（二元组的种类受字母表大小限制，与词表大小无关）
+            candidates = set(self._word_grams.get(term, ()))
+            for gram, bucket in self._word_grams.items():
+                if len(gram) == 2 and term in gram:
+                    candidates.update(bucket)
+            return list(candidates)
+        buckets = []
+        for gram in _word_grams(term):
+            bucket = self._word_grams.get(gram)
+            if bucket is None:
+                # 有一个二元组从未出现过，不可能有词包含 term
+                return []
+            buckets.append(bucket)
+        smallest = min(buckets, key=len)
+        return [word for word in smallest if term in word]
+
+    def _match(self, keyword: str, conversation_ids: Optional[Set[str]] = None) -> List[MessageRecord]:
+        """
+        内容包含关键词（不区分大小写）的消息，按发送顺序排列
+
+        参数:
+        - keyword: 关键词
+        - conversation_ids: 只保留这些会话中的消息，为空时不限会话；
+          在子串校验之前过滤，其它会话的候选消息不会被校验
+        """
+        needle = keyword.lower()
+        terms = set(query_terms(keyword))
+        if not terms:
+            # 关键词只有标点符号等无法索引的字符，退回逐条扫描
+            return [record for record in self._records.values()
+                    if (conversation_ids is None or record.recipient_id in conversation_ids)
+                    and needle in record.content.lower()]
+
+        # 从最短的倒排表开始求交集，候选集合很快缩小
+        postings = sorted((self._term_postings(term) for term in terms), key=len)
+        candidate_ids = set(postings[0])
+        for other in postings[1:]:
+            if not candidate_ids:
+                break
+            candidate_ids &= other
+
+        # 关键词本身就是一个索引词时候选消息一定匹配；否则各词可能不相邻，需要校验子串
+        verify = terms != {needle}
+        results = []
+        for message_id in sorted(candidate_ids):
+            # 磁盘索引中可能还留着已清空消息的ID
+            record = self._records.get(message_id)
+            if record is None:
+                continue
+            if conversation_ids is not None and record.recipient_id not in conversation_ids:
+                continue
+            if verify and needle not in record.content.lower():
+                continue
+            results.append(record)
+        return results
+
+    def search(self, keyword: str, conversation_id: Optional[str] = None) -> List[MessageRecord]:
+        """
+        搜索内容包含关键词的消息（不区分大小写）
+
+        参数:
+        - keyword: 搜索关键词
+        - conversation_id: 只搜索该会话，为空时搜索全部会话
+
+        返回:
+        - 按发送顺序排列的匹配消息
+        """
+        return self._match(keyword, {conversation_id} if conversation_id is not None else None)
+
+    def search_ranked(self, keyword: str, conversation_id: Optional[str] = None, limit: int = 20,
+                      cursor: Optional[str] = None, now: Optional[float] = None,
+                      conversation_ids: Optional[Set[str]] = None) -> Dict:
+        """
+        按相关度排序的分页搜索
+        关键词按空格拆分，每个词都必须出现；得分为 BM25 乘以时间衰减，
+        同样相关时较新的消息排在前面
+
+        参数:
+        - keyword: 搜索关键词，多个词用空格分隔
+        - conversation_id: 只搜索该会话，为空时搜索全部会话
+        - limit: 每页条数
+        - cursor: 上一页返回的 next_cursor，为空时返回第一页
+        - now: 计算时间衰减的当前时间（秒），默认为当前时间；翻页时沿用游标中的时间
+        - conversation_ids: 只搜索这些会话（如用户有权访问的全部会话），
+          在索引内部过滤，范围外的候选消息不会被校验和打分
+
+        返回:
+        - {"results": [{"message": 消息, "score": 得分, "highlights": [[起始, 结束], ...]}],
+           "next_cursor": 下一页的游标（没有更多时为 None）}
+          highlights 是关键词在消息内容中的字符区间，GUI 可以直接用来高亮
+        """
+        after = None
+        if cursor is not None:
+            try:
+                cursor_now, cursor_score, cursor_id = cursor.split(":")
+                now = float(cursor_now)
+                after = (-float(cursor_score), -int(cursor_id))
+            except (AttributeError, ValueError):
+                raise ValueError(f"无效的搜索游标: {cursor}")
+        if now is None:
+            now = time.time()
+        if conversation_id is not None:
+            conversation_ids = {conversation_id}
+        return self._rank(keyword, conversation_ids, limit, after, now)
+
+    def _rank(self, keyword: str, conversation_ids: Optional[Set[str]], limit: int,
+              after: Optional[tuple], now: float) -> Dict:
+        """
+        对匹配的消息打分并取出一页
+        """
+        terms = list(dict.fromkeys(keyword.lower().split()))
+        if not terms or not self._records:
+            return {"results": [], "next_cursor": None}
+
+        # 每个词匹配的消息；文档频率取搜索范围内的匹配数
+        matches = {term: self._match(term, conversation_ids) for term in terms}
+        by_size = sorted(matches.values(), key=len)
+        candidates = by_size[0]
+        for other in by_size[1:]:
+            if not candidates:
+                break
+            other_ids = {record.id for record in other}
+            candidates = [record for record in candidates if record.id in other_ids]
+
+        total = len(self._records)
+        average_length = self._total_length / total or 1
+        idf = {term: math.log(1 + (total - len(found) + 0.5) / (len(found) + 0.5))
+               for term, found in matches.items()}
+
+        scored = []
+        for record in candidates:
+            content = record.content.lower()
+            length_norm = self.BM25_K1 * (1 - self.BM25_B + self.BM25_B * len(content) / average_length)
+            score = 0.0
+            for term in terms:
+                frequency = content.count(term)
+                score += idf[term] * frequency * (self.BM25_K1 + 1) / (frequency + length_norm)
+            age_days = max(0.0, now - record.ts) / 86400
+            score *= self.DECAY_FLOOR + (1 - self.DECAY_FLOOR) * 0.5 ** (age_days / self.DECAY_HALF_LIFE_DAYS)
+            key = (-score, -record.id)
+            # 游标之前（得分更高）的结果已经在前面的页返回过
+            if after is not None and key <= after:
+                continue
+            scored.append((key, record))
+
+        # 只取出本页和用来判断是否还有下一页的一条，不对全部结果排序
+        page = heapq.nsmallest(max(0, limit) + 1, scored)
+        has_more = len(page) > limit
+        page = page[:limit]
+        results = [{"message": record, "score": -key[0], "highlights": _highlights(record.content, terms)}
+                   for key, record in page]
+        next_cursor = None
+        if has_more and results:
+            last = results[-1]
+            next_cursor = f"{now!r}:{last['score']!r}:{last['message'].id}"
+        return {"results": results, "next_cursor": next_cursor}
+
+
+    def plan_query(self, sender: Optional[str] = None, conversation_ids: Optional[Set[str]] = None,
+                   start: Optional[int] = None, end: Optional[int] = None,
+                   keywords: Optional[List[str]] = None, match_all: bool = True) -> str:
+        """
+        为组合条件查询选择最有选择性的索引
+
+        返回:
+        - "sender"、"conversation"、"time"、"text" 之一，没有任何条件时为 "scan"
+        """
+        estimates = {}
+        if sender is not None:
+            estimates["sender"] = len(self._by_sender.get(sender, ()))
+        if conversation_ids is not None:
+            estimates["conversation"] = sum(len(self._by_conversation.get(cid, ()))
+                                            for cid in conversation_ids)
+        if start is not None or end is not None:
+            low, high = self._time_range(start, end)
+            estimates["time"] = high - low
+        if keywords:
+            # AND 取匹配最少的关键词，OR 取各关键词之和
+            sizes = [self._estimate_matches(keyword) for keyword in keywords]
+            estimates["text"] = min(sizes) if match_all else sum(sizes)
+        if not estimates:
+            return "scan"
+        return min(estimates, key=estimates.get)
+
+    def _estimate_matches(self, keyword: str) -> int:
+        """
+        用关键词最短的倒排表估计匹配数（上限）
+        """
+        terms = set(query_terms(keyword))
+        if not terms:
+            return len(self._records)
+        return min(len(self._term_postings(term)) for term in terms)
+
+    def _time_range(self, start: Optional[int], end: Optional[int]) -> tuple:
+        """
+        时间索引中 [start, end] 对应的下标区间
+        """
+        low = bisect.bisect_left(self._by_time, (start, 0)) if start is not None else 0
+        high = bisect.bisect_right(self._by_time, (end, float("inf"))) if end is not None else len(self._by_time)
+        return low, max(low, high)
+
+    def query(self, sender: Optional[str] = None, conversation_ids: Optional[Set[str]] = None,
+              start=None, end=None, keywords: Optional[List[str]] = None, match_all: bool = True,
+              limit: Optional[int] = None) -> List[MessageRecord]:
+        """
+        组合条件查询，例如 "小明上周在数学群里说了什么"
+
+        参数:
+        - sender: 发送者
+        - conversation_ids: 限定的会话ID集合
+        - start / end: 时间范围（含两端），可以是 "YYYY-mm-dd HH:MM:SS"、datetime 或整数时间戳
+        - keywords: 关键词列表（不区分大小写的子串匹配）
+        - match_all: True 时所有关键词都要出现（AND），False 时出现任意一个即可（OR）
+        - limit: 只返回最新的 limit 条
+
+        返回:
+        - 按发送顺序排列的匹配消息
+        """
+        start, end = _to_ts(start), _to_ts(end)
+        keywords = [keyword.lower() for keyword in keywords or [] if keyword and keyword.strip()]
+        plan = self.plan_query(sender, conversation_ids, start, end, keywords, match_all)
+
+        # 先用选中的索引取出候选消息，其余条件逐条检查
+        if plan == "sender":
+            candidate_ids = self._by_sender.get(sender, set())
+        elif plan == "conversation":
+            candidate_ids = set().union(*(self._by_conversation.get(cid, set()) for cid in conversation_ids))
+        elif plan == "time":
+            low, high = self._time_range(start, end)
+            candidate_ids = [message_id for _, message_id in self._by_time[low:high]]
+        elif plan == "text":
+            if match_all:
+                # AND 只需取匹配最少的那个关键词，其余关键词在下面逐条检查
+                keyword = min(keywords, key=self._estimate_matches)
+                candidate_ids = [record.id for record in self._match(keyword, conversation_ids)]
+            else:
+                candidate_ids = set()
+                for keyword in keywords:
+                    candidate_ids.update(record.id for record in self._match(keyword, conversation_ids))
+        else:
+            candidate_ids = self._records.keys()
+
+        results = []
+        for message_id in sorted(candidate_ids):
+            record = self._records.get(message_id)
+            if record is None:
+                continue
+            if sender is not None and record.sender != sender:
+                continue
+            if conversation_ids is not None and record.recipient_id not in conversation_ids:
+                continue
+            if (start is not None and record.ts < start) or (end is not None and record.ts > end):
+                continue
+            if keywords:
+                content = record.content.lower()
+                found = (keyword in content for keyword in keywords)
+                if not (all(found) if match_all else any(found)):
+                    continue
+            results.append(record)
+        if limit is not None:
+            results = results[-limit:] if limit > 0 else []
+        return results
+
+def _highlights(content: str, terms: List[str]) -> List[List[int]]:
+    """
+    关键词在内容中出现的字符区间 [起始, 结束)，重叠的区间合并
+    """
+    lowered = content.lower()
+    spans = []
+    for term in terms:
+        start = lowered.find(term)
+        while start != -1:
+            spans.append([start, start + len(term)])
+            start = lowered.find(term, start + 1)
+    spans.sort()
+    merged: List[List[int]] = []
+    for span in spans:
+        if merged and span[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], span[1])
+        else:
+            merged.append(span)
+    return merged
+
+
+def _word_grams(word: str) -> Set[str]:
+    """
+    英文/数字词的二元组，单字符的词返回自身
+    """
+    if len(word) == 1:
+        return {word}
+    return {word[i:i + 2] for i in range(len(word) - 1)}
+
+
+def _segment_number(name: str) -> int:
+    """
+    分段文件名中的编号，"000012.json" -> 12
+    """
+    return int(name.split(".")[0]) if name else 0
+
+
+def _checksum(record: MessageRecord) -> int:
+    return zlib.crc32(f"{record.recipient_id}\x00{record.seq}\x00{record.content}".encode("utf-8"))
+
+
+def _is_cjk(term: str) -> bool:
+    return _CJK_PATTERN.match(term) is not None
+
+
+def _to_ts(value) -> Optional[int]:
+    """
+    把查询中的时间条件统一为整数时间戳
+    """
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    if isinstance(value, float):
+        return int(value)
+    ts = parse_timestamp(value)
+    if not ts:
+        raise ValueError(f"无效的时间: {value}")
+    return ts
@@ -0,0 +1,95 @@
+# SharedDocument.py
+import threading
+import time
+import weakref
+from StorageBackend import StorageBackend
+
+class SharedDocument:
+    """
+    进程内共享的文档副本（GroupStore、FriendGraph 的基类）
+    同一份数据（见 StorageBackend.location）上每个子类只有一个实例，见 shared；
+    通过存储后端的文档版本（JSON 文件的修改时间、SQLite 的版本号）发现其他进程的修改并重新加载：
+    子类在修改前调用 refresh(force=True)，读取时调用 refresh()，最多每 CHECK_INTERVAL 秒检查一次
+
+    子类需要设置 DOCUMENT_NAME、DOCUMENT_LABEL 并实现 _load（结尾调用 _remember_version）
+    """
+
+    # 文档名，以及提示信息中使用的名称
+    DOCUMENT_NAME = ""
+    DOCUMENT_LABEL = ""
+
+    # 读取时检查文档版本的最小间隔（秒），避免每次读取都访问文件系统
+    CHECK_INTERVAL = 1.0
+
+    # 进程内共享的实例：(子类, 数据位置) -> 实例，没有使用者后自动移除
+    _shared: "weakref.WeakValueDictionary[tuple, SharedDocument]" = weakref.WeakValueDictionary()
+    # 可重入：创建 FriendGraph 时会在锁内获取共享的 GroupStore
+    _shared_lock = threading.RLock()
+
+    @classmethod
+    def shared(cls, storage: StorageBackend):
+        """
+        获取存储后端所在数据位置的共享实例，不存在时创建并加载
+        """
+        key = (cls, storage.location() or storage)
+        with SharedDocument._shared_lock:
+            instance = SharedDocument._shared.get(key)
+            if instance is None:
+                instance = cls(storage)
+                SharedDocument._shared[key] = instance
+            return instance
+
+    def __init__(self, storage: StorageBackend):
+        """
+        参数:
+        - storage: 负责持久化的存储后端
+        """
+        self.storage = storage
+        # 最近一次加载或保存时的文档版本，以及上次检查的时间
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.RLock()
+
+    def _load(self):
+        """
+        从存储后端加载文档，由子类实现
+        """
+        raise NotImplementedError
+
+    def _reloaded(self):
+        """
+        被其他进程修改后重新加载完成时调用，子类可以在这里通知订阅者
+        """
+        pass
+
+    def _remember_version(self):
+        """
+        记录当前的文档版本（加载或保存之后调用）
+        """
+        self._version = self.storage.document_version(self.DOCUMENT_NAME)
+        self._checked_at = time.monotonic()
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        文档被其他进程修改过时重新加载
+        force 为 False 时距上次检查不足 CHECK_INTERVAL 秒直接跳过
+
+        返回:
+        - 是否重新加载了数据
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._checked_at < self.CHECK_INTERVAL:
+                return False
+            self._checked_at = now
+            try:
+                version = self.storage.document_version(self.DOCUMENT_NAME)
+            except Exception as e:
+                print(f"❌ 检查{self.DOCUMENT_LABEL}版本失败: {e}")
+                return False
+            if version is None or version == self._version:
+                return False
+            print(f"🔄 {self.DOCUMENT_LABEL}已被其他进程修改，重新加载")
+            self._load()
+            self._reloaded()
+            return True
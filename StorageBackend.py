@@ -0,0 +1,1051 @@
+# StorageBackend.py
+import atexit
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote
+from typing import List, Dict, Optional, Iterable, Callable
+from MessageLog import MessageLog
+from MessageRecord import MessageRecord, assign_missing_ids
+
+def _json_default(value):
+    """
+    文档序列化时把集合（好友集合、群成员集合）保存为有序列表，
+    文件格式与列表版本保持一致
+    """
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"无法序列化 {type(value).__name__} 类型的值")
+
+def _apply_edges(data: Dict, edges: Iterable[Dict]) -> Dict:
+    """
+    把边变更重放到文档上
+    每条边为 {"op": "add" 或 "remove", "key": 条目键, "value": 元素, "field": 可选字段名}，
+    表示向 data[key]（或 data[key][field]）这个列表中加入或移除一个元素；
+    加入和移除都是幂等的，重复重放同一段日志结果不变
+    """
+    for edge in edges:
+        key, value, field = edge.get("key"), edge.get("value"), edge.get("field")
+        if field is None:
+            if edge.get("op") == "add":
+                items = data.setdefault(key, [])
+            else:
+                items = data.get(key)
+        else:
+            entry = data.get(key)
+            items = entry.setdefault(field, []) if isinstance(entry, dict) else None
+        if items is None:
+            continue
+        if edge.get("op") == "add":
+            if value not in items:
+                items.append(value)
+        elif value in items:
+            items.remove(value)
+    return data
+
+class StorageBackend:
+    """
+    存储后端接口
+    所有管理器（用户、好友、群组、聊天）通过同一个接口读写数据，
+    具体存储到JSON文件还是SQLite数据库由实现类决定
+
+    数据分为两类：
+    - 文档：users / friends / groups 这类 "键 -> 值" 的字典
+    - 消息：按发送顺序排列的聊天记录
+    """
+
+    def load_document(self, name: str) -> Optional[Dict]:
+        """
+        读取整个文档，不存在时返回 None
+        """
+        raise NotImplementedError
+
+    def save_document(self, name: str, data: Dict) -> bool:
+        """
+        整体保存文档
+        """
+        raise NotImplementedError
+
+    def save_entries(self, name: str, data: Dict, keys: Iterable[str]) -> bool:
+        """
+        只保存文档中发生变化的键
+        data 中已不存在的键视为删除；不支持按键写入的后端会整体保存 data
+        """
+        return self.save_document(name, data)
+
+    def save_edges(self, name: str, data: Dict, edges: List[Dict]) -> bool:
+        """
+        保存好友关系、群成员这类集合文档中单个元素的增删（格式见 _apply_edges）
+        data 是变更后的完整文档；支持变更日志的后端只追加这几条边，
+        其他后端按变更涉及的键保存
+        """
+        return self.save_entries(name, data, list(dict.fromkeys(edge["key"] for edge in edges)))
+
+    def document_version(self, name: str):
+        """
+        文档的版本标记，文档被（包括其他进程）修改后会变化，用于判断内存副本是否过期
+        文档不存在时返回 None；不支持版本检测的后端也返回 None
+        """
+        return None
+
+    def location(self) -> Optional[tuple]:
+        """
+        数据所在位置的标识：(存储模式, 解析后的路径)
+        进程内的共享仓库按它区分，同一份数据上的不同后端实例共用一个仓库；
+        无法确定时返回 None，只与同一个后端实例共享
+        """
+        return None
+
+    def search_index_dir(self) -> Optional[Path]:
+        """
+        搜索索引的持久化目录，为空时索引只保存在内存中
+        """
+        return None
+
+    def load_messages(self) -> Optional[List[Dict]]:
+        """
+        读取全部消息，消息存储尚未创建时返回 None
+        """
+        raise NotImplementedError
+
+    def load_recent_messages(self, limit: int) -> Optional[List[Dict]]:
+        """
+        只读取每个会话最新的 limit 条消息（按ID排序），用于快速启动
+        不支持按会话读取的后端返回 None，调用方应改为 load_messages
+        """
+        return None
+
+    def load_conversation_messages(self, conversation_id: str, before_seq: Optional[int] = None,
+                                   limit: Optional[int] = None) -> List[Dict]:
+        """
+        读取一个会话中 seq 小于 before_seq 的最新 limit 条消息（按发送顺序）
+        before_seq 为空时从最新消息开始，limit 为空时不限条数
+        """
+        messages = [msg for msg in self.load_messages() or []
+                    if msg.get("recipient_id") == conversation_id
+                    and (before_seq is None or msg.get("seq", 0) < before_seq)]
+        return messages[-limit:] if limit else messages
+
+    def append_message(self, message: Dict, all_messages: Callable[[], List[Dict]]) -> bool:
+        """
+        追加一条新消息
+
+        参数:
+        - message: 新消息
+        - all_messages: 返回包含新消息在内全部消息的函数，只有需要整体重写的后端才会调用
+        """
+        raise NotImplementedError
+
+    def append_messages(self, messages: List[Dict], all_messages: Callable[[], List[Dict]],
+                        fsync: bool = False) -> bool:
+        """
+        一次追加多条新消息（批量提交）
+
+        参数:
+        - messages: 新消息列表
+        - all_messages: 同 append_message
+        - fsync: 写入后是否强制刷盘
+        """
+        return all(self.append_message(message, all_messages) for message in messages)
+
+    def appends_need_all_messages(self) -> bool:
+        """
+        追加新消息时是否需要调用 all_messages 整体重写（如 messages.json）
+        """
+        return False
+
+    def save_messages(self, messages: List[Dict]) -> bool:
+        """
+        用给定列表整体替换全部消息
+        """
+        raise NotImplementedError
+
+    def flush(self) -> bool:
+        """
+        把尚未写入的数据写入存储，默认后端都是同步写入，无需处理
+        """
+        return True
+
+    def compact_messages(self, watermarks: Dict[str, int],
+                         remaining_messages: Callable[[], List[Dict]]) -> bool:
+        """
+        压缩消息存储：物理删除已被清空（墓碑）隐藏的消息
+
+        参数:
+        - watermarks: 会话ID -> 清空水位线，seq 不超过水位线的消息会被删除
+        - remaining_messages: 返回压缩后剩余消息的函数，只有需要整体重写的后端才会调用
+
+        MessageStore 在自己的锁外调用，压缩期间可能同时有新消息追加，实现需要保证它们不丢失
+        """
+        return self.save_messages(remaining_messages())
+
+    def close(self):
+        """
+        释放后端占用的资源
+        """
+        pass
+
+
+class JSONStorageBackend(StorageBackend):
+    """
+    JSON文件存储后端（默认）
+    每个文档对应 data_dir 下的一个 <name>.json 文件；
+    消息可以保存为整体重写的 messages.json，或追加式的 messages.jsonl
+
+    好友、群成员的增删（save_edges）只追加到 <name>.log.jsonl 变更日志，
+    不重写整个文档；日志累积 SNAPSHOT_INTERVAL 条后写一次快照并清空日志。
+    读取文档时先读快照再重放日志
+    """
+
+    MESSAGE_FORMATS = ("json", "jsonl")
+
+    # 变更日志累积多少条后写一次完整快照
+    SNAPSHOT_INTERVAL = 1000
+
+    def __init__(self, data_dir="data", message_format="json"):
+        """
+        初始化JSON存储后端
+
+        参数:
+        - data_dir: 数据存储目录
+        - message_format: 消息文件格式，"json" 或 "jsonl"
+        """
+        if message_format not in self.MESSAGE_FORMATS:
+            raise ValueError(f"不支持的消息格式: {message_format}")
+
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(exist_ok=True)
+        self.message_format = message_format
+        self.messages_file = self.data_dir / "messages.json"
+        self.message_log = None
+        # 消息文件的写锁：追加、整体重写和压缩的最后替换互斥
+        self._write_lock = threading.RLock()
+        # 每个文档的变更日志当前条数，第一次用到时统计
+        self._edge_counts: Dict[str, int] = {}
+        if message_format == "jsonl":
+            self.message_log = MessageLog(self.data_dir / "messages.jsonl")
+            # 首次使用日志格式时，从旧版 messages.json 迁移历史消息
+            self.message_log.migrate_from_json(self.messages_file)
+
+    def _document_file(self, name: str) -> Path:
+        return self.data_dir / f"{name}.json"
+
+    def _edge_log_file(self, name: str) -> Path:
+        return self.data_dir / f"{name}.log.jsonl"
+
+    def _load_edges(self, name: str) -> List[Dict]:
+        """
+        读取文档的变更日志，最后一行如果因为异常退出而不完整，会被忽略
+        """
+        return MessageLog(self._edge_log_file(name)).load()
+
+    def load_document(self, name: str) -> Optional[Dict]:
+        document_file = self._document_file(name)
+        data = None
+        if document_file.exists():
+            with open(document_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        # 重放快照之后的变更
+        edges = self._load_edges(name)
+        self._edge_counts[name] = len(edges)
+        if edges:
+            data = _apply_edges(data if data is not None else {}, edges)
+        return data
+
+    def document_version(self, name: str):
+        # 快照和变更日志的修改时间和大小，其他进程写入后会变化
+        version = []
+        for path in (self._document_file(name), self._edge_log_file(name)):
+            try:
+                stat = path.stat()
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version) if version[0] is not None or version[1] is not None else None
+
+    def save_document(self, name: str, data: Dict) -> bool:
+        try:
+            # 先写临时文件再替换，写到一半退出不会留下损坏的快照
+            document_file = self._document_file(name)
+            temp_file = document_file.with_name(document_file.name + ".tmp")
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2, default=_json_default)
+            os.replace(temp_file, document_file)
+            # 快照已包含全部变更，清空变更日志
+            self._edge_log_file(name).unlink(missing_ok=True)
+            self._edge_counts[name] = 0
+            return True
+        except Exception as e:
+            print(f"❌ 保存 {name} 数据时出错: {e}")
+            return False
+
+    def save_edges(self, name: str, data: Dict, edges: List[Dict]) -> bool:
+        if name not in self._edge_counts:
+            self._edge_counts[name] = len(self._load_edges(name))
+        # 与消息日志共用追加逻辑：写入前截掉上次中断留下的残行
+        if not MessageLog(self._edge_log_file(name)).append_many(edges):
+            print(f"❌ 保存 {name} 变更日志时出错")
+            return False
+        self._edge_counts[name] += len(edges)
+        if self._edge_counts[name] >= self.SNAPSHOT_INTERVAL:
+            # 快照失败时日志仍然完整，下次再试
+            self.save_document(name, data)
+        return True
+
+    def load_messages(self) -> Optional[List[Dict]]:
+        if self.message_log is not None:
+            return self.message_log.load() if self.message_log.exists() else None
+        if not self.messages_file.exists():
+            return None
+        with open(self.messages_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def append_message(self, message: Dict, all_messages: Callable[[], List[Dict]]) -> bool:
+        return self.append_messages([message], all_messages)
+
+    def append_messages(self, messages: List[Dict], all_messages: Callable[[], List[Dict]],
+                        fsync: bool = False) -> bool:
+        if self.message_log is not None:
+            with self._write_lock:
+                return self.message_log.append_many(messages, fsync)
+        # messages.json 只能整体重写，一批消息只重写一次
+        return self.save_messages(all_messages(), fsync)
+
+    def appends_need_all_messages(self) -> bool:
+        return self.message_log is None
+
+    def location(self) -> Optional[tuple]:
+        return self.message_format, str(self.data_dir.resolve())
+
+    def search_index_dir(self) -> Optional[Path]:
+        return self.data_dir / "search_index"
+
+    def save_messages(self, messages: List[Dict], fsync: bool = False) -> bool:
+        with self._write_lock:
+            if self.message_log is not None:
+                return self.message_log.rewrite(messages, fsync)
+            try:
+                with open(self.messages_file, 'w', encoding='utf-8') as f:
+                    json.dump(messages, f, ensure_ascii=False, indent=2)
+                    if fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                return True
+            except Exception as e:
+                print(f"❌ 保存聊天记录时出错: {e}")
+                return False
+
+    def compact_messages(self, watermarks: Dict[str, int],
+                         remaining_messages: Callable[[], List[Dict]]) -> bool:
+        """
+        直接按水位线过滤消息文件，不使用仓库的剩余消息快照
+        messages.jsonl 在写锁外过滤重写，只在最后补上期间追加的行并替换时持有写锁；
+        messages.json 每次发送本来就整体重写，在写锁内过滤重写
+        """
+        def keep(message: Dict) -> bool:
+            conversation_id = message.get("recipient_id")
+            return conversation_id not in watermarks or message.get("seq", 0) > watermarks[conversation_id]
+
+        if self.message_log is not None:
+            return self.message_log.compact(keep, self._write_lock)
+        with self._write_lock:
+            try:
+                messages = self.load_messages()
+            except Exception as e:
+                print(f"❌ 压缩聊天记录时出错: {e}")
+                return False
+            if messages is None:
+                return True
+            return self.save_messages([message for message in messages if keep(message)])
+
+
+class SegmentedStorageBackend(JSONStorageBackend):
+    """
+    按会话分段的消息存储
+    每个会话的消息存放在 data/messages/<会话>/ 目录下的分段日志文件中，
+    当前分段超过 max_segment_bytes 后切换到新分段；
+    写入或压缩一个会话只会触及该会话的最新分段，不受广播室等大会话影响
+    文档（用户、好友、群组）仍然保存为JSON文件
+
+    会话目录名在不区分大小写的文件系统（Windows）上也不会冲突，见 conversation_dir；
+    旧版按原样URL编码的目录在启动时整体重写一次
+    """
+
+    # 目录名编码的版本，记录在 messages/FORMAT 中
+    LAYOUT_VERSION = "2"
+
+    def __init__(self, data_dir="data", max_segment_bytes=1024 * 1024):
+        """
+        初始化分段存储后端
+
+        参数:
+        - data_dir: 数据存储目录
+        - max_segment_bytes: 单个分段文件的大小上限（字节）
+        """
+        super().__init__(data_dir)
+        self.max_segment_bytes = max_segment_bytes
+        self.messages_dir = self.data_dir / "messages"
+        # 会话ID -> 当前写入的分段日志
+        self._active_segments: Dict[str, MessageLog] = {}
+        self._lock = threading.RLock()
+
+        # 首次使用分段存储时，从 messages.jsonl 或 messages.json 迁移历史消息
+        if not self.messages_dir.exists():
+            message_format = "jsonl" if (self.data_dir / "messages.jsonl").exists() else "json"
+            legacy_messages = JSONStorageBackend(self.data_dir, message_format).load_messages()
+            if legacy_messages is not None:
+                # 拆分到各会话之前先按文件顺序编号，之后按ID排序才能恢复原来的发送顺序
+                records = [MessageRecord.from_dict(msg) for msg in legacy_messages]
+                assign_missing_ids(records)
+                self.save_messages([record.to_dict() for record in records])
+                print(f"✅ 已将 {len(legacy_messages)} 条历史消息迁移到分段存储")
+        elif not self._layout_file().exists():
+            # 旧版目录名保留了大小写，Alice 和 alice 在 Windows 上会落到同一个目录
+            self.save_messages(self.load_messages())
+            print("✅ 已将分段存储的会话目录转换为不区分大小写的命名")
+        if not self.messages_dir.exists():
+            self.messages_dir.mkdir()
+            self._layout_file().write_text(self.LAYOUT_VERSION, encoding='utf-8')
+
+    def _layout_file(self, messages_dir: Optional[Path] = None) -> Path:
+        return (messages_dir or self.messages_dir) / "FORMAT"
+
+    def conversation_dir(self, conversation_id: str) -> Path:
+        """
+        会话的分段目录，会话ID经过URL编码以保证是合法的文件名
+        编码结果只含小写字母：大写字母写成 "^" 加小写字母（"^" 本身会被URL编码），
+        %XX 中的十六进制也写成小写，不区分大小写的文件系统上不同会话不会共用目录
+        """
+        if conversation_id is None:
+            return self.messages_dir / "%00"
+        name = re.sub(r"%[0-9A-F]{2}|[A-Z]",
+                      lambda match: match.group().lower() if match.group().startswith("%")
+                      else "^" + match.group().lower(),
+                      quote(conversation_id, safe=""))
+        return self.messages_dir / name
+
+    def _segment_files(self, conversation_dir: Path) -> List[Path]:
+        return sorted(conversation_dir.glob("*.jsonl"))
+
+    def _active_segment(self, conversation_id: str) -> MessageLog:
+        """
+        获取会话当前写入的分段，超过大小上限时切换到新分段
+        """
+        segment = self._active_segments.get(conversation_id)
+        if segment is None:
+            conversation_dir = self.conversation_dir(conversation_id)
+            conversation_dir.mkdir(parents=True, exist_ok=True)
+            files = self._segment_files(conversation_dir)
+            segment = MessageLog(files[-1] if files else conversation_dir / "000001.jsonl")
+            self._active_segments[conversation_id] = segment
+
+        if segment.exists() and segment.log_file.stat().st_size >= self.max_segment_bytes:
+            next_index = int(segment.log_file.stem) + 1
+            segment = MessageLog(segment.log_file.with_name(f"{next_index:06d}.jsonl"))
+            self._active_segments[conversation_id] = segment
+        return segment
+
+    def load_conversation_messages(self, conversation_id: str, before_seq: Optional[int] = None,
+                                   limit: Optional[int] = None) -> List[Dict]:
+        """
+        从最新分段往前读取，凑够 limit 条后停止，不会读取更早的分段
+        """
+        messages: List[Dict] = []
+        for segment_file in reversed(self._segment_files(self.conversation_dir(conversation_id))):
+            segment = [msg for msg in MessageLog(segment_file).load()
+                       if msg.get("recipient_id") == conversation_id
+                       and (before_seq is None or msg.get("seq", 0) < before_seq)]
+            messages[:0] = segment
+            if limit and len(messages) >= limit:
+                return messages[-limit:]
+        return messages
+
+    def load_recent_messages(self, limit: int) -> Optional[List[Dict]]:
+        if not self.messages_dir.exists():
+            return None
+        messages = []
+        for conversation_dir in sorted(self.messages_dir.iterdir()):
+            if conversation_dir.is_dir():
+                recent = []
+                for segment_file in reversed(self._segment_files(conversation_dir)):
+                    recent[:0] = MessageLog(segment_file).load()
+                    if len(recent) >= limit:
+                        break
+                messages.extend(recent[-limit:])
+        messages.sort(key=lambda msg: msg.get("id", 0))
+        return messages
+
+    def load_messages(self) -> Optional[List[Dict]]:
+        if not self.messages_dir.exists():
+            return None
+        messages = []
+        for conversation_dir in sorted(self.messages_dir.iterdir()):
+            if conversation_dir.is_dir():
+                for segment_file in self._segment_files(conversation_dir):
+                    messages.extend(MessageLog(segment_file).load())
+        # 各会话分别存储，按全局ID恢复发送顺序
+        messages.sort(key=lambda msg: msg.get("id", 0))
+        return messages
+
+    def appends_need_all_messages(self) -> bool:
+        return False
+
+    def location(self) -> Optional[tuple]:
+        return "segmented", str(self.data_dir.resolve())
+
+    def append_messages(self, messages: List[Dict], all_messages: Callable[[], List[Dict]],
+                        fsync: bool = False) -> bool:
+        by_conversation: Dict[str, List[Dict]] = {}
+        for message in messages:
+            by_conversation.setdefault(message.get("recipient_id"), []).append(message)
+        with self._lock:
+            return all(self._active_segment(cid).append_many(batch, fsync)
+                       for cid, batch in by_conversation.items())
+
+    def save_messages(self, messages: List[Dict], fsync: bool = False) -> bool:
+        by_conversation: Dict[str, List[Dict]] = {}
+        for message in messages:
+            by_conversation.setdefault(message.get("recipient_id"), []).append(message)
+        with self._lock:
+            try:
+                # 先写到临时目录，完成后再替换，避免写到一半时丢失原数据
+                temp_dir = self.data_dir / "messages.tmp"
+                if temp_dir.exists():
+                    shutil.rmtree(temp_dir)
+                temp_dir.mkdir()
+                self._layout_file(temp_dir).write_text(self.LAYOUT_VERSION, encoding='utf-8')
+                for cid, batch in by_conversation.items():
+                    conversation_dir = temp_dir / self.conversation_dir(cid).name
+                    conversation_dir.mkdir()
+                    if not self._write_segments(conversation_dir, batch, fsync):
+                        return False
+                if self.messages_dir.exists():
+                    shutil.rmtree(self.messages_dir)
+                os.replace(temp_dir, self.messages_dir)
+                self._active_segments = {}
+                return True
+            except Exception as e:
+                print(f"❌ 保存聊天记录时出错: {e}")
+                return False
+
+    def _write_segments(self, conversation_dir: Path, messages: List[Dict], fsync: bool) -> bool:
+        """
+        把一个会话的消息按大小上限切分写入分段文件
+        """
+        index, batch, batch_bytes = 1, [], 0
+        for message in messages:
+            batch.append(message)
+            batch_bytes += len(json.dumps(message, ensure_ascii=False).encode("utf-8")) + 1
+            if batch_bytes >= self.max_segment_bytes:
+                if not MessageLog(conversation_dir / f"{index:06d}.jsonl").rewrite(batch, fsync):
+                    return False
+                index, batch, batch_bytes = index + 1, [], 0
+        if batch:
+            return MessageLog(conversation_dir / f"{index:06d}.jsonl").rewrite(batch, fsync)
+        return True
+
+    def compact_messages(self, watermarks: Dict[str, int],
+                         remaining_messages: Callable[[], List[Dict]]) -> bool:
+        with self._lock:
+            try:
+                for cid, watermark in watermarks.items():
+                    conversation_dir = self.conversation_dir(cid)
+                    self._active_segments.pop(cid, None)
+                    for segment_file in self._segment_files(conversation_dir):
+                        segment = MessageLog(segment_file)
+                        # 只删除这个会话的消息，不依赖目录名一定只对应一个会话
+                        kept = [msg for msg in segment.load()
+                                if msg.get("recipient_id") != cid or msg.get("seq", 0) > watermark]
+                        if not kept:
+                            segment_file.unlink()
+                        elif not segment.rewrite(kept):
+                            return False
+                    # 会话已没有任何消息时删除整个目录
+                    if conversation_dir.exists() and not self._segment_files(conversation_dir):
+                        shutil.rmtree(conversation_dir)
+                return True
+            except Exception as e:
+                print(f"❌ 压缩聊天记录时出错: {e}")
+                return False
+
+    def drop_conversation(self, conversation_id: str) -> bool:
+        """
+        直接删除一个会话的全部分段（例如解散群组时）
+        """
+        with self._lock:
+            self._active_segments.pop(conversation_id, None)
+            try:
+                shutil.rmtree(self.conversation_dir(conversation_id), ignore_errors=True)
+                return True
+            except Exception as e:
+                print(f"❌ 删除会话消息时出错: {e}")
+                return False
+
+
+class SQLiteStorageBackend(StorageBackend):
+    """
+    SQLite存储后端（标准库 sqlite3，WAL模式）
+    文档按 (name, key) 逐行存储，修改一个用户或一个群组只写一行；
+    消息逐条插入，并在 recipient_id、sender 和 timestamp 上建立索引
+    """
+
+    def __init__(self, data_dir="data", db_name="chat.db"):
+        """
+        初始化SQLite存储后端
+
+        参数:
+        - data_dir: 数据存储目录
+        - db_name: 数据库文件名
+        """
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(exist_ok=True)
+        self.db_file = self.data_dir / db_name
+        is_new = not self.db_file.exists()
+
+        # GUI 在后台线程发送消息，连接需跨线程共享，用锁串行化访问
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(str(self.db_file), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+        # 新建数据库时导入同目录下已有的JSON数据
+        if is_new:
+            self._import_json_files()
+
+    def _create_schema(self):
+        with self._lock, self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    name TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (name, key)
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sender TEXT NOT NULL,
+                    recipient_id TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    payload TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_messages_recipient ON messages (recipient_id, id);
+                CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender, id);
+                CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+
+    def _import_json_files(self):
+        """
+        从JSON文件后端导入已有数据，便于从默认存储平滑切换
+        """
+        message_format = "jsonl" if (self.data_dir / "messages.jsonl").exists() else "json"
+        json_backend = JSONStorageBackend(self.data_dir, message_format=message_format)
+        for name in ("users", "friends", "groups", "tombstones", "read_marks"):
+            try:
+                data = json_backend.load_document(name)
+            except Exception as e:
+                print(f"⚠️ 导入 {name}.json 失败: {e}")
+                continue
+            if data is not None:
+                self.save_document(name, data)
+        try:
+            messages = json_backend.load_messages()
+        except Exception as e:
+            print(f"⚠️ 导入 messages.json 失败: {e}")
+            messages = None
+        if messages is not None:
+            self.save_messages(messages)
+            print(f"✅ 已将 {len(messages)} 条历史消息导入 {self.db_file.name}")
+
+    def _has_document(self, name: str) -> bool:
+        row = self.conn.execute("SELECT 1 FROM meta WHERE key = ?", (f"document:{name}",)).fetchone()
+        return row is not None
+
+    def _bump_document_version(self, name: str):
+        """
+        文档每次写入后版本号加一（meta 表中 document:<name> 的值）
+        """
+        self.conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+            (f"document:{name}",)
+        )
+
+    def document_version(self, name: str):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (f"document:{name}",)).fetchone()
+        return row[0] if row is not None else None
+
+    def location(self) -> Optional[tuple]:
+        return "sqlite", str(self.db_file.resolve())
+
+    def search_index_dir(self) -> Optional[Path]:
+        return self.data_dir / "search_index"
+
+    def load_document(self, name: str) -> Optional[Dict]:
+        with self._lock:
+            if not self._has_document(name):
+                return None
+            rows = self.conn.execute(
+                "SELECT key, value FROM documents WHERE name = ?", (name,)
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_document(self, name: str, data: Dict) -> bool:
+        try:
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM documents WHERE name = ?", (name,))
+                self.conn.executemany(
+                    "INSERT INTO documents (name, key, value) VALUES (?, ?, ?)",
+                    [(name, key, json.dumps(value, ensure_ascii=False, default=_json_default))
+                     for key, value in data.items()]
+                )
+                self._bump_document_version(name)
+            return True
+        except Exception as e:
+            print(f"❌ 保存 {name} 数据时出错: {e}")
+            return False
+
+    def save_entries(self, name: str, data: Dict, keys: Iterable[str]) -> bool:
+        try:
+            with self._lock, self.conn:
+                for key in keys:
+                    if key in data:
+                        self.conn.execute(
+                            "INSERT OR REPLACE INTO documents (name, key, value) VALUES (?, ?, ?)",
+                            (name, key, json.dumps(data[key], ensure_ascii=False, default=_json_default))
+                        )
+                    else:
+                        self.conn.execute(
+                            "DELETE FROM documents WHERE name = ? AND key = ?", (name, key)
+                        )
+                self._bump_document_version(name)
+            return True
+        except Exception as e:
+            print(f"❌ 保存 {name} 数据时出错: {e}")
+            return False
+
+    def load_messages(self) -> Optional[List[Dict]]:
+        with self._lock:
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = 'messages'").fetchone() is None:
+                return None
+            rows = self.conn.execute("SELECT payload FROM messages ORDER BY id").fetchall()
+        return [json.loads(payload) for (payload,) in rows]
+
+    def load_recent_messages(self, limit: int) -> Optional[List[Dict]]:
+        with self._lock:
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = 'messages'").fetchone() is None:
+                return None
+            # 借助 (recipient_id, id) 索引，每个会话只取最新的 limit 行
+            rows = self.conn.execute(
+                """SELECT payload FROM (
+                       SELECT payload, id, ROW_NUMBER() OVER (PARTITION BY recipient_id ORDER BY id DESC) AS rn
+                       FROM messages)
+                   WHERE rn <= ? ORDER BY id""",
+                (limit,)
+            ).fetchall()
+        return [json.loads(payload) for (payload,) in rows]
+
+    def load_conversation_messages(self, conversation_id: str, before_seq: Optional[int] = None,
+                                   limit: Optional[int] = None) -> List[Dict]:
+        query = "SELECT payload FROM messages WHERE recipient_id = ?"
+        params: list = [conversation_id or ""]
+        if before_seq is not None:
+            query += " AND json_extract(payload, '$.seq') < ?"
+            params.append(before_seq)
+        query += " ORDER BY id DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [json.loads(payload) for (payload,) in reversed(rows)]
+
+    def _insert_messages(self, messages: List[Dict]):
+        self.conn.executemany(
+            "INSERT INTO messages (sender, recipient_id, content, timestamp, payload) VALUES (?, ?, ?, ?, ?)",
+            [(msg.get("sender", ""), msg.get("recipient_id") or "", msg.get("content", ""),
+              msg.get("timestamp", ""), json.dumps(msg, ensure_ascii=False)) for msg in messages]
+        )
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('messages', '1')")
+
+    def append_message(self, message: Dict, all_messages: Callable[[], List[Dict]]) -> bool:
+        return self.append_messages([message], all_messages)
+
+    def append_messages(self, messages: List[Dict], all_messages: Callable[[], List[Dict]],
+                        fsync: bool = False) -> bool:
+        try:
+            with self._lock:
+                # WAL + synchronous=NORMAL 的提交不会立即刷盘，需要刷盘时临时切换为 FULL
+                if fsync:
+                    self.conn.execute("PRAGMA synchronous=FULL")
+                try:
+                    with self.conn:
+                        self._insert_messages(messages)
+                finally:
+                    if fsync:
+                        self.conn.execute("PRAGMA synchronous=NORMAL")
+            return True
+        except Exception as e:
+            print(f"❌ 保存聊天记录时出错: {e}")
+            return False
+
+    def save_messages(self, messages: List[Dict]) -> bool:
+        try:
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM messages")
+                self._insert_messages(messages)
+            return True
+        except Exception as e:
+            print(f"❌ 保存聊天记录时出错: {e}")
+            return False
+
+    def compact_messages(self, watermarks: Dict[str, int],
+                         remaining_messages: Callable[[], List[Dict]]) -> bool:
+        try:
+            with self._lock, self.conn:
+                self.conn.executemany(
+                    "DELETE FROM messages WHERE recipient_id = ? AND json_extract(payload, '$.seq') <= ?",
+                    list(watermarks.items())
+                )
+            return True
+        except Exception as e:
+            print(f"❌ 删除会话消息时出错: {e}")
+            return False
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class WriteBehindStorageBackend(StorageBackend):
+    """
+    消息延迟写入（write-behind）包装器
+    新消息先在内存中确认，由后台线程在积累 batch_size 条或等待 flush_interval_ms
+    毫秒后批量提交给底层后端；消息高峰期 N 次整体重写合并为一次
+
+    刷盘策略 fsync_policy:
+    - never: 从不主动刷盘，交给操作系统
+    - batch: 每批写入后刷盘一次
+    - message: 逐条写入并刷盘，最安全但最慢
+    """
+
+    FSYNC_POLICIES = ("never", "batch", "message")
+
+    def __init__(self, backend: StorageBackend, batch_size=50, flush_interval_ms=200,
+                 fsync_policy="batch"):
+        """
+        初始化延迟写入包装器
+
+        参数:
+        - backend: 实际负责存储的后端
+        - batch_size: 积累多少条消息后立即提交
+        - flush_interval_ms: 第一条未提交消息最多等待多少毫秒
+        - fsync_policy: 刷盘策略，"never"、"batch" 或 "message"
+        """
+        if fsync_policy not in self.FSYNC_POLICIES:
+            raise ValueError(f"不支持的刷盘策略: {fsync_policy}")
+
+        self.backend = backend
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000
+        self.fsync_policy = fsync_policy
+
+        self._pending = []
+        self._first_pending_at = 0.0
+        self._all_messages = None
+        # 累计加入队列的消息数，用于判断整体重写的快照是否已过期
+        self._enqueued = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        # 保证同一时间只有一个线程在向底层后端提交
+        self._flush_lock = threading.Lock()
+
+        self._flusher = threading.Thread(target=self._run_flusher, name="message-flusher", daemon=True)
+        self._flusher.start()
+        # 即使没有调用 close，解释器退出前也把剩余消息写完
+        atexit.register(self.flush)
+
+    def _run_flusher(self):
+        """
+        后台刷写线程：等到攒够一批或超时后提交
+        """
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                deadline = self._first_pending_at + self.flush_interval
+                while len(self._pending) < self.batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    def flush(self) -> bool:
+        """
+        立即提交所有待写入的消息
+
+        调用方（消息仓库）可能持有自己的锁再调用这里，而 all_messages 也要获取那把锁，
+        所以持有 _flush_lock 时绝不调用 all_messages：需要整体重写的后端先在锁外取得全部消息的快照，
+        进入锁后如果取快照之后又有新消息加入队列，就重新取快照
+        """
+        while True:
+            with self._cond:
+                all_messages = self._all_messages
+                enqueued = self._enqueued
+                needs_snapshot = (bool(self._pending) and all_messages is not None
+                                  and self.backend.appends_need_all_messages())
+            if needs_snapshot:
+                # 加入队列的消息都已在内存中，快照一定包含它们
+                snapshot = all_messages()
+                all_messages = lambda: snapshot
+
+            with self._flush_lock:
+                with self._cond:
+                    if needs_snapshot and self._enqueued != enqueued:
+                        continue
+                    batch, self._pending = self._pending, []
+                if not batch:
+                    return True
+                return self._commit(batch, all_messages)
+
+    def _commit(self, batch: List[Dict], all_messages: Callable[[], List[Dict]]) -> bool:
+        """
+        把一批消息提交给底层后端，调用方持有 _flush_lock
+        """
+        if self.fsync_policy == "message":
+            written = 0
+            for message in batch:
+                if not self.backend.append_messages([message], all_messages, fsync=True):
+                    break
+                written += 1
+        else:
+            ok = self.backend.append_messages(batch, all_messages,
+                                              fsync=self.fsync_policy == "batch")
+            written = len(batch) if ok else 0
+
+        if written < len(batch):
+            # 提交失败的消息放回队首，下次刷写时重试
+            with self._cond:
+                self._pending[:0] = batch[written:]
+                self._first_pending_at = time.monotonic()
+            print(f"❌ 批量写入聊天记录失败，{len(batch) - written} 条消息等待重试")
+            return False
+        return True
+
+    def append_message(self, message: Dict, all_messages: Callable[[], List[Dict]]) -> bool:
+        with self._cond:
+            if not self._closed:
+                if not self._pending:
+                    self._first_pending_at = time.monotonic()
+                self._pending.append(message)
+                self._enqueued += 1
+                self._all_messages = all_messages
+                self._cond.notify()
+                return True
+        # 已关闭时退化为同步写入
+        return self.backend.append_messages([message], all_messages,
+                                            fsync=self.fsync_policy != "never")
+
+    def append_messages(self, messages: List[Dict], all_messages: Callable[[], List[Dict]],
+                        fsync: bool = False) -> bool:
+        return all(self.append_message(message, all_messages) for message in messages)
+
+    # 以下操作需要看到完整的消息序列，先提交待写入的消息再交给底层后端
+
+    def load_messages(self) -> Optional[List[Dict]]:
+        self.flush()
+        return self.backend.load_messages()
+
+    def load_recent_messages(self, limit: int) -> Optional[List[Dict]]:
+        self.flush()
+        return self.backend.load_recent_messages(limit)
+
+    def load_conversation_messages(self, conversation_id: str, before_seq: Optional[int] = None,
+                                   limit: Optional[int] = None) -> List[Dict]:
+        self.flush()
+        return self.backend.load_conversation_messages(conversation_id, before_seq, limit)
+
+    def save_messages(self, messages: List[Dict]) -> bool:
+        self.flush()
+        return self.backend.save_messages(messages)
+
+    def compact_messages(self, watermarks: Dict[str, int],
+                         remaining_messages: Callable[[], List[Dict]]) -> bool:
+        self.flush()
+        return self.backend.compact_messages(watermarks, remaining_messages)
+
+    def load_document(self, name: str) -> Optional[Dict]:
+        return self.backend.load_document(name)
+
+    def save_document(self, name: str, data: Dict) -> bool:
+        return self.backend.save_document(name, data)
+
+    def save_entries(self, name: str, data: Dict, keys: Iterable[str]) -> bool:
+        return self.backend.save_entries(name, data, keys)
+
+    def save_edges(self, name: str, data: Dict, edges: List[Dict]) -> bool:
+        return self.backend.save_edges(name, data, edges)
+
+    def document_version(self, name: str):
+        return self.backend.document_version(name)
+
+    def location(self) -> Optional[tuple]:
+        return self.backend.location()
+
+    def search_index_dir(self) -> Optional[Path]:
+        return self.backend.search_index_dir()
+
+    def close(self):
+        """
+        停止后台线程，提交剩余消息后关闭底层后端
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._flusher.join()
+        self.flush()
+        atexit.unregister(self.flush)
+        self.backend.close()
+
+
+# 存储模式 -> 后端构造方式
+STORAGE_MODES = ("json", "jsonl", "segmented", "sqlite")
+
+def create_storage_backend(data_dir="data", storage_mode="json", write_behind=None) -> StorageBackend:
+    """
+    按存储模式创建存储后端
+
+    参数:
+    - data_dir: 数据存储目录
+    - storage_mode: "json"（默认）、"jsonl"（追加式消息日志）、
+      "segmented"（按会话分段的消息文件）或 "sqlite"
+    - write_behind: 启用消息延迟写入；True 使用默认参数，
+      也可以传入字典，如 {"batch_size": 100, "flush_interval_ms": 500, "fsync_policy": "never"}
+    """
+    if storage_mode == "sqlite":
+        backend = SQLiteStorageBackend(data_dir)
+    elif storage_mode == "segmented":
+        backend = SegmentedStorageBackend(data_dir)
+    elif storage_mode in ("json", "jsonl"):
+        backend = JSONStorageBackend(data_dir, message_format=storage_mode)
+    else:
+        raise ValueError(f"不支持的存储模式: {storage_mode}")
+
+    if write_behind:
+        options = write_behind if isinstance(write_behind, dict) else {}
+        backend = WriteBehindStorageBackend(backend, **options)
+    return backend
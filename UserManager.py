@@ -1,55 +1,58 @@
 # UserManager.py
-import json
-import os
 from pathlib import Path
+from StorageBackend import create_storage_backend
 
 class UserManager:
     """
     用户管理类：负责用户的注册、登录和数据存储
     """
     
-    def __init__(self, data_dir="data"):
+    def __init__(self, data_dir="data", storage=None):
         """
         初始化用户管理器
         data_dir: 数据存储目录
+        storage: 共享的存储后端，默认使用 data_dir 下的JSON文件
         """
         # 创建数据目录
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(exist_ok=True)  # 如果目录不存在就创建
         
-        # 用户数据文件路径
-        self.users_file = self.data_dir / "users.json"
+        # 存储后端
+        self.storage = storage if storage is not None else create_storage_backend(self.data_dir)
         
         # 加载现有用户数据
         self.users = self._load_users()
     
     def _load_users(self):
         """
-        从JSON文件加载用户数据
-        如果文件不存在或格式错误，返回空字典
+        从存储后端加载用户数据
+        如果数据不存在或格式错误，返回空字典
         """
         try:
-            if self.users_file.exists():
-                with open(self.users_file, 'r', encoding='utf-8') as f:
-                    users_data = json.load(f)
-                    print(f"✅ 成功加载用户数据，共有 {len(users_data)} 个用户")
-                    return users_data
+            users_data = self.storage.load_document("users")
+            if users_data is not None:
+                print(f"✅ 成功加载用户数据，共有 {len(users_data)} 个用户")
+                return users_data
             else:
                 print("📝 用户数据文件不存在，将创建新文件")
                 return {}
-        except (json.JSONDecodeError, Exception) as e:
+        except Exception as e:
             print(f"❌ 加载用户数据时出错: {e}")
             return {}
     
-    def _save_users(self):
+    def _save_users(self, changed_users=None):
         """
-        将用户数据保存到JSON文件
+        将用户数据保存到存储后端
+        changed_users: 发生变化的用户名，提供时只写入这些用户
         """
         try:
-            with open(self.users_file, 'w', encoding='utf-8') as f:
-                json.dump(self.users, f, ensure_ascii=False, indent=2)
-            print("✅ 用户数据保存成功")
-            return True
+            if changed_users is None:
+                saved = self.storage.save_document("users", self.users)
+            else:
+                saved = self.storage.save_entries("users", self.users, changed_users)
+            if saved:
+                print("✅ 用户数据保存成功")
+            return saved
         except Exception as e:
             print(f"❌ 保存用户数据时出错: {e}")
             return False
@@ -77,7 +80,7 @@ class UserManager:
         self.users[username] = password
         
         # 保存数据
-        if self._save_users():
+        if self._save_users([username]):
             return True, f"✅ 注册成功！欢迎 {username} 加入中考加油大家庭！"
         else:
             # 如果保存失败，回滚用户数据
@@ -0,0 +1,230 @@
+# benchmark.py
+"""
+性能基准测试
+用法: python benchmark.py [测试名...]
+不指定测试名时运行全部测试
+"""
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from MessageRecord import MessageRecord, TIMESTAMP_FORMAT
+from SearchIndex import SearchIndex
+from FriendManager import FriendManager
+from FriendSuggester import FriendSuggester
+from GroupStore import GroupStore
+from StorageBackend import JSONStorageBackend
+
+def _measure_memory(build):
+    """
+    测量 build() 返回的对象占用的内存（字节）
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+def bench_message_memory(count=200000):
+    """
+    比较字典消息与 MessageRecord 每条消息的内存占用
+    """
+    print(f"📊 消息内存占用（{count} 条消息）")
+    senders = [f"同学{i}" for i in range(500)]
+    conversations = ["BROADCAST_ROOM"] + [f"group-{i}" for i in range(50)]
+    start = datetime(2025, 6, 1, 8, 0, 0)
+
+    def make_fields(i):
+        # 每次都重新生成字符串，模拟从JSON文件反序列化得到的独立对象
+        return (
+            "".join(random.choice(senders)),
+            "".join(random.choice(conversations)),
+            f"第{i}条消息：中考加油！",
+            (start + timedelta(seconds=i)).strftime(TIMESTAMP_FORMAT),
+        )
+
+    random.seed(0)
+    def build_dicts():
+        messages = []
+        for i in range(count):
+            sender, recipient_id, content, timestamp = make_fields(i)
+            messages.append({
+                "sender": sender,
+                "recipient_id": recipient_id,
+                "content": content,
+                "timestamp": timestamp,
+                "id": i + 1,
+                "seq": i + 1
+            })
+        return messages
+
+    random.seed(0)
+    def build_records():
+        messages = []
+        for i in range(count):
+            sender, recipient_id, content, timestamp = make_fields(i)
+            messages.append(MessageRecord.from_dict({
+                "sender": sender,
+                "recipient_id": recipient_id,
+                "content": content,
+                "timestamp": timestamp,
+                "id": i + 1,
+                "seq": i + 1
+            }))
+        return messages
+
+    dicts, dict_bytes = _measure_memory(build_dicts)
+    del dicts
+    records, record_bytes = _measure_memory(build_records)
+    del records
+
+    dict_per_message = dict_bytes / count
+    record_per_message = record_bytes / count
+    saving = dict_per_message - record_per_message
+    print(f"   字典:          {dict_per_message:8.1f} 字节/条")
+    print(f"   MessageRecord: {record_per_message:8.1f} 字节/条")
+    print(f"   节省:          {saving:8.1f} 字节/条 ({saving / dict_per_message:.0%})")
+
+def bench_search(count=1000000):
+    """
+    比较逐条子串扫描与倒排索引的关键词搜索耗时
+    """
+    print(f"📊 关键词搜索（{count} 条消息）")
+    words = ["中考", "加油", "数学", "物理", "化学", "英语", "作业", "复习", "考试", "同学",
+             "老师", "明天", "今天", "一起", "努力", "题目", "答案", "模拟", "错题", "背诵",
+             "语文", "历史", "地理", "生物", "体育", "休息", "晚安", "早上", "图书馆", "笔记",
+             " math ", " physics ", " homework ", " exam ", " ok "]
+    random.seed(0)
+    start = datetime(2025, 6, 1, 8, 0, 0)
+    records = []
+    for i in range(count):
+        content = "".join(random.choice(words) for _ in range(3))
+        records.append(MessageRecord(f"同学{i % 500}", f"group-{i % 50}", content,
+                                     int((start + timedelta(seconds=i)).timestamp()), id=i + 1, seq=i + 1))
+
+    # 大量不同的英文/数字词（学号、单词变体），子串匹配不能扫描整个词表
+    for i in range(count // 10):
+        records[i].content += f" s{i}x{random.randrange(100000)} "
+    began = time.perf_counter()
+    index = SearchIndex()
+    index.add_many(records)
+    print(f"   建立索引（{len(index._words)} 个英文/数字词）:  {time.perf_counter() - began:8.2f} 秒")
+
+    for keyword in ("物理作业", "homework", "中考加油复习", "work", "s12345x", "qzqz", "zz9"):
+        began = time.perf_counter()
+        scanned = [record for record in records if keyword.lower() in record.content.lower()]
+        scan_ms = (time.perf_counter() - began) * 1000
+        began = time.perf_counter()
+        found = index.search(keyword)
+        index_ms = (time.perf_counter() - began) * 1000
+        assert [record.id for record in found] == [record.id for record in scanned]
+        print(f"   '{keyword}': 扫描 {scan_ms:8.1f} 毫秒, 索引 {index_ms:8.1f} 毫秒 ({len(found)} 条)")
+
+def bench_permission(user_counts=(1000, 10000, 100000), checks=20000):
+    """
+    发送消息前的权限检查耗时：原来的逐用户扫描列表 vs 邻接集合
+    集合版本的耗时应与用户数量无关
+    """
+    print(f"📊 会话权限检查（每次测量 {checks} 次检查）")
+
+    def scan_lists(friends_lists, groups_lists, user_id, conversation_id):
+        # 原实现：遍历全部用户的好友列表，群成员也是列表
+        for user, friends in friends_lists.items():
+            if user == user_id and conversation_id in friends:
+                return True
+            if user == conversation_id and user_id in friends:
+                return True
+        if conversation_id in groups_lists:
+            return user_id in groups_lists[conversation_id]["members"]
+        return False
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        manager = FriendManager(data_dir)
+        for user_count in user_counts:
+            random.seed(0)
+            users = [f"同学{i}" for i in range(user_count)]
+            friends = {user: set() for user in users}
+            for user in users:
+                for friend in random.sample(users, 20):
+                    if friend != user:
+                        friends[user].add(friend)
+                        friends[friend].add(user)
+            groups = {f"group-{i}": {"name": f"群{i}", "members": set(random.sample(users, 200))}
+                      for i in range(max(1, user_count // 100))}
+            # 直接替换内存数据，不经过存储后端
+            manager.friends_data = friends
+            manager.group_store.groups = groups
+            friends_lists = {user: list(items) for user, items in friends.items()}
+            groups_lists = {gid: {"members": list(info["members"])} for gid, info in groups.items()}
+
+            targets = list(users) + list(groups)
+            pairs = [(random.choice(users), random.choice(targets)) for _ in range(checks)]
+            # 扫描版本太慢，只测一部分再换算
+            scan_pairs = pairs[:max(10, checks * 1000 // user_count // 10)]
+
+            began = time.perf_counter()
+            expected = [scan_lists(friends_lists, groups_lists, u, c) for u, c in scan_pairs]
+            scan_us = (time.perf_counter() - began) / len(scan_pairs) * 1e6
+            began = time.perf_counter()
+            results = [manager.can_access_conversation(u, c) for u, c in pairs]
+            set_us = (time.perf_counter() - began) / len(pairs) * 1e6
+            assert results[:len(scan_pairs)] == expected
+            print(f"   {user_count:>7} 用户: 扫描 {scan_us:10.2f} 微秒/次, 集合 {set_us:6.2f} 微秒/次")
+
+def bench_suggestions(user_count=50000, queries=1000):
+    """
+    "可能认识的人" 推荐：首次计算（有界广度优先搜索）与命中缓存的耗时
+    """
+    print(f"📊 好友推荐（{user_count} 名学生，{queries} 次查询）")
+    random.seed(0)
+    users = [f"同学{i}" for i in range(user_count)]
+    friends = {user: set() for user in users}
+    for user in users:
+        for friend in random.sample(users, 10):
+            if friend != user:
+                friends[user].add(friend)
+                friends[friend].add(user)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        group_store = GroupStore(JSONStorageBackend(data_dir))
+        # 每个班级群 40 人，直接替换内存数据，不经过存储后端
+        for i in range(user_count // 40):
+            group_store.groups[f"class-{i}"] = {"name": f"班级{i}", "members": set(users[i * 40:(i + 1) * 40])}
+        group_store.user_groups_index = group_store._build_user_groups_index()
+        suggester = FriendSuggester(friends, group_store)
+        targets = random.sample(users, queries)
+
+        began = time.perf_counter()
+        for user in targets:
+            suggester.suggest(user)
+        cold_ms = (time.perf_counter() - began) / queries * 1000
+        began = time.perf_counter()
+        for user in targets:
+            suggester.suggest(user)
+        warm_us = (time.perf_counter() - began) / queries * 1e6
+        print(f"   首次计算: {cold_ms:8.2f} 毫秒/次")
+        print(f"   命中缓存: {warm_us:8.2f} 微秒/次")
+
+        # 一条好友关系变化只让少数用户的缓存失效
+        suggester.invalidate_friendship(targets[0], targets[1])
+        print(f"   加一条好友关系后仍有效的缓存: {len(suggester._cache)} / {min(queries, suggester.CACHE_SIZE)}")
+
+BENCHMARKS = {
+    "message_memory": bench_message_memory,
+    "search": bench_search,
+    "permission": bench_permission,
+    "suggestions": bench_suggestions,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"❌ 未知的测试: {name}，可选: {', '.join(BENCHMARKS)}")
+            continue
+        BENCHMARKS[name]()
+        print()
@@ -2,7 +2,8 @@
 from typing import List, Dict
 from datetime import datetime
 import os
-import json
+from StorageBackend import create_storage_backend
+from MessageStore import MessageStore
 
 class Chat:
     """
@@ -11,13 +12,15 @@ class Chat:
     支持模块化系统和独立运行两种模式
     """
     
-    def __init__(self, main_manager=None, data_dir="data"):
+    def __init__(self, main_manager=None, data_dir="data", storage=None, history_tail=None):
         """
         初始化聊天模块
         
         参数:
         - main_manager: 模块化系统的主管理器，用于在模块化环境中获取其他管理器
         - data_dir: 数据存储目录
+        - storage: 存储后端，模块化系统中默认使用主管理器的共享后端
+        - history_tail: 启动时每个会话只加载最新的这么多条消息，模块化系统中默认使用主管理器的设置
         """
         self.main_manager = main_manager
         
@@ -27,13 +30,21 @@ class Chat:
         else:
             self.data_dir = data_dir
         
-        self.messages = []
         self.friend_manager = None
         
         # 确保数据目录存在
         if self.data_dir and not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
         
+        # 存储后端
+        if storage is None and main_manager is not None:
+            storage = getattr(main_manager, 'storage', None)
+        self.storage = storage if storage is not None else create_storage_backend(self.data_dir)
+        if history_tail is None and main_manager is not None:
+            history_tail = getattr(main_manager, 'history_tail', None)
+        # 与 ChatManager 共用同一个消息仓库，两边看到的始终是同一份消息
+        self.message_store = MessageStore.shared(self.storage, tail_size=history_tail)
+        
         # 如果在模块化系统中运行，从main_manager获取friend模块
         if main_manager is not None:
             self.friend_manager = main_manager.get_manager('friend')
@@ -41,6 +52,13 @@ class Chat:
         # 加载消息数据
         self._load_messages()
     
+    @property
+    def messages(self) -> List[Dict]:
+        """
+        全部消息（按时间顺序）
+        """
+        return self.message_store.messages
+    
     def send_message(self, sender, content, recipient_id=None):
         """
         发送消息
@@ -57,15 +75,10 @@ class Chat:
             "timestamp": self._get_current_time()
         }
         
-        # 添加到消息列表
-        self.messages.append(new_message)
-        
-        # 保存到文件
-        if self._save_messages():
+        # 添加到消息仓库并保存（只追加这一条），保存失败时自动移除
+        if self.message_store.append(new_message):
             return True, "✅ 消息发送成功"
         else:
-            # 如果保存失败，移除最新消息
-            self.messages.pop()
             return False, "❌ 消息发送失败，请重试"
     
     def _can_send_to_chat(self, sender: str, recipient_id: str) -> bool:
@@ -103,17 +116,36 @@ class Chat:
     def get_chat_history(self, recipient_id: str, limit: int = None) -> List[Dict]:
         """
         获取指定会话的聊天记录
+        会话中的消息写入时就按时间排列，无需排序；指定 limit 时只切出最后 limit 条
         """
-        # 过滤出指定会话的消息
-        chat_messages = [msg for msg in self.messages if msg.get('recipient_id') == recipient_id]
-        
-        # 按时间排序（确保最新的在后面）
-        chat_messages.sort(key=lambda x: x.get('timestamp', ''))
+        if limit:
+            return self.message_store.get_page(recipient_id, limit=limit)["messages"]
+        return list(self.message_store.get_conversation(recipient_id))
+    
+    def get_chat_history_page(self, recipient_id: str, before: str = None, limit: int = 50) -> Dict:
+        """
+        分页获取会话历史，向上翻页时只取出当前这一页
         
-        if limit and len(chat_messages) > limit:
-            return chat_messages[-limit:]
+        参数:
+        - recipient_id: 会话ID
+        - before: 上一页返回的 next_cursor，为空时返回最新一页
+        - limit: 每页消息数
         
-        return chat_messages
+        返回:
+        - {"messages": 按时间顺序的消息列表, "next_cursor": 更早一页的游标，没有更多时为 None}
+        """
+        try:
+            return self.message_store.get_page(recipient_id, before, limit)
+        except ValueError as e:
+            print(f"获取聊天记录时出错: {e}")
+            return {"messages": [], "next_cursor": None}
+    
+    def get_messages_since(self, conversation_id: str, seq: int) -> List[Dict]:
+        """
+        增量拉取：获取会话中序号大于 seq 的新消息
+        客户端记住最后看到的 seq，刷新时只取之后的消息
+        """
+        return self.message_store.get_messages_since(conversation_id, seq)
     
     def get_recent_chats_for_user(self, username: str) -> List[Dict]:
         """
@@ -124,54 +156,57 @@ class Chat:
         
         recent_chats = []
         
+        # 最后一条消息直接从最后活动表中取，不再读取各会话的历史；未读数由已读水位线算出
+        last_message_of = self.message_store.get_last_message
+        unread_count_of = self.message_store.get_unread_count
+        
         # 1. 广播室（始终显示）
         broadcast_id = self.friend_manager.get_broadcast_room_id()
-        broadcast_messages = self.get_chat_history(broadcast_id, 1)
-        last_message = broadcast_messages[-1] if broadcast_messages else None
-        
         recent_chats.append({
             "id": broadcast_id,
             "name": "中考加油广播室",
             "type": "broadcast",
-            "last_message": last_message,
-            "unread_count": 0  # 简化处理，实际应该跟踪未读消息
+            "last_message": last_message_of(broadcast_id),
+            "unread_count": unread_count_of(username, broadcast_id)
         })
         
         # 2. 个人聊天
         friends = self.friend_manager.get_friend_list(username)
         for friend in friends:
             chat_id = self.friend_manager.get_personal_chat_id(username, friend)
-            chat_messages = self.get_chat_history(chat_id, 1)
-            last_message = chat_messages[-1] if chat_messages else None
-            
             recent_chats.append({
                 "id": chat_id,
                 "name": friend,
                 "type": "personal",
-                "last_message": last_message,
-                "unread_count": 0
+                "last_message": last_message_of(chat_id),
+                "unread_count": unread_count_of(username, chat_id)
             })
         
         # 3. 群组聊天
         groups = self.friend_manager.get_group_list(username)
         for group in groups:
             if group["id"] != broadcast_id:  # 排除广播室
-                chat_messages = self.get_chat_history(group["id"], 1)
-                last_message = chat_messages[-1] if chat_messages else None
-                
                 recent_chats.append({
                     "id": group["id"],
                     "name": group["name"],
                     "type": "group",
-                    "last_message": last_message,
-                    "unread_count": 0
+                    "last_message": last_message_of(group["id"]),
+                    "unread_count": unread_count_of(username, group["id"])
                 })
         
-        # 按最后消息时间排序
-        recent_chats.sort(key=lambda x: x["last_message"]["timestamp"] if x["last_message"] else "", reverse=True)
+        # 按最后活动时间排序
+        order = {chat_id: index for index, chat_id in
+                 enumerate(self.message_store.sort_by_last_activity(chat["id"] for chat in recent_chats))}
+        recent_chats.sort(key=lambda x: order[x["id"]])
         
         return recent_chats
     
+    def mark_as_read(self, username: str, recipient_id: str, seq: int = None) -> bool:
+        """
+        标记用户已读到会话中的 seq（默认为最新消息）
+        """
+        return self.message_store.mark_read(username, recipient_id, seq)
+    
     def get_personal_chat_history(self, user1: str, user2: str) -> List[Dict]:
         """
         获取两人之间的个人聊天记录
@@ -186,34 +221,15 @@ class Chat:
         """
         搜索消息，可以指定会话或全局搜索
         """
-        results = []
-        for msg in self.messages:
-            # 如果指定了会话，只搜索该会话的消息
-            if recipient_id and msg.get('recipient_id') != recipient_id:
-                continue
-            
-            if keyword.lower() in msg['content'].lower():
-                results.append(msg)
-        
-        return results
+        # 通过倒排索引查找，不再逐条扫描全部消息
+        return self.message_store.search(keyword, recipient_id)
     
     def get_user_messages(self, username: str, recipient_id: str = None) -> List[Dict]:
         """
         获取用户发送的消息，可以指定会话
         """
-        user_messages = []
-        for msg in self.messages:
-            # 检查发送者
-            if msg['sender'] != username:
-                continue
-            
-            # 如果指定了会话，只返回该会话的消息
-            if recipient_id and msg.get('recipient_id') != recipient_id:
-                continue
-            
-            user_messages.append(msg)
-        
-        return user_messages
+        # 直接从发送者索引中取出，不再扫描全部消息
+        return self.message_store.get_sender_messages(username, recipient_id)
     
     def clear_chat_history(self, recipient_id: str = None) -> (bool, str):
         """
@@ -222,14 +238,14 @@ class Chat:
         try:
             if recipient_id:
                 # 清空指定会话
-                self.messages = [msg for msg in self.messages if msg.get('recipient_id') != recipient_id]
                 message = f"已清空会话记录"
+                saved = self.message_store.clear_conversation(recipient_id)
             else:
                 # 清空所有记录
-                self.messages = []
                 message = "已清空所有聊天记录"
+                saved = self.message_store.clear_all()
             
-            if self._save_messages():
+            if saved:
                 return True, message
             else:
                 return False, "清空失败"
@@ -247,10 +263,11 @@ class Chat:
         """
         获取消息数量，可以指定会话
         """
+        # 消息仓库维护着计数，无需遍历消息
         if recipient_id:
-            return len([msg for msg in self.messages if msg.get('recipient_id') == recipient_id])
+            return self.message_store.count_conversation(recipient_id)
         else:
-            return len(self.messages)
+            return self.message_store.count_all()
     
     def _get_current_time(self) -> str:
         """
@@ -260,29 +277,32 @@ class Chat:
     
     def _load_messages(self):
         """
-        从文件加载消息数据
+        从存储后端加载消息数据
         """
+        if self.message_store.loaded:
+            return
         try:
-            file_path = os.path.join(self.data_dir, "messages.json")
-            if os.path.exists(file_path):
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    self.messages = json.load(f)
+            self.message_store.load()
         except Exception as e:
             print(f"加载消息数据时出错: {e}")
-            self.messages = []
+    
+    def subscribe(self, callback):
+        """
+        订阅消息变化，callback(event, conversation_id, messages)
+        """
+        self.message_store.subscribe(callback)
+    
+    def unsubscribe(self, callback):
+        """
+        取消订阅消息变化
+        """
+        self.message_store.unsubscribe(callback)
     
     def _save_messages(self) -> bool:
         """
-        保存消息数据到文件
+        整体保存消息数据到存储后端
         """
-        try:
-            file_path = os.path.join(self.data_dir, "messages.json")
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(self.messages, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            print(f"保存消息数据时出错: {e}")
-            return False
+        return self.message_store.save_all()
 
 # 测试代码
 def test_enhanced_chat_system():
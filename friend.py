@@ -1,25 +1,28 @@
 # Friend.py
-import json
-import os
 import uuid
 from pathlib import Path
 from datetime import datetime
 from typing import List, Dict, Set
+from StorageBackend import create_storage_backend
+from FriendGraph import FriendGraph
 
 class Friend:
     """
     好友功能模块
     处理好友添加、删除和好友关系管理
     支持模块化系统和独立运行模式
+
+    好友关系由共享的 FriendGraph 管理，与 FriendManager 共用同一份数据和同一个推荐器
     """
     
-    def __init__(self, main_manager=None, data_dir="data"):
+    def __init__(self, main_manager=None, data_dir="data", storage=None):
         """
         初始化好友模块
         
         Args:
             main_manager: 主管理器实例，用于模块化系统
             data_dir: 数据存储目录
+            storage: 存储后端，模块化系统中默认使用主管理器的共享后端
         """
         self.main_manager = main_manager
         
@@ -32,117 +35,34 @@ class Friend:
         # 确保数据目录存在
         self.data_dir.mkdir(exist_ok=True)
         
-        # 好友数据文件
-        self.friends_file = self.data_dir / "friends.json"
+        # 存储后端
+        if storage is None and main_manager is not None:
+            storage = getattr(main_manager, 'storage', None)
+        self.storage = storage if storage is not None else create_storage_backend(self.data_dir)
         
-        # 加载数据
-        self.friends_data = self._load_friends_data()
+        # 加载数据；同一份数据的好友关系只加载一份，与 FriendManager 共用
+        self.friend_graph = FriendGraph.shared(self.storage)
+        self.friends_data = self.friend_graph.friends
         
         print("✅ 好友管理系统初始化完成")
     
-    def _load_friends_data(self) -> Dict:
-        """
-        加载好友关系数据
-        """
-        try:
-            if self.friends_file.exists():
-                with open(self.friends_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    print(f"✅ 加载好友数据，共 {len(data)} 个用户的好友关系")
-                    return data
-            else:
-                print("📝 好友数据文件不存在，创建新文件")
-                return {}
-        except Exception as e:
-            print(f"❌ 加载好友数据失败: {e}")
-            return {}
-    
-    def _save_friends_data(self):
-        """
-        保存好友数据
-        """
-        try:
-            with open(self.friends_file, 'w', encoding='utf-8') as f:
-                json.dump(self.friends_data, f, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            print(f"❌ 保存好友数据失败: {e}")
-            return False
-    
     def add_friend(self, user1: str, user2: str) -> (bool, str):
         """
         添加好友关系（双向）
         """
-        if user1 == user2:
-            return False, "❌ 不能添加自己为好友"
-        
-        # 初始化用户的好友列表
-        if user1 not in self.friends_data:
-            self.friends_data[user1] = []
-        if user2 not in self.friends_data:
-            self.friends_data[user2] = []
-        
-        # 检查是否已经是好友
-        if user2 in self.friends_data[user1]:
-            return False, f"❌ 你们已经是好友了"
-        
-        # 建立好友关系
-        self.friends_data[user1].append(user2)
-        self.friends_data[user2].append(user1)
-        
-        # 保存数据
-        if self._save_friends_data():
-            return True, f"✅ 成功添加好友 {user2}"
-        else:
-            # 回滚操作
-            if user2 in self.friends_data[user1]:
-                self.friends_data[user1].remove(user2)
-            if user1 in self.friends_data[user2]:
-                self.friends_data[user2].remove(user1)
-            return False, "❌ 添加好友失败，请稍后重试"
+        return self.friend_graph.add_friend(user1, user2)
     
     def remove_friend(self, user1: str, user2: str) -> (bool, str):
         """
         移除好友关系
         """
-        # 检查用户数据结构
-        if user1 not in self.friends_data or user2 not in self.friends_data:
-            return False, "❌ 好友关系不存在"
-        
-        # 检查是否是好友
-        if user2 not in self.friends_data[user1]:
-            return False, "❌ 你们不是好友"
-        
-        # 解除好友关系
-        self.friends_data[user1].remove(user2)
-        self.friends_data[user2].remove(user1)
-        
-        # 清理空列表
-        if not self.friends_data[user1]:
-            del self.friends_data[user1]
-        if not self.friends_data[user2]:
-            del self.friends_data[user2]
-        
-        # 保存数据
-        if self._save_friends_data():
-            return True, f"✅ 已解除与 {user2} 的好友关系"
-        else:
-            # 回滚操作
-            if user1 not in self.friends_data:
-                self.friends_data[user1] = []
-            if user2 not in self.friends_data:
-                self.friends_data[user2] = []
-            self.friends_data[user1].append(user2)
-            self.friends_data[user2].append(user1)
-            return False, "❌ 移除好友失败，请稍后重试"
+        return self.friend_graph.remove_friend(user1, user2)
     
     def get_user_friends(self, user_id: str) -> List[str]:
         """
         获取用户的所有好友
         """
-        if user_id not in self.friends_data:
-            return []
-        return self.friends_data[user_id]
+        return sorted(self.friend_graph.get_friends(user_id))
     
     # 兼容旧接口
     get_friend_list = get_user_friends
@@ -151,8 +71,7 @@ class Friend:
         """
         检查两个用户是否是好友
         """
-        friends = self.get_user_friends(user_id)
-        return other_user_id in friends
+        return other_user_id in self.friend_graph.get_friends(user_id)
     
     def get_personal_chat_id(self, user1: str, user2: str) -> str:
         """
@@ -220,6 +139,17 @@ class Friend:
         
         return sorted(filtered_users)
     
+    def suggest_friends(self, current_user: str, limit: int = 10) -> List[Dict]:
+        """
+        推荐可能认识的人，不需要知道准确的用户名
+        按共同好友数和共同群组数排序，返回: [{"user", "mutual_friends", "shared_groups", "score"}, ...]
+        """
+        try:
+            return self.friend_graph.suggest(current_user, limit)
+        except Exception as e:
+            print(f"❌ 获取好友推荐失败: {e}")
+            return []
+    
     # 群组相关功能委托给Group模块
     def get_broadcast_room_id(self) -> str:
         """
@@ -272,8 +202,13 @@ def test_friend_system():
     search_results = friend_manager.search_users("小明", "小")
     print(f"   搜索'小': {search_results}")
     
+    # 测试好友推荐
+    print("\n5. 测试好友推荐:")
+    suggestions = friend_manager.suggest_friends("小明")
+    print(f"   小明可能认识: {[item['user'] for item in suggestions]}")
+    
     # 测试移除好友
-    print("\n5. 测试移除好友:")
+    print("\n6. 测试移除好友:")
     success, message = friend_manager.remove_friend("小明", "小红")
     print(f"   小明移除小红: {success} - {message}")
     
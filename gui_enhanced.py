@@ -58,13 +58,18 @@ except ImportError as e:
         print(f"❌ 好友模块加载失败: {e}")
         FRIEND_AVAILABLE = False
 
+# 每次加载的聊天记录条数（向上翻页时再加载更早的消息）
+HISTORY_PAGE_SIZE = 100
+# 搜索时显示的最相关结果条数
+SEARCH_PAGE_SIZE = 50
+
 class EnhancedApplication(tk.Frame):
     """
     中考加油聊天室 - 增强版
     支持多会话：广播室、个人聊天、群组聊天
     """
     
-    def __init__(self, master=None, username="同学"):
+    def __init__(self, master=None, username="同学", main_manager=None):
         super().__init__(master)
         self.master = master
         self.username = username
@@ -77,15 +82,22 @@ class EnhancedApplication(tk.Frame):
         # 设置窗口位置
         self.center_window()
         
-        # 初始化管理器
-        self.chat_manager = ChatManager() if CHAT_AVAILABLE else None
-        self.friend_manager = FriendManager() if FRIEND_AVAILABLE else None
+        # 初始化管理器：在模块化系统中运行时使用主管理器的实例，与其他模块共用同一份数据
+        if main_manager is not None:
+            self.chat_manager = main_manager.get_manager('chat')
+            self.friend_manager = main_manager.get_manager('friend')
+        else:
+            self.chat_manager = ChatManager() if CHAT_AVAILABLE else None
+            self.friend_manager = FriendManager() if FRIEND_AVAILABLE else None
         
         # 当前会话状态
         self.current_chat_id = None
         self.current_chat_name = "中考加油广播室"
         self.current_chat_type = "broadcast"
         
+        # 当前会话更早一页的分页游标
+        self.history_cursor = None
+        
         # 自动刷新控制
         self.auto_refresh = True
         self.is_closing = False
@@ -101,6 +113,10 @@ class EnhancedApplication(tk.Frame):
         # 启动自动刷新
         self.start_auto_refresh()
         
+        # 订阅消息变化，当前会话有新消息时立即刷新
+        if self.chat_manager and hasattr(self.chat_manager, 'subscribe'):
+            self.chat_manager.subscribe(self._on_messages_changed)
+        
         # 设置关闭事件
         self.master.protocol("WM_DELETE_WINDOW", self.on_closing)
         
@@ -242,13 +258,14 @@ class EnhancedApplication(tk.Frame):
         list_frame.pack(side="top", fill="both", expand=True, padx=5, pady=5)
         
         # 创建树形视图显示会话列表
-        columns = ("name", "type")
+        columns = ("name", "type", "unread")
         self.conversation_tree = ttk.Treeview(list_frame, columns=columns, show="tree", height=15)
         
         # 设置列
         self.conversation_tree.column("#0", width=0, stretch=tk.NO)  # 隐藏第一列
         self.conversation_tree.column("name", width=180)
         self.conversation_tree.column("type", width=0, stretch=tk.NO)  # 隐藏类型列
+        self.conversation_tree.column("unread", width=40, anchor="e")  # 未读数
         
         # 创建滚动条
         tree_scroll = ttk.Scrollbar(list_frame, orient="vertical", command=self.conversation_tree.yview)
@@ -298,6 +315,15 @@ class EnhancedApplication(tk.Frame):
                                bg="#3498DB", fg="white")
         refresh_btn.pack(side="left", padx=5, pady=2)
         
+        # 加载更早消息按钮
+        self.load_earlier_btn = tk.Button(control_frame, 
+                                         text="⬆️ 更早消息",
+                                         command=self.load_earlier_messages,
+                                         font=('Microsoft YaHei', 8),
+                                         bg="#95A5A6", fg="white",
+                                         state='disabled')
+        self.load_earlier_btn.pack(side="left", padx=5, pady=2)
+        
         # 自动刷新开关
         self.auto_refresh_var = tk.BooleanVar(value=True)
         auto_refresh_btn = tk.Checkbutton(control_frame, 
@@ -323,6 +349,15 @@ class EnhancedApplication(tk.Frame):
                               bg="#27AE60", fg="white")
         search_btn.pack(side="left", padx=2)
         
+        # 勾选后在自己所有的会话中搜索
+        self.search_all_var = tk.BooleanVar(value=False)
+        search_all_btn = tk.Checkbutton(search_frame,
+                                        text="全部会话",
+                                        variable=self.search_all_var,
+                                        font=('Microsoft YaHei', 8),
+                                        bg="#ECF0F1")
+        search_all_btn.pack(side="left", padx=2)
+        
         # 聊天记录显示区域
         self.chat_text = scrolledtext.ScrolledText(
             chat_frame,
@@ -417,7 +452,8 @@ class EnhancedApplication(tk.Frame):
         for chat in recent_chats:
             if chat.get("type") == "broadcast":
                 broadcast_item = self.conversation_tree.insert("", "end", 
-                                                             values=(chat["name"], "broadcast"),
+                                                             values=(chat["name"], "broadcast",
+                                                                     self._unread_badge(chat)),
                                                              tags=("broadcast",))
                 break
         
@@ -435,7 +471,7 @@ class EnhancedApplication(tk.Frame):
                                                           tags=("folder",))
             for chat in personal_chats:
                 self.conversation_tree.insert(personal_folder, "end", 
-                                            values=(chat["name"], "personal"),
+                                            values=(chat["name"], "personal", self._unread_badge(chat)),
                                             tags=("personal",))
         
         # 添加群组聊天
@@ -446,7 +482,7 @@ class EnhancedApplication(tk.Frame):
                                                         tags=("folder",))
             for chat in group_chats:
                 self.conversation_tree.insert(group_folder, "end", 
-                                            values=(chat["name"], "group"),
+                                            values=(chat["name"], "group", self._unread_badge(chat)),
                                             tags=("group",))
         
         # 设置标签样式
@@ -459,6 +495,13 @@ class EnhancedApplication(tk.Frame):
         for folder in self.conversation_tree.get_children():
             self.conversation_tree.item(folder, open=True)
     
+    def _unread_badge(self, chat):
+        """会话列表中的未读数标记"""
+        unread = chat.get("unread_count", 0)
+        if not unread:
+            return ""
+        return "99+" if unread > 99 else str(unread)
+    
     def on_conversation_select(self, event):
         """会话选择事件"""
         selection = self.conversation_tree.selection()
@@ -552,11 +595,19 @@ class EnhancedApplication(tk.Frame):
             return
         
         try:
-            # 获取当前会话的聊天记录
-            messages = self.chat_manager.get_chat_history(self.current_chat_id)
+            # 获取当前会话最新一页的聊天记录
+            messages = self._fetch_history_page()
+            
+            # 正在查看的会话视为已读
+            if hasattr(self.chat_manager, 'mark_as_read'):
+                self.chat_manager.mark_as_read(self.username, self.current_chat_id)
             
             # 更新消息计数
-            self.message_count_label.config(text=f"消息数: {len(messages)}")
+            if hasattr(self.chat_manager, 'get_conversation_message_count'):
+                total = self.chat_manager.get_conversation_message_count(self.current_chat_id)
+            else:
+                total = len(messages)
+            self.message_count_label.config(text=f"消息数: {total}")
             
             # 允许编辑
             self.chat_text.config(state='normal')
@@ -598,33 +649,9 @@ class EnhancedApplication(tk.Frame):
                 
                 self.chat_text.insert(tk.END, welcome_msg, "welcome")
             else:
-                # 显示所有消息
+                # 显示最新一页消息
                 for msg in messages:
-                    sender = msg.get('sender', '未知用户')
-                    content = msg.get('content', '')
-                    timestamp = msg.get('timestamp', '')
-                    
-                    # 格式化时间
-                    try:
-                        time_obj = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-                        display_time = time_obj.strftime("%m/%d %H:%M")
-                    except:
-                        display_time = timestamp
-                    
-                    # 确定消息样式
-                    if sender == "系统":
-                        tag = "system"
-                        prefix = "⚙️ 系统: "
-                    elif sender == self.username:
-                        tag = "self"
-                        prefix = "👤 我: "
-                    else:
-                        tag = "other"
-                        prefix = f"👤 {sender}: "
-                    
-                    # 插入消息
-                    display_line = f"[{display_time}] {prefix}{content}\n\n"
-                    self.chat_text.insert(tk.END, display_line, tag)
+                    self._insert_chat_message(msg, tk.END)
             
             # 设置不同消息类型的样式
             self.chat_text.tag_config("welcome", 
@@ -652,6 +679,69 @@ class EnhancedApplication(tk.Frame):
             self.chat_text.insert(tk.END, f"❌ 加载聊天记录时出错: {e}\n")
             self.chat_text.config(state='disabled')
     
+    def _fetch_history_page(self, before=None):
+        """获取当前会话的一页聊天记录，并记录更早一页的游标"""
+        if hasattr(self.chat_manager, 'get_chat_history_page'):
+            page = self.chat_manager.get_chat_history_page(self.username, self.current_chat_id,
+                                                           before=before, limit=HISTORY_PAGE_SIZE)
+            messages = page["messages"]
+            self.history_cursor = page["next_cursor"]
+        else:
+            messages = self.chat_manager.get_chat_history(self.current_chat_id)
+            self.history_cursor = None
+        
+        self.load_earlier_btn.config(state='normal' if self.history_cursor else 'disabled')
+        return messages
+    
+    def _insert_chat_message(self, msg, index, highlights=None):
+        """在聊天区域的指定位置插入一条消息，highlights 为内容中需要高亮的 [起始, 结束) 区间"""
+        sender = msg.get('sender', '未知用户')
+        content = msg.get('content', '')
+        timestamp = msg.get('timestamp', '')
+        
+        # 格式化时间
+        try:
+            time_obj = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+            display_time = time_obj.strftime("%m/%d %H:%M")
+        except:
+            display_time = timestamp
+        
+        # 确定消息样式
+        if sender == "系统":
+            tag = "system"
+            prefix = "⚙️ 系统: "
+        elif sender == self.username:
+            tag = "self"
+            prefix = "👤 我: "
+        else:
+            tag = "other"
+            prefix = f"👤 {sender}: "
+        
+        # 插入消息
+        head = f"[{display_time}] {prefix}"
+        start = self.chat_text.index('end-1c' if index == tk.END else index)
+        self.chat_text.insert(index, f"{head}{content}\n\n", tag)
+        
+        # 按搜索结果给出的区间高亮关键词，无需再扫描内容
+        for begin, end in highlights or []:
+            self.chat_text.tag_add("highlight", f"{start}+{len(head) + begin}c", f"{start}+{len(head) + end}c")
+    
+    def load_earlier_messages(self):
+        """向上翻页：在顶部插入更早的一页消息"""
+        if not self.chat_manager or not self.history_cursor:
+            return
+        
+        try:
+            messages = self._fetch_history_page(before=self.history_cursor)
+            self.chat_text.config(state='normal')
+            # 倒序插入到顶部，保持时间顺序
+            for msg in reversed(messages):
+                self._insert_chat_message(msg, '1.0')
+            self.chat_text.config(state='disabled')
+            self.chat_text.see('1.0')
+        except Exception as e:
+            print(f"加载更早消息时出错: {e}")
+    
     # 以下方法保持不变，与基础版gui.py相同
     def on_input_focus_in(self, event):
         """输入框获得焦点"""
@@ -786,6 +876,21 @@ class EnhancedApplication(tk.Frame):
             self.refresh_current_chat()
             self.master.after(30000, self.start_auto_refresh)  # 30秒后再次刷新
     
+    def _on_messages_changed(self, event, conversation_id, messages):
+        """消息仓库变化通知，可能来自其他线程，交给界面线程刷新"""
+        if self.is_closing:
+            return
+        # 自己发送的消息由发送完成回调刷新，这里不再重复刷新和标记已读
+        if event == "append" and messages and all(msg.sender == self.username for msg in messages):
+            return
+        if conversation_id is None or conversation_id == self.current_chat_id:
+            self.master.after(0, self.refresh_current_chat)
+    
+    def _unsubscribe_messages(self):
+        """关闭窗口前取消订阅消息变化"""
+        if self.chat_manager and hasattr(self.chat_manager, 'unsubscribe'):
+            self.chat_manager.unsubscribe(self._on_messages_changed)
+    
     def search_messages(self, event=None):
         """搜索消息"""
         keyword = self.search_entry.get().strip()
@@ -795,29 +900,37 @@ class EnhancedApplication(tk.Frame):
         
         try:
             if self.chat_manager:
-                results = self.chat_manager.search_messages(keyword, self.current_chat_id)
+                if self.search_all_var.get() and hasattr(self.chat_manager, 'search_all_chats'):
+                    page = self.chat_manager.search_all_chats(self.username, keyword, limit=SEARCH_PAGE_SIZE)
+                    results = page["results"]
+                    has_more = page["next_cursor"] is not None
+                elif hasattr(self.chat_manager, 'search_messages_ranked'):
+                    # 按相关度排序，只取最相关的一页，并带有高亮区间
+                    page = self.chat_manager.search_messages_ranked(keyword, self.current_chat_id, self.username,
+                                                                    limit=SEARCH_PAGE_SIZE)
+                    results = page["results"]
+                    has_more = page["next_cursor"] is not None
+                else:
+                    results = [{"message": msg, "highlights": []}
+                               for msg in self.chat_manager.search_messages(keyword, self.current_chat_id)]
+                    has_more = False
+                
                 if results:
                     # 显示搜索结果
                     self.chat_text.config(state='normal')
                     self.chat_text.delete('1.0', tk.END)
                     
-                    for msg in results:
-                        sender = msg.get('sender', '未知用户')
-                        content = msg.get('content', '')
-                        timestamp = msg.get('timestamp', '')
-                        
-                        # 格式化时间
-                        try:
-                            time_obj = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-                            display_time = time_obj.strftime("%m/%d %H:%M")
-                        except:
-                            display_time = timestamp
-                        
-                        display_line = f"[{display_time}] {sender}: {content}\n\n"
-                        self.chat_text.insert(tk.END, display_line)
+                    if has_more:
+                        summary = f"🔎 '{keyword}' 的搜索结果（按相关度排序，显示最相关的 {len(results)} 条）\n\n"
+                    else:
+                        summary = f"🔎 '{keyword}' 的搜索结果（按相关度排序，共 {len(results)} 条）\n\n"
+                    self.chat_text.insert(tk.END, summary, "system")
+                    for result in results:
+                        self._insert_chat_message(result["message"], tk.END, result["highlights"])
                     
+                    self.chat_text.tag_config("highlight", background="#F9E79F")
                     self.chat_text.config(state='disabled')
-                    messagebox.showinfo("搜索结果", f"找到 {len(results)} 条包含 '{keyword}' 的消息")
+                    self.chat_text.see('1.0')
                 else:
                     messagebox.showinfo("搜索结果", f"没有找到包含 '{keyword}' 的消息")
                     self.refresh_current_chat()  # 恢复显示所有消息
@@ -847,6 +960,7 @@ class EnhancedApplication(tk.Frame):
             
             print(f"👋 用户 {self.username} 注销")
             self.is_closing = True
+            self._unsubscribe_messages()
             self.master.destroy()
             
             # 重新启动增强版登录界面
@@ -868,11 +982,16 @@ class EnhancedApplication(tk.Frame):
         self.is_closing = True
         if messagebox.askokcancel("退出", "确定要退出中考加油聊天室吗？"):
             print("👋 退出中考加油聊天室")
+            self._unsubscribe_messages()
             self.master.destroy()
 
-def start_enhanced_app(username="同学"):
+def start_enhanced_app(username="同学", main_manager=None):
     """
     启动增强版应用程序
+
+    参数:
+    - username: 当前登录的用户名
+    - main_manager: 可选的主管理器实例，提供时共用它的聊天和好友管理器
     """
     print(f"🎉 欢迎 {username} 使用增强版聊天室！")
     print("💡 新功能：多会话支持（广播室 + 个人聊天 + 群组聊天）")
@@ -885,7 +1004,7 @@ def start_enhanced_app(username="同学"):
         root.minsize(800, 500)
         
         # 创建应用
-        app = EnhancedApplication(master=root, username=username)
+        app = EnhancedApplication(master=root, username=username, main_manager=main_manager)
         
         # 启动主循环
         root.mainloop()
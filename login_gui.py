@@ -401,12 +401,10 @@ class LoginApp:
         stats_frame = tk.Frame(card_frame, bg="white")
         stats_frame.pack(fill="x", pady=20)
         
-        # 消息统计
+        # 消息统计：使用主管理器中已加载的聊天管理器，直接读取计数
         try:
-            from chat import ChatManager
-            chat_mgr = ChatManager()
-            user_messages = chat_mgr.get_user_messages(self.current_user)
-            message_count = len(user_messages)
+            chat_mgr = main_manager.get_manager('chat') if main_manager else None
+            message_count = chat_mgr.get_user_message_count(self.current_user) if chat_mgr else 0
         except:
             message_count = 0
         
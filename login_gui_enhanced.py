@@ -428,7 +428,7 @@ class EnhancedLoginApp:
                 raise ImportError("增强版GUI文件不存在")
                 
             from gui_enhanced import start_enhanced_app
-            start_enhanced_app(self.current_user)
+            start_enhanced_app(self.current_user, self.main_manager)
         except ImportError as e:
             print(f"❌ 无法启动增强版: {e}")
             # 尝试启动基础版
@@ -0,0 +1,67 @@
+# test_friend_suggestions.py
+"""
+好友推荐的回归测试
+用法: python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from StorageBackend import create_storage_backend
+from FriendManager import FriendManager
+from friend import Friend
+from FriendSuggester import FriendSuggester
+
+
+class SharedSuggestionsTest(unittest.TestCase):
+    """
+    Friend 和 FriendManager 共用一个好友图和推荐器，任何一方修改好友关系后两边的推荐都是最新的
+    """
+
+    def test_changes_from_either_module_reach_both_suggestions(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            storage = create_storage_backend(data_dir, "json")
+            manager = FriendManager(data_dir, storage=storage)
+            friend = Friend(data_dir=data_dir, storage=storage)
+            # 先查询一次，让推荐结果进入缓存
+            self.assertEqual(manager.suggest_friends("小明"), [])
+
+            self.assertTrue(friend.add_friend("小明", "小红")[0])
+            self.assertTrue(friend.add_friend("小红", "小刚")[0])
+            self.assertEqual([item["user"] for item in friend.suggest_friends("小明")], ["小刚"])
+            self.assertEqual([item["user"] for item in manager.suggest_friends("小明")], ["小刚"])
+
+            self.assertTrue(manager.remove_friend("小红", "小刚")[0])
+            self.assertEqual(friend.suggest_friends("小明"), [])
+
+
+class ConcurrentInvalidationTest(unittest.TestCase):
+    """
+    其他线程让缓存失效（群组仓库的通知）时，推荐仍然返回正确结果，不会因为缓存项被删除而出错
+    """
+
+    def test_suggest_while_invalidating(self):
+        friends = {"小明": {"小红"}, "小红": {"小明", "小刚"}, "小刚": {"小红"}}
+        suggester = FriendSuggester(friends)
+        stop = threading.Event()
+
+        def invalidate():
+            while not stop.is_set():
+                suggester.invalidate_users(["小明"])
+
+        worker = threading.Thread(target=invalidate, daemon=True)
+        worker.start()
+        try:
+            for _ in range(5000):
+                self.assertEqual([item["user"] for item in suggester.suggest("小明")], ["小刚"])
+        finally:
+            stop.set()
+            worker.join(timeout=10)
+
+
+if __name__ == "__main__":
+    unittest.main()
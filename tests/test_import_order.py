@@ -0,0 +1,74 @@
+# test_import_order.py
+"""
+导入历史消息后会话保持时间顺序的回归测试
+用法: python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from StorageBackend import create_storage_backend
+from MessageStore import MessageStore
+
+
+class ImportOrderTest(unittest.TestCase):
+    """
+    导入的消息插入到原始时间的位置：分页、最新消息按时间，增量拉取和未读数按到达顺序（seq）
+    """
+
+    EXPECTED = ["很早", "第0条", "第1条", "第2条", "补发", "第3条", "第4条", "第5条"]
+
+    def _import(self, data_dir, mode):
+        store = MessageStore(create_storage_backend(data_dir, mode))
+        store.load()
+        for i in range(6):
+            store.append({"sender": "小明", "recipient_id": "BROADCAST_ROOM",
+                          "content": f"第{i}条", "timestamp": f"2025-06-01 08:0{i}:00"})
+        last = store.get_last_message("BROADCAST_ROOM")
+        self.assertTrue(store.import_messages([
+            {"sender": "小红", "recipient_id": "BROADCAST_ROOM", "content": "补发",
+             "timestamp": "2025-06-01 08:02:30"},
+            {"sender": "小红", "recipient_id": "BROADCAST_ROOM", "content": "很早",
+             "timestamp": "2024-01-01 08:00:00"},
+        ]))
+        self.assertIs(store.get_last_message("BROADCAST_ROOM"), last)
+        self.assertEqual([msg.content for msg in store.get_conversation("BROADCAST_ROOM")], self.EXPECTED)
+        self.assertEqual([msg.content for msg in store.get_messages_since("BROADCAST_ROOM", 6)], ["很早", "补发"])
+        self.assertEqual(store.get_unread_count("小明", "BROADCAST_ROOM"), 2)
+        # 发送推进的已读水位线和发送者计数延迟写入，临时目录删除前写完
+        self.assertTrue(store.save_deferred_state())
+
+    def _pages(self, store, limit):
+        contents, cursor = [], None
+        while True:
+            page = store.get_page("BROADCAST_ROOM", cursor, limit)
+            contents[:0] = [msg.content for msg in page["messages"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return contents
+
+    def test_import_keeps_time_order(self):
+        for mode in ("json", "jsonl", "segmented", "sqlite"):
+            for tail_size in (None, 3):
+                with self.subTest(mode=mode, tail_size=tail_size), tempfile.TemporaryDirectory() as data_dir:
+                    self._import(data_dir, mode)
+                    reloaded = MessageStore(create_storage_backend(data_dir, mode), tail_size=tail_size)
+                    reloaded.load()
+                    self.assertEqual(reloaded.get_last_message("BROADCAST_ROOM").content, "第5条")
+                    self.assertEqual(self._pages(reloaded, 3), self.EXPECTED)
+                    self.assertEqual([msg.content for msg in reloaded.get_messages_since("BROADCAST_ROOM", 5)],
+                                     ["第5条", "很早", "补发"])
+
+    def test_invalid_cursor(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            store = MessageStore(create_storage_backend(data_dir, "json"))
+            store.load()
+            with self.assertRaises(ValueError):
+                store.get_page("BROADCAST_ROOM", "12")
+
+
+if __name__ == "__main__":
+    unittest.main()
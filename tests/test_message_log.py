@@ -0,0 +1,49 @@
+# test_message_log.py
+"""
+追加式日志的回归测试
+用法: python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MessageLog import MessageLog
+from StorageBackend import create_storage_backend
+
+
+class TornLineTest(unittest.TestCase):
+    """
+    写到一半退出留下的残行不能让下一次追加的内容一起损坏
+    """
+
+    def test_append_after_torn_write(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            log_file = Path(data_dir) / "messages.jsonl"
+            log = MessageLog(log_file)
+            self.assertTrue(log.append_many([{"id": 1}, {"id": 2}]))
+            with open(log_file, 'a', encoding='utf-8') as f:
+                f.write('{"id": 3, "content": "写到一')
+
+            reopened = MessageLog(log_file)
+            self.assertTrue(reopened.append({"id": 4}))
+            self.assertEqual([msg["id"] for msg in MessageLog(log_file).load()], [1, 2, 4])
+
+    def test_edge_log_after_torn_write(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            storage = create_storage_backend(data_dir, "json")
+            storage.save_edges("friends", {}, [{"op": "add", "key": "小明", "value": "小红"}])
+            with open(Path(data_dir) / "friends.log.jsonl", 'a', encoding='utf-8') as f:
+                f.write('{"op": "add", "key": "小')
+
+            reopened = create_storage_backend(data_dir, "json")
+            reopened.save_edges("friends", {}, [{"op": "add", "key": "小刚", "value": "小红"}])
+            friends = create_storage_backend(data_dir, "json").load_document("friends")
+            self.assertEqual(friends, {"小明": ["小红"], "小刚": ["小红"]})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+# test_read_marks.py
+"""
+已读水位线的回归测试
+用法: python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from StorageBackend import create_storage_backend
+from MessageStore import MessageStore
+
+
+class SenderReadMarkTest(unittest.TestCase):
+    """
+    发送消息时只在内存中推进发送者的已读水位线，不在每次发送时重写已读文档
+    """
+
+    def test_send_defers_read_mark_write(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            storage = create_storage_backend(data_dir, "json")
+            store = MessageStore(storage)
+            store.load()
+            for i in range(3):
+                store.append({"sender": "小明", "recipient_id": "BROADCAST_ROOM",
+                              "content": f"第{i}条", "timestamp": "2025-06-01 08:00:00"})
+
+            self.assertEqual(store.get_unread_count("小明", "BROADCAST_ROOM"), 0)
+            self.assertEqual(store.get_unread_count("小红", "BROADCAST_ROOM"), 3)
+            self.assertIsNone(storage.load_document("read_marks"))
+
+            self.assertTrue(store.save_deferred_state())
+            reloaded = MessageStore(create_storage_backend(data_dir, "json"))
+            reloaded.load()
+            self.assertEqual(reloaded.get_unread_count("小明", "BROADCAST_ROOM"), 0)
+            self.assertEqual(reloaded.get_unread_count("小红", "BROADCAST_ROOM"), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
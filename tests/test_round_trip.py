@@ -0,0 +1,124 @@
+# test_round_trip.py
+"""
+各存储模式下消息的完整往返：发送 → 重启 → 清空 → 压缩 → 只加载尾部重启
+用法: python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from StorageBackend import create_storage_backend, STORAGE_MODES
+from MessageStore import MessageStore
+
+
+class RoundTripTest(unittest.TestCase):
+    """
+    每种存储模式都走同一套流程，重启时每个会话只加载最新 3 条（history_tail）
+    """
+
+    TAIL = 3
+
+    def _open(self, data_dir, mode, tail_size=None):
+        store = MessageStore(create_storage_backend(data_dir, mode), tail_size=tail_size)
+        store.load()
+        return store
+
+    def _send(self, store, recipient_id, content, sender="小明"):
+        self.assertTrue(store.append({"sender": sender, "recipient_id": recipient_id,
+                                      "content": content, "timestamp": "2025-06-01 08:00:00"}))
+
+    def _close(self, store):
+        # 延迟写入的已读水位线和发送者计数在临时目录删除前写完
+        self.assertTrue(store.save_deferred_state())
+        store.storage.close()
+
+    def _all_pages(self, store, conversation_id, limit):
+        """
+        用 before= 游标从最新一页翻到最早一页，返回按时间顺序的全部内容和每页条数
+        """
+        contents, sizes, cursor = [], [], None
+        while True:
+            page = store.get_page(conversation_id, before=cursor, limit=limit)
+            contents[:0] = [msg.content for msg in page["messages"]]
+            sizes.append(len(page["messages"]))
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return contents, sizes
+
+    def test_round_trip(self):
+        for mode in STORAGE_MODES:
+            with self.subTest(mode=mode), tempfile.TemporaryDirectory() as data_dir:
+                self._round_trip(data_dir, mode)
+
+    def _round_trip(self, data_dir, mode):
+        broadcast = [f"第{i}条" for i in range(8)]
+        store = self._open(data_dir, mode)
+        for content in broadcast:
+            self._send(store, "BROADCAST_ROOM", content)
+        self._send(store, "group_1", "群消息1", sender="小红")
+        self._send(store, "group_1", "群消息2", sender="小红")
+        self._close(store)
+
+        # 重启：只加载尾部，翻页和增量拉取时按需补读更早的历史
+        store = self._open(data_dir, mode, self.TAIL)
+        self.assertEqual(store.count_conversation("BROADCAST_ROOM"), 8)
+        self.assertEqual(store.count_by_sender("小明"), 8)
+        self.assertEqual(self._all_pages(store, "BROADCAST_ROOM", 3), (broadcast, [3, 3, 2]))
+        self.assertEqual([msg.content for msg in store.get_messages_since("group_1", 0)], ["群消息1", "群消息2"])
+        self.assertEqual([msg.content for msg in store.search("第7")], ["第7条"])
+
+        # 清空并压缩：存储中只剩下其他会话的消息
+        self.assertTrue(store.clear_conversation("BROADCAST_ROOM"))
+        self.assertEqual(store.count_conversation("BROADCAST_ROOM"), 0)
+        self.assertTrue(store.compact())
+        on_disk = store.storage.load_messages() or []
+        self.assertEqual(sorted(msg["content"] for msg in on_disk), ["群消息1", "群消息2"])
+        self._send(store, "BROADCAST_ROOM", "清空后")
+        self._close(store)
+
+        # 再次只加载尾部重启：序号从水位线继续，清空的消息不会回来
+        store = self._open(data_dir, mode, self.TAIL)
+        self.assertEqual([(msg.seq, msg.content) for msg in store.get_conversation("BROADCAST_ROOM")],
+                         [(9, "清空后")])
+        self.assertEqual(store.count_conversation("BROADCAST_ROOM"), 1)
+        self.assertEqual(store.count_by_sender("小明"), 1)
+        self.assertEqual(store.count_by_sender("小红"), 2)
+        self.assertEqual(self._all_pages(store, "BROADCAST_ROOM", 3), (["清空后"], [1]))
+        self.assertEqual(store.search("第7"), [])
+        self._close(store)
+
+
+class PagingTest(unittest.TestCase):
+    """
+    before= 游标翻页：每页取游标之前最新的 limit 条，翻到最早一页后游标为 None
+    """
+
+    def test_pages_before_cursor(self):
+        for mode in ("json", "segmented"):
+            with self.subTest(mode=mode), tempfile.TemporaryDirectory() as data_dir:
+                store = MessageStore(create_storage_backend(data_dir, mode))
+                store.load()
+                for i in range(5):
+                    store.append({"sender": "小明", "recipient_id": "BROADCAST_ROOM",
+                                  "content": f"第{i}条", "timestamp": f"2025-06-01 08:0{i}:00"})
+                first = store.get_page("BROADCAST_ROOM", limit=2)
+                self.assertEqual([msg.content for msg in first["messages"]], ["第3条", "第4条"])
+                second = store.get_page("BROADCAST_ROOM", before=first["next_cursor"], limit=2)
+                self.assertEqual([msg.content for msg in second["messages"]], ["第1条", "第2条"])
+                last = store.get_page("BROADCAST_ROOM", before=second["next_cursor"], limit=2)
+                self.assertEqual([msg.content for msg in last["messages"]], ["第0条"])
+                self.assertIsNone(last["next_cursor"])
+                # 游标之后的新消息不影响已经翻到的位置
+                store.append({"sender": "小明", "recipient_id": "BROADCAST_ROOM",
+                              "content": "新消息", "timestamp": "2025-06-01 08:09:00"})
+                again = store.get_page("BROADCAST_ROOM", before=first["next_cursor"], limit=2)
+                self.assertEqual([msg.content for msg in again["messages"]], ["第1条", "第2条"])
+                self.assertTrue(store.save_deferred_state())
+                store.storage.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+# test_search_index.py
+"""
+搜索索引持久化的回归测试：清单补齐、重建和分段合并
+用法: python -m pytest tests
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MessageRecord import MessageRecord
+from SearchIndex import SearchIndex
+
+
+def _records(start, end, content="消息{}"):
+    return [MessageRecord("小明", "BROADCAST_ROOM", content.format(i), 1750000000 + i, id=i, seq=i)
+            for i in range(start, end + 1)]
+
+
+class ManifestTest(unittest.TestCase):
+    """
+    启动时按清单判断磁盘索引是否可用：落后时只补上缺少的消息，消息记录被整体替换时重建
+    """
+
+    def _manifest(self, index_dir):
+        with open(os.path.join(index_dir, "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_catch_up_missing_messages(self):
+        with tempfile.TemporaryDirectory() as index_dir:
+            records = _records(1, 5)
+            index = SearchIndex(index_dir)
+            self.assertFalse(index.load(records, 5))
+            index.close()
+            self.assertEqual(self._manifest(index_dir)["max_id"], 5)
+
+            # 上次退出后又有 3 条消息没有写入索引
+            records += _records(6, 8)
+            index = SearchIndex(index_dir)
+            self.assertTrue(index.load(records, 8))
+            self.assertEqual([record.id for record in index.search("消息")], list(range(1, 9)))
+            self.assertEqual(self._manifest(index_dir)["max_id"], 8)
+            index.close()
+
+    def test_rebuild_when_messages_replaced(self):
+        with tempfile.TemporaryDirectory() as index_dir:
+            index = SearchIndex(index_dir)
+            index.load(_records(1, 5), 5)
+            index.close()
+
+            # 消息记录被整体替换：最后一条已索引消息的内容变了
+            replaced = _records(1, 5, content="新内容{}")
+            index = SearchIndex(index_dir)
+            self.assertFalse(index.load(replaced, 5))
+            self.assertEqual(index.search("消息"), [])
+            self.assertEqual(len(index.search("新内容")), 5)
+            index.close()
+
+            # 重建后的索引可以直接使用
+            index = SearchIndex(index_dir)
+            self.assertTrue(index.load(replaced, 5))
+            self.assertEqual(len(index.search("新内容")), 5)
+            index.close()
+
+
+class SegmentMergeTest(unittest.TestCase):
+    """
+    分段按大小在后台合并，分段数保持在对数级别，合并时丢掉已删除的消息
+    """
+
+    def test_merge_keeps_results(self):
+        with tempfile.TemporaryDirectory() as index_dir:
+            index = SearchIndex(index_dir)
+            index.FLUSH_SIZE = 10
+            index.load([], 0)
+            records = _records(1, 400)
+            for record in records:
+                index.add(record)
+            index.remove_many(records[:50])
+            index.close()
+            self.assertLessEqual(len(index._segments), 10)
+
+            index = SearchIndex(index_dir)
+            self.assertTrue(index.load(records[50:], 400))
+            self.assertEqual([record.id for record in index.search("消息")], list(range(51, 401)))
+            index.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+# test_sender_counts.py
+"""
+发送者计数的回归测试
+用法: python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from StorageBackend import create_storage_backend
+from MessageStore import MessageStore
+
+
+class SenderCountTest(unittest.TestCase):
+    """
+    只加载尾部时统计发送条数不加载历史；计数没来得及写入就重启时按水位线和 seq 补齐
+    """
+
+    def _open(self, data_dir, mode):
+        store = MessageStore(create_storage_backend(data_dir, mode), tail_size=3)
+        store.load()
+        return store
+
+    def _lose_sender_counts(self, store):
+        """
+        模拟发送者计数写入前进程退出（已读水位线照常写入）
+        """
+        store._dirty_sender_counts.clear()
+        self.assertTrue(store.save_deferred_state())
+
+    def _counts(self, store):
+        return store.count_by_sender("小明"), store.count_by_sender("小红")
+
+    def test_counts_survive_restart(self):
+        for mode in ("segmented", "sqlite"):
+            with self.subTest(mode=mode), tempfile.TemporaryDirectory() as data_dir:
+                store = self._open(data_dir, mode)
+                for i in range(10):
+                    store.append({"sender": "小明" if i % 3 else "小红",
+                                  "recipient_id": "BROADCAST_ROOM" if i < 7 else "group_1",
+                                  "content": f"第{i}条", "timestamp": "2025-06-01 08:00:00"})
+                self.assertEqual(self._counts(store), (6, 4))
+                self.assertTrue(store.save_deferred_state())
+
+                store = self._open(data_dir, mode)
+                self.assertEqual(self._counts(store), (6, 4))
+                self.assertIn("BROADCAST_ROOM", store._partial)
+
+                # 新消息的计数还没写入就重启
+                store.append({"sender": "小红", "recipient_id": "BROADCAST_ROOM",
+                              "content": "补充", "timestamp": "2025-06-01 08:00:00"})
+                self._lose_sender_counts(store)
+                store = self._open(data_dir, mode)
+                self.assertEqual(self._counts(store), (6, 5))
+                self.assertTrue(store.save_deferred_state())
+
+                # 清空后计数还没写入就重启
+                self.assertTrue(store.clear_conversation("BROADCAST_ROOM"))
+                self.assertEqual(self._counts(store), (2, 1))
+                self._lose_sender_counts(store)
+                store = self._open(data_dir, mode)
+                self.assertEqual(self._counts(store), (2, 1))
+                self.assertTrue(store.save_deferred_state())
+                store.storage.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+# test_write_behind.py
+"""
+消息延迟写入的回归测试
+用法: python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from StorageBackend import create_storage_backend
+from MessageStore import MessageStore
+
+
+class WriteBehindClearTest(unittest.TestCase):
+    """
+    延迟写入时，发送消息与清空、压缩同时进行不能死锁
+    （json 格式下仓库持锁调用后端刷写，而后台刷写线程要通过 all_messages 获取仓库的锁），
+    其他存储模式也走同一条刷写路径
+    """
+
+    def test_send_while_clearing_does_not_deadlock(self):
+        for mode in ("json", "jsonl", "segmented", "sqlite"):
+            with self.subTest(mode=mode):
+                self._send_while_clearing(mode)
+
+    def _send_while_clearing(self, mode):
+        with tempfile.TemporaryDirectory() as data_dir:
+            storage = create_storage_backend(data_dir, mode,
+                                             write_behind={"batch_size": 5, "flush_interval_ms": 1})
+            store = MessageStore(storage)
+            store.load()
+
+            def send():
+                for i in range(300):
+                    store.append({"sender": "小明", "recipient_id": "BROADCAST_ROOM",
+                                  "content": f"第{i}条", "timestamp": "2025-06-01 08:00:00"})
+
+            sender = threading.Thread(target=send, daemon=True)
+            worker = threading.Thread(target=lambda: [
+                (store.clear_conversation("BROADCAST_ROOM"), store.compact()) for _ in range(50)
+            ], daemon=True)
+            sender.start()
+            worker.start()
+            sender.join(timeout=30)
+            worker.join(timeout=30)
+            self.assertFalse(sender.is_alive(), "发送线程死锁")
+            self.assertFalse(worker.is_alive(), "清空线程死锁")
+
+            # 全部提交后，磁盘上的消息与内存中可见的消息一致
+            store.save_deferred_state()
+            storage.flush()
+            on_disk = {msg["id"] for msg in storage.load_messages() or []}
+            self.assertEqual(on_disk, {msg["id"] for msg in store._message_dicts()})
+            storage.close()
+
+
+if __name__ == "__main__":
+    unittest.main()